@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import collections
+import contextvars
+import functools
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+TRACING_ENABLED = os.getenv('TracingEnabled', 'false').lower() == 'true'
+TRACING_SAMPLE_RATE = float(os.getenv('TracingSampleRate', '0.01'))
+TRACING_OUTPUT = os.getenv('TracingOutput', '-') # '-' for stdout (CloudWatch Logs on AWS Lambda), or a JSON lines file path
+
+#XXX: A private random generator, so that sampling does not change
+# the sequence of the global random generator seeded by lambda functions.
+_SAMPLER = random.Random()
+
+_CURRENT_SPAN = contextvars.ContextVar('current_span', default=None)
+
+
+class NoopSpan:
+  """The span returned outside of a sampled trace. It records nothing."""
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    return False
+
+  def set_attribute(self, key, value):
+    pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+  __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'start_time', 'start', 'end', 'token')
+
+  def __init__(self, trace, name, parent_id, attributes):
+    self.trace = trace
+    self.span_id = len(trace['spans'])
+    self.parent_id = parent_id
+    self.name = name
+    self.attributes = attributes
+    self.start_time, self.start, self.end, self.token = (None, None, None, None)
+    trace['spans'].append(self)
+
+  def __enter__(self):
+    self.token = _CURRENT_SPAN.set(self)
+    self.start_time = time.time()
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    self.end = time.perf_counter()
+    _CURRENT_SPAN.reset(self.token)
+    if exc_type is not None:
+      self.attributes['error'] = exc_type.__name__
+    return False
+
+  def set_attribute(self, key, value):
+    self.attributes[key] = value
+
+  def to_dict(self, trace_start):
+    return {
+      'span_id': self.span_id,
+      'parent_id': self.parent_id,
+      'name': self.name,
+      'start_ms': round((self.start - trace_start) * 1000, 3),
+      'duration_ms': round(((self.end or time.perf_counter()) - self.start) * 1000, 3),
+      'attributes': self.attributes
+    }
+
+
+def span(name, **attributes):
+  """Returns a span as a child of the current span, or `NOOP_SPAN` if no trace is sampled."""
+  parent = _CURRENT_SPAN.get()
+  if parent is None:
+    return NOOP_SPAN
+  return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def export(trace):
+  root = trace['spans'][0]
+  line = json.dumps({
+    'trace_id': trace['trace_id'],
+    'name': root.name,
+    'start_time': root.start_time,
+    'duration_ms': round((root.end - root.start) * 1000, 3),
+    'spans': [e.to_dict(root.start) for e in trace['spans']]
+  }, default=str)
+
+  if TRACING_OUTPUT == '-':
+    print(line, flush=True)
+  else:
+    with open(TRACING_OUTPUT, 'a') as f:
+      f.write(line + '\n')
+
+
+def trace(name, enabled=None, sample_rate=None):
+  """Decorates a lambda handler to start a trace for a sampled invocation.
+
+  The handler is returned as it is if tracing is disabled, and spans outside of a sampled trace are `NOOP_SPAN`.
+  """
+  enabled = TRACING_ENABLED if enabled is None else enabled
+  sample_rate = TRACING_SAMPLE_RATE if sample_rate is None else sample_rate
+
+  def decorator(fn):
+    if not enabled:
+      return fn
+
+    @functools.wraps(fn)
+    def wrapper(event, context):
+      if _SAMPLER.random() >= sample_rate:
+        return fn(event, context)
+
+      request_id = getattr(context, 'aws_request_id', None)
+      root = Span({'trace_id': request_id or uuid.uuid4().hex, 'spans': []}, name, None, {})
+      try:
+        with root:
+          return fn(event, context)
+      finally:
+        export(root.trace)
+    return wrapper
+  return decorator
+
+
+def load_traces(trace_files):
+  """Reads traces from JSON lines files. Lines of other logs, e.g. exported from CloudWatch Logs, are skipped."""
+  for trace_file in trace_files:
+    with open(trace_file) as f:
+      for line in f:
+        try:
+          trace = json.loads(line[line.index('{'):])
+        except ValueError as _:
+          continue
+        if isinstance(trace, dict) and 'trace_id' in trace and 'spans' in trace:
+          yield trace
+
+
+def aggregate(traces):
+  """Aggregates spans by the path of names from the root span. Returns {path: [count, total_ms, self_ms]}."""
+  stats = collections.defaultdict(lambda: [0, 0.0, 0.0])
+  for trace in traces:
+    spans = {e['span_id']: e for e in trace['spans']}
+    children_ms = collections.Counter()
+    for e in trace['spans']:
+      if e['parent_id'] is not None:
+        children_ms[e['parent_id']] += e['duration_ms']
+
+    paths = {}
+    for e in trace['spans']:
+      parent = spans.get(e['parent_id'], None)
+      paths[e['span_id']] = (paths[parent['span_id']] if parent else ()) + (e['name'],)
+      stat = stats[paths[e['span_id']]]
+      stat[0] += 1
+      stat[1] += e['duration_ms']
+      # children running concurrently can take longer than their parent
+      stat[2] += max(0.0, e['duration_ms'] - children_ms[e['span_id']])
+  return stats
+
+
+def print_summary(stats, width=40):
+  """Prints the span tree sorted by total time, with a bar of its share of the root span."""
+  print('{:>12} {:>12} {:>8} {:>7}  {}'.format('total(ms)', 'self(ms)', 'count', '%', 'span'))
+
+  def walk(path):
+    root_ms = stats[path[:1]][1] or 1.0
+    count, total_ms, self_ms = stats[path]
+    share = total_ms / root_ms
+    print('{:>12.1f} {:>12.1f} {:>8} {:>6.1%}  {}{} {}'.format(total_ms, self_ms, count, share,
+      '  ' * (len(path) - 1), path[-1], '#' * max(1, round(share * width))))
+    children = [e for e in stats if len(e) == len(path) + 1 and e[:len(path)] == path]
+    for child in sorted(children, key=lambda e: -stats[e][1]):
+      walk(child)
+
+  for root in sorted((e for e in stats if len(e) == 1), key=lambda e: -stats[e][1]):
+    walk(root)
+
+
+def print_folded(stats):
+  """Prints the self time of each span path in microseconds in the folded stack format of flamegraph.pl."""
+  for path, (_, _, self_ms) in sorted(stats.items()):
+    print('{} {}'.format(';'.join(path), int(self_ms * 1000)))
+
+
+def measure_overhead(iterations):
+  """Measures the cost of a span when tracing is disabled or the invocation is not sampled, and when it is sampled."""
+  def loop(fn):
+    start = time.perf_counter()
+    for _ in range(iterations):
+      fn()
+    return (time.perf_counter() - start) / iterations * 1e9
+
+  def bare():
+    pass
+
+  def with_span():
+    with span('stage'):
+      pass
+
+  def handler(event, context):
+    with span('stage'):
+      pass
+
+  unsampled_handler = trace('handler', enabled=True, sample_rate=0.0)(handler)
+  root = Span({'trace_id': 'overhead', 'spans': []}, 'handler', None, {})
+
+  baseline_ns = loop(bare)
+  results = {
+    'span outside of a sampled trace': loop(with_span) - baseline_ns,
+    'handler not sampled': loop(lambda: unsampled_handler(None, None)) - loop(lambda: handler(None, None))
+  }
+  with root:
+    results['span in a sampled trace'] = loop(with_span) - baseline_ns
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Summarize traces of the lambda functions like a flame graph')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  summary_parser = subparsers.add_parser('summary', help='print the span tree of traces')
+  summary_parser.add_argument('trace_files', nargs='+',
+    help='JSON lines files of traces, or log files exported from CloudWatch Logs')
+  summary_parser.add_argument('--name', help='summarize only the traces of this root span')
+  summary_parser.add_argument('--folded', action='store_true',
+    help='print the folded stack format for flamegraph.pl or speedscope instead')
+
+  overhead_parser = subparsers.add_parser('overhead', help='measure the overhead of spans')
+  overhead_parser.add_argument('--iterations', default=1000000, type=int,
+    help='The number of spans to measure (default: 1000000)')
+
+  options = parser.parse_args()
+
+  if options.command == 'overhead':
+    for name, ns in measure_overhead(options.iterations).items():
+      print('{:>32}: {:>8.0f} ns'.format(name, ns))
+    return
+
+  traces = [e for e in load_traces(options.trace_files) if options.name in (None, e['name'])]
+  if not traces:
+    print('[ERROR] No traces found', file=sys.stderr)
+    sys.exit(1)
+
+  stats = aggregate(traces)
+  if options.folded:
+    print_folded(stats)
+  else:
+    print('[INFO] {} traces'.format(len(traces)), file=sys.stderr)
+    print_summary(stats)
+
+
+if __name__ == '__main__':
+  main()
@@ -48,7 +48,7 @@ athena_databases = GlueCatalogDatabaseStack(app, 'GlueDatabasesOnAccessLogs')
 athena_databases.add_dependency(merge_small_files_stack)
 
 lakeformation_grant_permissions = DataLakePermissionsStack(app, 'GrantLFPermissionsOnMergeFilesJob',
-  merge_small_files_stack.lambda_exec_role
+  merge_small_files_stack.job_roles
 )
 lakeformation_grant_permissions.add_dependency(athena_databases)
 
@@ -56,7 +56,8 @@ athena_named_query_stack = AthenaNamedQueryStack(app,
   'SaaSMeteringAthenaNamedQueries',
   athena_work_group_stack.athena_work_group_name,
   merge_small_files_stack.s3_json_location,
-  merge_small_files_stack.s3_parquet_location
+  merge_small_files_stack.s3_parquet_location,
+  s3_daily_location=merge_small_files_stack.s3_daily_location
 )
 athena_named_query_stack.add_dependency(lakeformation_grant_permissions)
 
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import datetime
+import json
+import os
+import random
+import uuid
+
+#XXX: Resources of the RandomStrings API
+RESOURCE_PATHS = ['/random/strings', '/random/strings/{len}', '/random/strings/upper', '/random/strings/lower']
+STATUS_CODES = [200] * 95 + [400, 403, 404, 429, 500]
+
+
+def gen_access_log(rng, basic_dt, users, weights=None):
+  """Returns a record of the access log format of the API Gateway stage in the hour of `basic_dt`."""
+  request_dt = basic_dt + datetime.timedelta(seconds=rng.uniform(0, 3600))
+  return {
+    'requestId': str(uuid.UUID(int=rng.getrandbits(128))),
+    'ip': '10.{}.{}.{}'.format(rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+    'user': rng.choices(users, weights)[0] if weights else rng.choice(users),
+    'requestTime': int(request_dt.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000),
+    'httpMethod': 'GET',
+    'resourcePath': rng.choice(RESOURCE_PATHS),
+    'status': rng.choice(STATUS_CODES),
+    'protocol': 'HTTP/1.1',
+    'responseLength': rng.randrange(16, 1024)
+  }
+
+
+def gen_users(num_users, seed=47):
+  rng = random.Random(seed)
+  return ['{}@example.com'.format(uuid.UUID(int=rng.getrandbits(128)).hex[:12]) for _ in range(num_users)]
+
+
+def gen_zipf_weights(num_users, s=1.1):
+  """Returns the weights of tenants whose requests follow Zipf's law, i.e. a few tenants send most of the requests."""
+  return [1 / (i + 1)**s for i in range(num_users)]
+
+
+def put_hour_json(root, location, basic_dt, num_objects, rows_per_object, users, weights=None, seed=47):
+  """Writes `num_objects` JSON Lines objects of an hour at `location` of a LocalStorage `root`, like the Firehose output.
+
+  Returns the number of rows written.
+  """
+  rng = random.Random(seed)
+  dir_path = os.path.join(root, location[len('s3://'):])
+  os.makedirs(dir_path, exist_ok=True)
+  for i in range(num_objects):
+    with open(os.path.join(dir_path, 'PUT-S3-access-log-{:%Y-%m-%d-%H}-{:04d}'.format(basic_dt, i)), 'w') as f:
+      for _ in range(rows_per_object):
+        f.write(json.dumps(gen_access_log(rng, basic_dt, users, weights)) + '\n')
+  return num_objects * rows_per_object
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python'))
+
+import compaction_ledger
+import compaction_planner
+from local_athena import LocalAthenaClient, LocalGlueClient, LocalS3Client, run_backfill
+
+#XXX: (hour profile, number of objects, bytes of an object) of the Firehose output
+HOUR_PROFILES = [
+  ('empty', 0, 0),
+  ('quiet', 1, 40 * 1024),
+  ('normal', 60, 5 * 1024**2),
+  ('hot', 600, 5 * 1024**2),
+  ('very hot', 6000, 5 * 1024**2)
+]
+
+
+def benchmark_listing(athena_ctas, options):
+  """Compares listing the objects of hours one after another with the concurrent listing of the planner."""
+  s3 = athena_ctas.S3_CLIENT = LocalS3Client(list_latency=options.list_latency_ms / 1000)
+  start_dt = datetime.datetime(2023, 1, 1)
+  hours = [start_dt + datetime.timedelta(hours=i) for i in range(options.hours)]
+  for basic_dt in hours:
+    s3.put_hour_objects(athena_ctas.OLD_TABLE_LOCATION_PREFIX, basic_dt, options.objects_per_hour, 5 * 1024**2)
+
+  start = time.monotonic()
+  sequential = [athena_ctas.list_location(athena_ctas.get_hour_location(athena_ctas.OLD_TABLE_LOCATION_PREFIX, e)) for e in hours]
+  sequential_s = time.monotonic() - start
+
+  sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+  try:
+    start = time.monotonic()
+    plans = asyncio.run(athena_ctas.plan_hours(hours))
+    concurrent_s = time.monotonic() - start
+  finally:
+    sys.stderr = stderr
+
+  assert [(e['input_files'], e['input_bytes']) for e in plans.values()] == sequential
+  pages = sum(1 for e in s3.api_calls if e == 'ListObjectsV2') // 2
+  print('{:>6} {:>8} {:>6} {:>14} {:>14} {:>8}'.format('hours', 'objects', 'pages', 'sequential(s)', 'concurrent(s)', 'speedup'))
+  print('{:>6} {:>8} {:>6} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(len(hours), options.objects_per_hour * len(hours), pages,
+    sequential_s, concurrent_s, sequential_s / concurrent_s))
+
+
+def benchmark_plans(athena_ctas, options):
+  """Compacts hours of each profile as planned, and compares the predicted and actual numbers of files."""
+  s3 = athena_ctas.S3_CLIENT = LocalS3Client()
+  athena_ctas.GLUE_CLIENT = LocalGlueClient()
+  athena_ctas.TARGET_FILE_SIZE_MB = options.target_file_size_mb
+
+  start_dt = datetime.datetime(2023, 1, 31)
+  for i, (_, num_objects, size) in enumerate(HOUR_PROFILES):
+    s3.put_hour_objects(athena_ctas.OLD_TABLE_LOCATION_PREFIX, start_dt + datetime.timedelta(hours=i), num_objects, size)
+
+  print('\n{:>9} {:>8} {:>10} {:>8} {:>10} {:>7} {:>8}'.format('hour', 'objects', 'input(MB)', 'buckets', 'predicted',
+    'actual', 'queries'))
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    ledger = compaction_ledger.FileLedger(os.path.join(tmp_dir, 'ledger.jsonl'))
+    athena_client = LocalAthenaClient(time_scale=options.time_scale, s3=s3)
+    end_dt = start_dt + datetime.timedelta(hours=len(HOUR_PROFILES))
+    summary = run_backfill(athena_ctas, athena_client, start_dt, end_dt, 5, ledger)
+    records = ledger.get_records(athena_ctas.get_ledger_id(), *[e.strftime(athena_ctas.BACKFILL_HOUR_FMT) for e in (start_dt, end_dt)])
+
+  #XXX: The queries of an hour refer to its temporary table.
+  queries_by_hour = {i: sum(1 for e in athena_client.executions.values()
+    if '_{:%Y%m%d%H}'.format(start_dt + datetime.timedelta(hours=i)) in e['query']) for i in range(len(HOUR_PROFILES))}
+
+  for i, (name, num_objects, size) in enumerate(HOUR_PROFILES):
+    record = records[(start_dt + datetime.timedelta(hours=i)).strftime(athena_ctas.BACKFILL_HOUR_FMT)]
+    print('{:>9} {:>8} {:>10.1f} {:>8} {:>10} {:>7} {:>8}'.format(name, num_objects, num_objects * size / 1024**2,
+      record.get('bucket_count', '-'), record.get('predicted_files', 0), record.get('output_files', 0), queries_by_hour[i]))
+    if num_objects:
+      assert record['status'] == 'SUCCEEDED', record
+      #XXX: Athena chooses the number of files of an hour not bucketed.
+      assert record['bucket_count'] == 1 or record['predicted_files'] == record['output_files'], record
+    else:
+      assert record['status'] == 'EMPTY' and not queries_by_hour[i], record
+  assert summary['empty'] == 1 and not summary['failed']
+
+  print('\n[INFO] Files of about {} MB are planned with the Parquet to JSON ratio of {}; bucket_count is capped at {}.'.format(
+    options.target_file_size_mb, athena_ctas.PARQUET_TO_JSON_RATIO, compaction_planner.MAX_BUCKET_COUNT), file=sys.stderr)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the size-aware compaction planner against local stand-ins')
+  parser.add_argument('--hours', default=48, type=int,
+    help='The number of hours to list (default: 48)')
+  parser.add_argument('--objects-per-hour', default=2500, type=int,
+    help='The number of objects of an hour to list (default: 2500)')
+  parser.add_argument('--list-latency-ms', default=30, type=float,
+    help='The modeled latency of a page of ListObjectsV2 (default: 30)')
+  parser.add_argument('--target-file-size-mb', default=128, type=float,
+    help='The target size of merged files (default: 128)')
+  parser.add_argument('--time-scale', default=0.2, type=float,
+    help='The ratio of simulated query latencies (default: 0.2)')
+  options = parser.parse_args()
+
+  os.environ['DRY_RUN'] = 'false'
+  os.environ['SIZE_AWARE_PLANNING'] = 'true'
+  os.environ['EMIT_METRICS'] = 'false'
+  os.environ.setdefault('OLD_DATABASE', 'mydatabase')
+  os.environ.setdefault('OLD_TABLE_NAME', 'restapi_access_log_json')
+  os.environ.setdefault('NEW_DATABASE', 'mydatabase')
+  os.environ.setdefault('NEW_TABLE_NAME', 'restapi_access_log_parquet')
+  os.environ.setdefault('OLD_TABLE_LOCATION_PREFIX', 's3://example-bucket/json-data')
+  os.environ.setdefault('OUTPUT_PREFIX', 's3://example-bucket/parquet-data')
+  os.environ.setdefault('STAGING_OUTPUT_PREFIX', 's3://example-bucket/tmp')
+
+  import athena_ctas
+
+  benchmark_listing(athena_ctas, options)
+  benchmark_plans(athena_ctas, options)
+
+
+if __name__ == '__main__':
+  main()
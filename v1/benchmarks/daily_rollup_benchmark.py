@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import asyncio
+import collections
+import datetime
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python'))
+
+import json_to_parquet
+from access_logs import gen_access_log, gen_users, gen_zipf_weights
+
+#XXX: The columns read by the monthly invoice query
+INVOICE_QUERY_COLUMNS = ['user', 'responseLength']
+INVOICE_QUERY_FMT = '''SELECT "user", COUNT(*) AS requests, SUM(responseLength) AS response_bytes
+FROM {database}.{table}
+WHERE year={year} AND month={month}
+GROUP BY "user"
+'''
+
+
+def gen_hour_table(rng, basic_dt, num_rows, users, weights):
+  rows = [gen_access_log(rng, basic_dt, users, weights) for _ in range(num_rows)]
+  schema = json_to_parquet.get_schema()
+  columns = {name: [e[name] for e in rows] for name in schema.names}
+  columns['status'] = [str(e) for e in columns['status']]
+  columns['requestTime'] = [datetime.datetime.fromtimestamp(e / 1000, tz=datetime.timezone.utc) for e in columns['requestTime']]
+  return pa.table(columns, schema=schema)
+
+
+def write_month(root, month_dt, num_days, rows_per_hour, users, weights):
+  """Writes a Parquet file per hour like the hourly table, and a Parquet file per day like the daily table.
+
+  Returns the partition directories of each layout: {layout: [partition directory]}.
+  """
+  rng = random.Random(47)
+  layouts = collections.defaultdict(list)
+  for day in range(num_days):
+    day_dt = month_dt + datetime.timedelta(days=day)
+    tables = []
+    for hour in range(24):
+      basic_dt = day_dt.replace(hour=hour)
+      table = gen_hour_table(rng, basic_dt, rows_per_hour, users, weights)
+      path = os.path.join(root, 'hourly', 'year={}/month={:02}/day={:02}/hour={:02}'.format(basic_dt.year, basic_dt.month,
+        basic_dt.day, basic_dt.hour))
+      os.makedirs(path)
+      pq.write_table(table, os.path.join(path, '00000.parquet'), compression='snappy')
+      layouts['hourly'].append(path)
+      tables.append(table.append_column('hour', pa.array([hour] * table.num_rows, pa.int32())))
+
+    #XXX: The roll-up reads the hourly files of the day, and writes them as a file of the daily table.
+    path = os.path.join(root, 'daily', 'year={}/month={:02}/day={:02}/rollup=00000000T000000Z'.format(day_dt.year,
+      day_dt.month, day_dt.day))
+    os.makedirs(path)
+    pq.write_table(pa.concat_tables(tables), os.path.join(path, '00000.parquet'), compression='snappy')
+    layouts['daily'].append(path)
+
+  #XXX: The last day is still hourly, as the view reads the day before it is rolled up.
+  layouts['view'] = layouts['daily'][:-1] + layouts['hourly'][-24:]
+  return layouts
+
+
+def scan_month(partitions):
+  """Runs the invoice query over the partitions, listing each partition and reading INVOICE_QUERY_COLUMNS of its files.
+
+  Returns (requests by user, files, bytes read).
+  """
+  num_files, num_bytes = (0, 0)
+  totals = collections.Counter()
+  for path in partitions:
+    for name in sorted(os.listdir(path)):
+      parquet_file = pq.ParquetFile(os.path.join(path, name))
+      table = parquet_file.read(columns=INVOICE_QUERY_COLUMNS, use_threads=False)
+      metadata = parquet_file.metadata
+      num_files += 1
+      num_bytes += metadata.serialized_size + sum(metadata.row_group(i).column(j).total_compressed_size
+        for i in range(metadata.num_row_groups) for j in range(metadata.num_columns)
+        if metadata.schema.column(j).name in INVOICE_QUERY_COLUMNS)
+      for e in table.group_by('user').aggregate([('responseLength', 'count')]).to_pylist():
+        totals[e['user']] += e['responseLength_count']
+  return (totals, num_files, num_bytes)
+
+
+def run_local(options):
+  users = gen_users(options.users)
+  weights = gen_zipf_weights(options.users)
+  with tempfile.TemporaryDirectory() as root:
+    start = time.monotonic()
+    layouts = write_month(root, datetime.datetime(2023, 1, 1), options.days, options.rows_per_hour, users, weights)
+    print('[INFO] Wrote {} days of {} rows per hour in {:.1f} s'.format(options.days, options.rows_per_hour,
+      time.monotonic() - start), file=sys.stderr)
+
+    print('{:>8} {:>11} {:>6} {:>9} {:>12} {:>9}'.format('layout', 'partitions', 'files', 'requests', 'scanned(MB)', 'scan(s)'))
+    results = {}
+    for layout in ('hourly', 'daily', 'view'):
+      elapsed = []
+      for _ in range(options.iterations):
+        start = time.monotonic()
+        totals, num_files, num_bytes = scan_month(layouts[layout])
+        elapsed.append(time.monotonic() - start)
+      results[layout] = (totals, statistics.median(elapsed))
+      #XXX: A LIST request per partition, and GET requests of the footer and the column chunks of each file
+      num_requests = len(layouts[layout]) + num_files * 2
+      print('{:>8} {:>11} {:>6} {:>9} {:>12.1f} {:>9.3f}'.format(layout, len(layouts[layout]), num_files, num_requests,
+        num_bytes / 1024**2, results[layout][1]))
+
+  #XXX: Every layout bills every tenant the same.
+  assert results['hourly'][0] == results['daily'][0] == results['view'][0]
+  print('\n[INFO] The month scan of the view is {:.1f}x as fast as the hourly table.'.format(
+    results['hourly'][1] / results['view'][1]), file=sys.stderr)
+
+
+def run_athena(options):
+  import boto3
+  import athena_ctas
+
+  athena_client = boto3.client('athena', region_name=options.region_name)
+  month_dt = datetime.datetime.strptime(options.month, '%Y-%m')
+  print('{:>40} {:>12} {:>12} {:>12} {:>14}'.format('table', 'planning(ms)', 'engine(ms)', 'total(ms)', 'scanned(MB)'))
+  for table in [options.table, options.view]:
+    elapsed = collections.defaultdict(list)
+    for _ in range(options.iterations):
+      query = INVOICE_QUERY_FMT.format(database=options.database, table=table, year=month_dt.year, month=month_dt.month)
+      response = athena_client.start_query_execution(QueryString=query,
+        ResultConfiguration={'OutputLocation': options.output_location},
+        WorkGroup=options.work_group)
+      query_execution = asyncio.run(athena_ctas.wait_for_query(athena_client, response['QueryExecutionId']))
+      for key in ('QueryPlanningTimeInMillis', 'EngineExecutionTimeInMillis', 'TotalExecutionTimeInMillis', 'DataScannedInBytes'):
+        elapsed[key].append(query_execution['Statistics'].get(key, 0))
+    print('{:>40} {:>12} {:>12} {:>12} {:>14.1f}'.format(table, *[statistics.median(elapsed[e]) for e in
+      ('QueryPlanningTimeInMillis', 'EngineExecutionTimeInMillis', 'TotalExecutionTimeInMillis')],
+      statistics.median(elapsed['DataScannedInBytes']) / 1024**2))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the monthly invoice query on hourly and daily rolled up Parquet files')
+  parser.add_argument('--days', default=30, type=int,
+    help='The number of days of the month (default: 30)')
+  parser.add_argument('--rows-per-hour', default=2000, type=int,
+    help='The number of rows of an hour (default: 2000)')
+  parser.add_argument('--users', default=200, type=int,
+    help='The number of tenants, whose requests follow Zipf\'s law (default: 200)')
+  parser.add_argument('--iterations', default=3, type=int,
+    help='The number of month scans of each layout (default: 3)')
+  parser.add_argument('--athena', action='store_true',
+    help='run the invoice query on Amazon Athena instead of the local files')
+  parser.add_argument('--region-name', default='us-east-1', help='aws region name')
+  parser.add_argument('--work-group', default='primary', help='aws athena work group')
+  parser.add_argument('--database', default='mydatabase', help='aws athena database name')
+  parser.add_argument('--table', default='restapi_access_log_parquet', help='the hourly table, queried before the roll-up deletes its files')
+  parser.add_argument('--view', default='restapi_access_log_parquet_all', help='the view of the daily and the hourly tables')
+  parser.add_argument('--month', help='the month to query, ex) 2023-01')
+  parser.add_argument('--output-location', help='s3 path for query results')
+  options = parser.parse_args()
+
+  if options.athena:
+    if not (options.month and options.output_location):
+      parser.error('--month and --output-location are required with --athena')
+    run_athena(options)
+  else:
+    run_local(options)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,1154 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import asyncio
+import bisect
+import collections
+import datetime
+import io
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import botocore.exceptions
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python'))
+
+import compaction_ledger
+import late_data
+
+#XXX: Seconds a query of each kind spends in QUEUED and RUNNING states
+QUERY_LATENCIES = [
+  (re.compile(r'^DROP TABLE'), (0.1, 0.3)),
+  (re.compile(r'^ALTER TABLE'), (0.1, 0.5)),
+  (re.compile(r'^CREATE TABLE'), (0.2, 1.0))
+]
+
+
+def gen_parquet_body(num_rows):
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  buf = io.BytesIO()
+  pq.write_table(pa.table({'requestId': ['request-{:08d}'.format(i) for i in range(num_rows)],
+    'responseLength': list(range(num_rows))}), buf, compression='snappy')
+  return buf.getvalue()
+
+
+class LocalAthenaClient:
+  """A stand-in for the Amazon Athena client, which runs queries on a simulated clock without AWS.
+
+  A query fails if it matches one of `failures`, a list of (regular expression, StateChangeReason).
+  If `max_active_queries` is set, StartQueryExecution fails with TooManyRequestsException
+  while that many queries are active, like the active query quota of a workgroup.
+  If `s3` is a LocalS3Client, a CTAS query writes `ctas_rows` rows of `ctas_bytes` bytes to its external location,
+  in a file per bucket if it is bucketed, or in `ctas_files` files.
+  A CTAS query scans `ctas_scanned_bytes`, and runs `factor` times as long if it matches one of `slow_queries`,
+  a list of (regular expression, factor). If `ctas_parquet` is set, the files are Parquet files of `ctas_rows` rows
+  instead of objects without bodies, e.g. to read their footers.
+  """
+
+  #XXX: QueryExecutionIds are unique across clients, so that the files of the CTAS queries of different runs do not collide.
+  _ids = itertools.count(1)
+
+  def __init__(self, failures=None, time_scale=1.0, max_active_queries=None, s3=None, ctas_files=2, ctas_rows=1000,
+      ctas_bytes=64 * 1024**2, ctas_scanned_bytes=60 * 1024**2, slow_queries=None, ctas_parquet=False):
+    self.failures = [(re.compile(pattern), reason) for pattern, reason in (failures or [])]
+    self.slow_queries = [(re.compile(pattern), factor) for pattern, factor in (slow_queries or [])]
+    self.ctas_scanned_bytes = ctas_scanned_bytes
+    self.time_scale = time_scale
+    self.s3 = s3
+    self.ctas_files = ctas_files
+    self.ctas_rows = ctas_rows
+    self.ctas_bytes = ctas_bytes
+    self.ctas_parquet = ctas_parquet
+    self.max_active_queries = max_active_queries
+    self.max_active = 0
+    self.throttled = 0
+    self.executions = {}
+    self.api_calls = []
+    self._lock = threading.Lock()
+
+  def start_query_execution(self, QueryString, ResultConfiguration, WorkGroup, QueryExecutionContext=None):
+    now = time.monotonic()
+    queued_s, running_s = next((e for pattern, e in QUERY_LATENCIES if pattern.search(QueryString)), (0.1, 0.5))
+    running_s *= next((e for pattern, e in self.slow_queries if pattern.search(QueryString)), 1)
+    reason = next((e for pattern, e in self.failures if pattern.search(QueryString)), None)
+    with self._lock:
+      active = sum(1 for e in self.executions.values() if now < e['finished_at'] and not e['cancelled'])
+      if self.max_active_queries is not None and active >= self.max_active_queries:
+        self.throttled += 1
+        raise botocore.exceptions.ClientError({'Error': {'Code': 'TooManyRequestsException',
+          'Message': 'You have exceeded the limit for the number of queries you can run concurrently'}}, 'StartQueryExecution')
+      self.max_active = max(self.max_active, active + 1)
+      query_execution_id = 'query-{:04d}'.format(next(LocalAthenaClient._ids))
+      self.api_calls.append(('StartQueryExecution', query_execution_id, now))
+      self.executions[query_execution_id] = {
+        'query': QueryString,
+        'started_at': now,
+        'running_at': now + queued_s * self.time_scale,
+        'finished_at': now + (queued_s + running_s) * self.time_scale,
+        'failure_reason': reason,
+        'cancelled': False,
+        'scanned_bytes': self.ctas_scanned_bytes if QueryString.startswith('CREATE TABLE') else 0
+      }
+
+    external_location = re.search(r"external_location='s3://([^/]+)/([^']*)'", QueryString)
+    if self.s3 is not None and external_location and reason is None:
+      bucket, prefix = external_location.groups()
+      bucket_count = re.search(r'bucket_count = (\d+)', QueryString)
+      num_files = int(bucket_count.group(1)) if bucket_count else self.ctas_files
+      for i in range(num_files):
+        key = '{}{}_{:05d}'.format(prefix, query_execution_id, i)
+        if self.ctas_parquet:
+          self.s3.put_object(Bucket=bucket, Key=key, Body=gen_parquet_body(self.ctas_rows // num_files
+            + int(i < self.ctas_rows % num_files)))
+        else:
+          self.s3.put_sized_object(Bucket=bucket, Key=key, Size=self.ctas_bytes // num_files)
+    return {'QueryExecutionId': query_execution_id}
+
+  def get_query_execution(self, QueryExecutionId):
+    now = time.monotonic()
+    with self._lock:
+      self.api_calls.append(('GetQueryExecution', QueryExecutionId, now))
+      execution = self.executions[QueryExecutionId]
+
+    status = {}
+    if execution['cancelled']:
+      status['State'] = 'CANCELLED'
+    elif now < execution['running_at']:
+      status['State'] = 'QUEUED'
+    elif now < execution['finished_at']:
+      status['State'] = 'RUNNING'
+    elif execution['failure_reason']:
+      status.update(State='FAILED', StateChangeReason=execution['failure_reason'])
+    else:
+      status['State'] = 'SUCCEEDED'
+
+    return {
+      'QueryExecution': {
+        'QueryExecutionId': QueryExecutionId,
+        'Query': execution['query'],
+        'Status': status,
+        'Statistics': {
+          'TotalExecutionTimeInMillis': int((min(now, execution['finished_at']) - execution['started_at']) * 1000),
+          'QueryQueueTimeInMillis': int((min(now, execution['running_at']) - execution['started_at']) * 1000),
+          'EngineExecutionTimeInMillis': int(max(min(now, execution['finished_at']) - execution['running_at'], 0) * 1000),
+          'DataScannedInBytes': execution['scanned_bytes'] if now >= execution['finished_at'] else 0
+        }
+      }
+    }
+
+  def get_query_results(self, QueryExecutionId, MaxResults=None):
+    with self._lock:
+      self.api_calls.append(('GetQueryResults', QueryExecutionId, time.monotonic()))
+      execution = self.executions[QueryExecutionId]
+    response = {'ResultSet': {'Rows': []}}
+    if execution['query'].startswith('CREATE TABLE'):
+      response['UpdateCount'] = self.ctas_rows
+    return response
+
+  def stop_query_execution(self, QueryExecutionId):
+    with self._lock:
+      self.executions[QueryExecutionId]['cancelled'] = True
+    return {}
+
+  def queries(self):
+    return [e['query'].split()[0] + ' ' + e['query'].split()[1] for e in self.executions.values()]
+
+
+class LocalGlueClient:
+  """A stand-in for the AWS Glue client, which keeps partitions of tables in memory.
+
+  If `denied` is True, every call fails with AccessDeniedException, e.g. without Lake Formation permissions.
+  """
+
+  def __init__(self, denied=False):
+    self.denied = denied
+    self.partitions = {}
+    self.api_calls = []
+
+  def _call(self, operation_name):
+    self.api_calls.append(operation_name)
+    if self.denied:
+      raise botocore.exceptions.ClientError({'Error': {'Code': 'AccessDeniedException',
+        'Message': 'Insufficient Lake Formation permission(s)'}}, operation_name)
+
+  def get_table(self, DatabaseName, Name):
+    self._call('GetTable')
+    return {
+      'Table': {
+        'DatabaseName': DatabaseName,
+        'Name': Name,
+        'StorageDescriptor': {
+          'Columns': [{'Name': 'requestId', 'Type': 'string'}],
+          'Location': 's3://example-bucket/{}/'.format(Name),
+          'SerdeInfo': {'SerializationLibrary': 'org.openx.data.jsonserde.JsonSerDe'}
+        }
+      }
+    }
+
+  def batch_get_partition(self, DatabaseName, TableName, PartitionsToGet):
+    self._call('BatchGetPartition')
+    table = self.partitions.setdefault((DatabaseName, TableName), {})
+    return {'Partitions': [table[tuple(e['Values'])] for e in PartitionsToGet if tuple(e['Values']) in table]}
+
+  def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+    self._call('BatchCreatePartition')
+    table = self.partitions.setdefault((DatabaseName, TableName), {})
+    errors = []
+    for e in PartitionInputList:
+      values = tuple(e['Values'])
+      if values in table:
+        errors.append({'PartitionValues': e['Values'], 'ErrorDetail': {'ErrorCode': 'AlreadyExistsException'}})
+      else:
+        table[values] = dict(e, DatabaseName=DatabaseName, TableName=TableName)
+    return {'Errors': errors}
+
+  def get_partition(self, DatabaseName, TableName, PartitionValues):
+    self._call('GetPartition')
+    table = self.partitions.setdefault((DatabaseName, TableName), {})
+    if tuple(PartitionValues) not in table:
+      raise botocore.exceptions.ClientError({'Error': {'Code': 'EntityNotFoundException',
+        'Message': 'Cannot find partition.'}}, 'GetPartition')
+    return {'Partition': table[tuple(PartitionValues)]}
+
+  def create_partition(self, DatabaseName, TableName, PartitionInput):
+    self._call('CreatePartition')
+    table = self.partitions.setdefault((DatabaseName, TableName), {})
+    if tuple(PartitionInput['Values']) in table:
+      raise botocore.exceptions.ClientError({'Error': {'Code': 'AlreadyExistsException',
+        'Message': 'Partition already exists.'}}, 'CreatePartition')
+    table[tuple(PartitionInput['Values'])] = dict(PartitionInput, DatabaseName=DatabaseName, TableName=TableName)
+    return {}
+
+  def update_partition(self, DatabaseName, TableName, PartitionValueList, PartitionInput):
+    self._call('UpdatePartition')
+    table = self.partitions.setdefault((DatabaseName, TableName), {})
+    table[tuple(PartitionValueList)] = dict(PartitionInput, DatabaseName=DatabaseName, TableName=TableName)
+    return {}
+
+  def batch_delete_partition(self, DatabaseName, TableName, PartitionsToDelete):
+    self._call('BatchDeletePartition')
+    table = self.partitions.setdefault((DatabaseName, TableName), {})
+    for e in PartitionsToDelete:
+      table.pop(tuple(e['Values']), None)
+    return {'Errors': []}
+
+
+class LocalPaginator:
+  def __init__(self, fn, token_key, next_token_key):
+    self.fn = fn
+    self.token_key = token_key
+    self.next_token_key = next_token_key
+
+  def paginate(self, **kwargs):
+    token = None
+    while True:
+      page = self.fn(**(dict(kwargs, **{self.token_key: token}) if token else kwargs))
+      yield page
+      token = page.get(self.next_token_key)
+      if not token:
+        return
+
+
+class LocalS3Client:
+  """A stand-in for the Amazon S3 client, which keeps objects in memory.
+
+  A page of ListObjectsV2 takes `list_latency` seconds.
+  """
+
+  def __init__(self, max_keys=1000, list_latency=0.0):
+    self.max_keys = max_keys
+    self.list_latency = list_latency
+    self.objects = {}
+    self._sorted_keys = None
+    self.api_calls = []
+    self._lock = threading.Lock()
+
+  def put_object(self, Bucket, Key, Body=b'', **kwargs):
+    with self._lock:
+      self.api_calls.append('PutObject')
+      #XXX: LastModified of S3 objects has a resolution of a second.
+      self._sorted_keys = None
+      self.objects[(Bucket, Key)] = {'Body': Body, 'Size': len(Body),
+        'LastModified': datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)}
+    return {}
+
+  def put_sized_object(self, Bucket, Key, Size):
+    """Puts an object of `Size` bytes without its body, e.g. a large input of a benchmark."""
+    with self._lock:
+      self._sorted_keys = None
+      self.objects[(Bucket, Key)] = {'Body': None, 'Size': Size,
+        'LastModified': datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)}
+
+  def put_hour_objects(self, location_prefix, basic_dt, num_objects, size):
+    bucket, _, prefix = location_prefix[len('s3://'):].partition('/')
+    for i in range(num_objects):
+      self.put_sized_object(Bucket=bucket, Key='{}/year={}/month={:02}/day={:02}/hour={:02}/random-gen-1-{:05d}'.format(prefix,
+        basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour, i), Size=size)
+
+  def get_object(self, Bucket, Key, Range=None):
+    with self._lock:
+      self.api_calls.append('GetObject')
+      body = self.objects[(Bucket, Key)]['Body']
+    if Range is not None:
+      #XXX: Only the suffix ranges of the footers of Parquet files, e.g. bytes=-65536
+      body = body[-int(re.match(r'bytes=-(\d+)$', Range).group(1)):]
+    return {'Body': io.BytesIO(body)}
+
+  def put_object_tagging(self, Bucket, Key, Tagging):
+    with self._lock:
+      self.api_calls.append('PutObjectTagging')
+      self.objects[(Bucket, Key)]['Tags'] = {e['Key']: e['Value'] for e in Tagging['TagSet']}
+    return {}
+
+  def copy_object(self, Bucket, Key, CopySource):
+    with self._lock:
+      self.api_calls.append('CopyObject')
+      self._sorted_keys = None
+      self.objects[(Bucket, Key)] = dict(self.objects[(CopySource['Bucket'], CopySource['Key'])],
+        LastModified=datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0))
+    return {}
+
+  def delete_objects(self, Bucket, Delete):
+    with self._lock:
+      self.api_calls.append('DeleteObjects')
+      self._sorted_keys = None
+      for e in Delete['Objects']:
+        self.objects.pop((Bucket, e['Key']), None)
+    return {}
+
+  def list_keys(self, location):
+    bucket, _, prefix = location[len('s3://'):].partition('/')
+    return sorted(k for b, k in self.objects if b == bucket and k.startswith(prefix))
+
+  def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=None, MaxKeys=None, Delimiter=None):
+    max_keys = MaxKeys or self.max_keys
+    time.sleep(self.list_latency)
+    with self._lock:
+      self.api_calls.append('ListObjectsV2')
+      if self._sorted_keys is None:
+        self._sorted_keys = sorted(self.objects)
+      if Delimiter is not None:
+        #XXX: All the common prefixes in a page, e.g. the partitions of a table
+        keys = [k for b, k in self._sorted_keys if b == Bucket and k.startswith(Prefix)]
+        prefixes = sorted({Prefix + k[len(Prefix):].partition(Delimiter)[0] + Delimiter for k in keys
+          if Delimiter in k[len(Prefix):]})
+        return {'Contents': [{'Key': k, 'Size': self.objects[(Bucket, k)]['Size'],
+          'LastModified': self.objects[(Bucket, k)]['LastModified']} for k in keys if Delimiter not in k[len(Prefix):]],
+          'CommonPrefixes': [{'Prefix': e} for e in prefixes], 'IsTruncated': False}
+      keys = []
+      start_after = max(Prefix, ContinuationToken or StartAfter)
+      for b, k in self._sorted_keys[bisect.bisect_right(self._sorted_keys, (Bucket, start_after)):]:
+        if b != Bucket or not k.startswith(Prefix) or len(keys) > max_keys:
+          break
+        keys.append(k)
+      contents = [{'Key': k, 'Size': self.objects[(Bucket, k)]['Size'],
+        'LastModified': self.objects[(Bucket, k)]['LastModified']} for k in keys[:max_keys]]
+    response = {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': len(keys) > max_keys}
+    if response['IsTruncated']:
+      response['NextContinuationToken'] = contents[-1]['Key']
+    return response
+
+  def get_paginator(self, operation_name):
+    assert operation_name == 'list_objects_v2', operation_name
+    return LocalPaginator(self.list_objects_v2, 'ContinuationToken', 'NextContinuationToken')
+
+
+class LocalSQSClient:
+  """A stand-in for the Amazon SQS client, which keeps the messages of a queue in memory."""
+
+  def __init__(self):
+    self.messages = {}
+    self.in_flight = set()
+    self.api_calls = []
+    self._ids = itertools.count(1)
+
+  def send_message(self, QueueUrl, MessageBody):
+    message_id = 'message-{:04d}'.format(next(self._ids))
+    self.messages[message_id] = MessageBody
+    return {'MessageId': message_id}
+
+  def send_s3_event(self, location, size, event_time=None):
+    """Sends an S3 event notification of an object created at `location`, with its key URL-encoded like Amazon S3."""
+    bucket, _, key = location[len('s3://'):].partition('/')
+    event_time = event_time or datetime.datetime.now(datetime.timezone.utc)
+    self.send_message('local-queue', json.dumps({'Records': [{
+      'eventVersion': '2.1',
+      'eventSource': 'aws:s3',
+      'eventTime': event_time.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+      'eventName': 'ObjectCreated:Put',
+      's3': {'bucket': {'name': bucket}, 'object': {'key': urllib.parse.quote_plus(key, safe='/'), 'size': size}}
+    }]}))
+
+  def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0):
+    self.api_calls.append('ReceiveMessage')
+    #XXX: Received messages are invisible until they are deleted, as if the visibility timeout were longer than a run.
+    message_ids = [e for e in self.messages if e not in self.in_flight][:MaxNumberOfMessages]
+    self.in_flight.update(message_ids)
+    return {'Messages': [{'MessageId': e, 'ReceiptHandle': e, 'Body': self.messages[e]} for e in message_ids]}
+
+  def delete_message_batch(self, QueueUrl, Entries):
+    self.api_calls.append('DeleteMessageBatch')
+    for e in Entries:
+      self.messages.pop(e['ReceiptHandle'], None)
+      self.in_flight.discard(e['ReceiptHandle'])
+    return {'Successful': [{'Id': e['Id']} for e in Entries], 'Failed': []}
+
+
+class LocalDynamoDBClient:
+  """A stand-in for the Amazon DynamoDB client, which supports the key conditions of the compaction ledger."""
+
+  def __init__(self):
+    self.items = {}
+    self.api_calls = []
+
+  def put_item(self, TableName, Item):
+    self.api_calls.append('PutItem')
+    self.items[(TableName, Item['ledger_id']['S'], Item['hour']['S'])] = Item
+    return {}
+
+  def query(self, TableName, ExpressionAttributeValues, ExclusiveStartKey=None, **kwargs):
+    self.api_calls.append('Query')
+    ledger_id, start_hour, end_hour = [ExpressionAttributeValues[k]['S'] for k in (':ledger_id', ':start_hour', ':end_hour')]
+    return {'Items': [item for (table_name, pk, sk), item in sorted(self.items.items())
+      if table_name == TableName and pk == ledger_id and start_hour <= sk <= end_hour]}
+
+  def get_paginator(self, operation_name):
+    assert operation_name == 'query', operation_name
+    return LocalPaginator(self.query, 'ExclusiveStartKey', 'LastEvaluatedKey')
+
+
+def run_scenario(athena_ctas, athena_client, glue_client, partition_registrar='glue', event_time='2023-01-31T13:10:00Z'):
+  """Runs the compaction job against the stand-ins. Returns the elapsed seconds and the error if any.
+
+  `partition_registrar` is either one of `PARTITION_REGISTRAR` or `projection` for the tables with partition projection.
+  """
+  athena_ctas.ATHENA_CLIENT = athena_client
+  athena_ctas.GLUE_CLIENT = glue_client
+  athena_ctas.PARTITION_REGISTRAR = partition_registrar
+  athena_ctas.PARTITION_PROJECTION = (partition_registrar == 'projection')
+
+  event = {'time': event_time, 'detail-type': 'Scheduled Event', 'detail': {}}
+  error = None
+  sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+  start = time.monotonic()
+  try:
+    athena_ctas.lambda_handler(event, {})
+  except Exception as ex:
+    error = ex
+  finally:
+    sys.stderr = stderr
+  return time.monotonic() - start, error
+
+
+class CrashingLedger:
+  """Records to `ledger`, and cancels the backfill like a crash once `crash_after_hours` hours have succeeded."""
+
+  def __init__(self, ledger, crash_after_hours, loop, task):
+    self.ledger = ledger
+    self.crash_after_hours = crash_after_hours
+    self.loop = loop
+    self.task = task
+    self.succeeded = 0
+
+  def get_records(self, ledger_id, start_hour, end_hour):
+    return self.ledger.get_records(ledger_id, start_hour, end_hour)
+
+  def put_record(self, ledger_id, record):
+    self.ledger.put_record(ledger_id, record)
+    if record['status'] == 'SUCCEEDED':
+      self.succeeded += 1
+      if self.succeeded == self.crash_after_hours:
+        self.loop.call_soon_threadsafe(self.task.cancel)
+
+
+def run_backfill(athena_ctas, athena_client, start_dt, end_dt, concurrency, ledger, crash_after_hours=None):
+  """Runs a backfill against the stand-ins. If `crash_after_hours` is set, stops it like a crash
+  as soon as that many hours have succeeded, regardless of the time scale.
+
+  Returns the summary of the backfill, or None if it crashed.
+  """
+  async def backfill():
+    task = asyncio.current_task()
+    backfill_ledger = ledger if crash_after_hours is None else \
+      CrashingLedger(ledger, crash_after_hours, asyncio.get_running_loop(), task)
+    return await athena_ctas.backfill(athena_client, start_dt, end_dt, concurrency=concurrency, ledger=backfill_ledger)
+
+  athena_ctas.ATHENA_CLIENT = athena_client
+  sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+  try:
+    return asyncio.run(backfill())
+  except asyncio.CancelledError as _:
+    return None
+  finally:
+    sys.stderr = stderr
+
+
+def run_backfill_scenarios(athena_ctas, options):
+  athena_ctas.GLUE_CLIENT = LocalGlueClient()
+  athena_ctas.PARTITION_REGISTRAR = 'glue'
+  athena_ctas.PARTITION_PROJECTION = False
+  s3 = athena_ctas.S3_CLIENT = LocalS3Client()
+
+  start_dt = datetime.datetime(2023, 1, 31)
+  end_dt = start_dt + datetime.timedelta(hours=options.backfill_hours)
+  for i in range(options.backfill_hours):
+    s3.put_hour_objects(athena_ctas.OLD_TABLE_LOCATION_PREFIX, start_dt + datetime.timedelta(hours=i), 12, 5 * 1024**2)
+  ctas_failure = (r'hour=5\nWITH DATA', 'HIVE_PATH_ALREADY_EXISTS: Target directory for table already exists')
+
+  def num_ctas(athena_client):
+    return sum(1 for e in athena_client.queries() if e == 'CREATE TABLE')
+
+  print('\n{:>20} {:>8} {:>6} {:>9} {:>7} {:>7} {:>9} {:>7}'.format('backfill', 'time(s)', 'hours', 'succeeded',
+    'failed', 'skipped', 'throttled', 'active'))
+
+  def print_result(name, athena_client, summary):
+    print('{:>20} {:>8.2f} {:>6} {:>9} {:>7} {:>7} {:>9} {:>7}'.format(name, summary['elapsed_s'], summary['hours'],
+      summary['succeeded'], len(summary['failed']), summary['skipped'], summary['throttled_query_starts'],
+      athena_client.max_active))
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    #XXX: More workers than the active query quota, so that some query starts are throttled and retried.
+    ledger = compaction_ledger.FileLedger(os.path.join(tmp_dir, 'backfill.jsonl'))
+    athena_client = LocalAthenaClient(failures=[ctas_failure], time_scale=options.time_scale,
+      max_active_queries=options.max_active_queries, s3=s3)
+    summary = run_backfill(athena_ctas, athena_client, start_dt, end_dt, options.max_active_queries + 3, ledger)
+    print_result('throttled', athena_client, summary)
+    assert summary['failed'] == ['2023-01-31T05'], summary['failed']
+    assert summary['succeeded'] == options.backfill_hours - 1
+    assert athena_client.max_active <= options.max_active_queries
+    assert summary['throttled_query_starts'] == athena_client.throttled > 0
+    assert num_ctas(athena_client) == options.backfill_hours
+
+    #XXX: Only the failed hour is compacted again.
+    athena_client = LocalAthenaClient(time_scale=options.time_scale, max_active_queries=options.max_active_queries, s3=s3)
+    summary = run_backfill(athena_ctas, athena_client, start_dt, end_dt, options.max_active_queries, ledger)
+    print_result('failed hours retried', athena_client, summary)
+    assert (summary['succeeded'], summary['skipped'], summary['failed']) == (1, options.backfill_hours - 1, [])
+    assert num_ctas(athena_client) == 1
+
+    #XXX: The CTAS queries running at the crash are taken over by the resumed backfill instead of running again.
+    #XXX: Another output prefix, so that the outputs of the backfills above are not taken as existing ones.
+    athena_ctas.OUTPUT_PREFIX = 's3://example-bucket/parquet-data-crashed'
+    ledger = compaction_ledger.FileLedger(os.path.join(tmp_dir, 'crashed.jsonl'))
+    athena_client = LocalAthenaClient(time_scale=options.time_scale, max_active_queries=options.max_active_queries, s3=s3)
+    assert run_backfill(athena_ctas, athena_client, start_dt, end_dt, options.max_active_queries, ledger,
+      crash_after_hours=max(1, options.backfill_hours // 4)) is None
+    num_ctas_before_crash = num_ctas(athena_client)
+    summary = run_backfill(athena_ctas, athena_client, start_dt, end_dt, options.max_active_queries, ledger)
+    print_result('crashed and resumed', athena_client, summary)
+    assert 0 < summary['skipped'] < options.backfill_hours and not summary['failed']
+    assert num_ctas(athena_client) == options.backfill_hours, (num_ctas_before_crash, num_ctas(athena_client))
+    records = ledger.get_records(athena_ctas.get_ledger_id(), *[e.strftime(athena_ctas.BACKFILL_HOUR_FMT) for e in (start_dt, end_dt)])
+    assert len(records) == options.backfill_hours and all(e['status'] == 'SUCCEEDED' for e in records.values())
+    assert all(e['rows'] == athena_client.ctas_rows for e in records.values())
+
+    #XXX: A CTAS query running 4 times as long as those of the hours of the same input bytes is flagged.
+    # The last hour is slowed down, so that the hours merged before it are its baseline.
+    regressed_dt = end_dt - datetime.timedelta(hours=1)
+    regressed_hour = regressed_dt.strftime(athena_ctas.BACKFILL_HOUR_FMT)
+    athena_ctas.OUTPUT_PREFIX = 's3://example-bucket/parquet-data-regressed'
+    ledger = compaction_ledger.FileLedger(os.path.join(tmp_dir, 'regressed.jsonl'))
+    athena_client = LocalAthenaClient(time_scale=options.time_scale, max_active_queries=options.max_active_queries, s3=s3,
+      slow_queries=[(r'hour={}\nWITH DATA'.format(regressed_dt.hour), 4)])
+    metrics = io.StringIO()
+    stdout, sys.stdout = sys.stdout, metrics
+    athena_ctas.EMIT_METRICS = True
+    try:
+      summary = run_backfill(athena_ctas, athena_client, start_dt, end_dt, options.max_active_queries, ledger)
+    finally:
+      sys.stdout = stdout
+      athena_ctas.EMIT_METRICS = False
+    print_result('regression flagged', athena_client, summary)
+    assert summary['regressions'] == [regressed_hour], summary['regressions']
+    records = ledger.get_records(athena_ctas.get_ledger_id(), *[e.strftime(athena_ctas.BACKFILL_HOUR_FMT) for e in (start_dt, end_dt)])
+    assert [e['key'] for e in records[regressed_hour]['regressions']] == ['query_engine_ms'], records[regressed_hour]
+    assert all(e['queries'] == 2 and e['query_data_scanned_bytes'] == athena_client.ctas_scanned_bytes for e in records.values())
+
+    #XXX: A document of Embedded Metric Format per query, and one per hour
+    documents = [json.loads(e) for e in metrics.getvalue().splitlines()]
+    statements = collections.Counter(e.get('Statement') for e in documents)
+    assert statements == {'ctas': options.backfill_hours, 'drop_tmp_table': options.backfill_hours, None: options.backfill_hours}, statements
+    hour = next(e for e in documents if e['Hour'] == regressed_hour and 'Statement' not in e)
+    assert hour['CompactionRegressions'] == 1 and hour['CompactionCost'] > 0, hour
+
+
+def run_catch_up_scenarios(athena_ctas, options):
+  """Runs the scheduled lambda function with the compaction ledger on S3 and DynamoDB stand-ins."""
+  catch_up_hours = 6
+  athena_ctas.CATCH_UP_HOURS = catch_up_hours
+  ctas_failure = (r'hour=13\nWITH DATA', 'Query exhausted resources at this scale factor')
+
+  print('\n{:>20} {:>20} {:>8} {:>8} {:>5} {:>7}  {}'.format('ledger', 'catch-up', 'time(s)', 'queries', 'ctas',
+    'calls', 'result'))
+  for ledger_name in ('s3', 'dynamodb'):
+    s3 = athena_ctas.S3_CLIENT = LocalS3Client(max_keys=4)
+    athena_ctas.OUTPUT_PREFIX = 's3://example-bucket/parquet-data'
+    if ledger_name == 's3':
+      athena_ctas.COMPACTION_LEDGER = 's3://example-bucket/compaction-ledger'
+      ledger_client = s3
+      athena_ctas.LEDGER = compaction_ledger.S3Ledger(s3, 'example-bucket', 'compaction-ledger')
+    else:
+      athena_ctas.COMPACTION_LEDGER = 'dynamodb://CompactionLedger'
+      ledger_client = LocalDynamoDBClient()
+      athena_ctas.LEDGER = compaction_ledger.DynamoDBLedger(ledger_client, 'CompactionLedger')
+
+    for hour in range(7, 16):
+      s3.put_hour_objects(athena_ctas.OLD_TABLE_LOCATION_PREFIX, datetime.datetime(2023, 1, 31, hour), 12, 5 * 1024**2)
+
+    #XXX: Two hours were compacted before the ledger was enabled.
+    for hour in (8, 9):
+      s3.put_object(Bucket='example-bucket', Key=f'parquet-data/year=2023/month=01/day=31/hour={hour:02}/legacy_00000', Body=b'\0' * 100)
+
+    #XXX: (catch-up, event time, athena failures, expected CTAS queries, expected error)
+    runs = [
+      ('first run', '2023-01-31T13:10:00Z', [], 4, None),
+      ('failed run', '2023-01-31T14:10:00Z', [ctas_failure], 1, athena_ctas.CompactionError),
+      ('catch-up run', '2023-01-31T16:10:00Z', [], 3, None),
+      ('idempotent re-run', '2023-01-31T16:10:00Z', [], 0, None)
+    ]
+    for name, event_time, failures, expected_ctas, expected_error in runs:
+      athena_client = LocalAthenaClient(failures=failures, time_scale=options.time_scale, s3=s3)
+      num_ledger_calls = len(ledger_client.api_calls)
+      elapsed, error = run_scenario(athena_ctas, athena_client, LocalGlueClient(), 'glue', event_time)
+      ledger_calls = ledger_client.api_calls[num_ledger_calls:]
+      num_ctas = sum(1 for e in athena_client.queries() if e == 'CREATE TABLE')
+      print('{:>20} {:>20} {:>8.2f} {:>8} {:>5} {:>7}  {}'.format(ledger_name, name, elapsed, len(athena_client.executions),
+        num_ctas, len(ledger_calls), error or 'OK'))
+
+      assert num_ctas == expected_ctas, (name, athena_client.queries())
+      assert (error is None) if expected_error is None else isinstance(error, expected_error), error
+      if name == 'idempotent re-run':
+        #XXX: Nothing but the ledger is read.
+        assert not athena_client.executions and set(ledger_calls) in ({'ListObjectsV2'}, {'Query'}), ledger_calls
+
+    records = athena_ctas.LEDGER.get_records(athena_ctas.get_ledger_id(), '2023-01-31T00', '2023-01-31T16')
+    assert [records[f'2023-01-31T{hour:02}']['status'] for hour in range(7, 16)] == \
+      ['SUCCEEDED', 'EXISTING', 'EXISTING'] + ['SUCCEEDED'] * 6, records
+
+  athena_ctas.COMPACTION_LEDGER = ''
+  athena_ctas.LEDGER = None
+
+
+def run_late_data_scenarios(athena_ctas, options):
+  """Runs the scheduled lambda function with late objects notified through an SQS queue stand-in."""
+  athena_ctas.CATCH_UP_HOURS = 6
+  athena_ctas.OUTPUT_PREFIX = 's3://example-bucket/parquet-data'
+  athena_ctas.COMPACTION_LEDGER = 'dynamodb://CompactionLedger'
+  athena_ctas.LEDGER = compaction_ledger.DynamoDBLedger(LocalDynamoDBClient(), 'CompactionLedger')
+  athena_ctas.LATE_DATA_QUEUE_URL = 'local-queue'
+  sqs = athena_ctas.SQS_CLIENT = LocalSQSClient()
+  s3 = athena_ctas.S3_CLIENT = LocalS3Client()
+  for hour in range(7, 15):
+    s3.put_hour_objects(athena_ctas.OLD_TABLE_LOCATION_PREFIX, datetime.datetime(2023, 1, 31, hour), 12, 5 * 1024**2)
+
+  def get_hour_location(location_prefix, hour):
+    return athena_ctas.get_hour_location(location_prefix, datetime.datetime(2023, 1, 31, hour))
+
+  late_object_ids = itertools.count()
+
+  def put_late_objects(hour, num_objects):
+    location = get_hour_location(athena_ctas.OLD_TABLE_LOCATION_PREFIX, hour)
+    for i in itertools.islice(late_object_ids, num_objects):
+      s3.put_object(Bucket='example-bucket', Key='{}late-{:05d}'.format(location[len('s3://example-bucket/'):], i),
+        Body=b'{}\n' * 1024)
+      sqs.send_s3_event('{}late-{:05d}'.format(location, i), 3 * 1024)
+
+  def ctas_hours(athena_client):
+    return sorted(int(re.search(r'hour=(\d+)\nWITH DATA', e['query']).group(1)) for e in athena_client.executions.values()
+      if e['query'].startswith('CREATE TABLE'))
+
+  #XXX: (run, event time, late data settle minutes, late objects by hour sent before the run, expected hours of CTAS queries)
+  runs = [
+    ('first run', '2023-01-31T13:10:00Z', 15, {}, [7, 8, 9, 10, 11, 12]),
+    #XXX: A burst of late objects of hours 11 and 12 waits to settle. Hour 13 is compacted as usual with its late objects.
+    ('burst settling', '2023-01-31T14:10:00Z', 15, {11: 20, 12: 5, 13: 3}, [13]),
+    ('more late objects', '2023-01-31T14:10:00Z', 15, {11: 10}, []),
+    ('burst settled', '2023-01-31T15:10:00Z', 0, {}, [11, 12, 14]),
+    ('idempotent re-run', '2023-01-31T15:10:00Z', 0, {}, [])
+  ]
+  print('\n{:>20} {:>8} {:>8} {:>12} {:>6}  {}'.format('late data', 'time(s)', 'events', 'ctas hours', 'dirty', 'result'))
+  old_files = {}
+  for name, event_time, settle_minutes, late_objects, expected_ctas_hours in runs:
+    for hour, num_objects in late_objects.items():
+      put_late_objects(hour, num_objects)
+    num_events = len(sqs.messages)
+    if name == 'burst settled':
+      old_files = {e: s3.list_keys(get_hour_location(athena_ctas.OUTPUT_PREFIX, e)) for e in (11, 12)}
+    athena_ctas.LATE_DATA_SETTLE_MINUTES = settle_minutes
+    athena_client = LocalAthenaClient(time_scale=options.time_scale, s3=s3)
+    elapsed, error = run_scenario(athena_ctas, athena_client, LocalGlueClient(), 'glue', event_time)
+    records = athena_ctas.LEDGER.get_records(athena_ctas.get_ledger_id(), '2023-01-31T00', '2023-01-31T16')
+    dirty_hours = sorted(k for k, v in records.items() if v['status'] == compaction_ledger.DIRTY_STATUS)
+    print('{:>20} {:>8.2f} {:>8} {:>12} {:>6}  {}'.format(name, elapsed, num_events, ','.join(map(str, ctas_hours(athena_client))),
+      len(dirty_hours), error or 'OK'))
+
+    assert error is None, error
+    assert ctas_hours(athena_client) == expected_ctas_hours, (name, ctas_hours(athena_client))
+    assert not sqs.messages, sqs.messages
+    if name in ('burst settling', 'more late objects'):
+      #XXX: The late objects of hour 13 were created before it was compacted.
+      assert dirty_hours == ['2023-01-31T11', '2023-01-31T12'], records
+    if name == 'more late objects':
+      assert records['2023-01-31T11']['late_objects'] == 30, records['2023-01-31T11']
+
+  #XXX: The merged files of the dirty hours are replaced with those of the CTAS query run again.
+  assert not dirty_hours, records
+  for hour in (11, 12):
+    record = records['2023-01-31T{}'.format(hour)]
+    new_files = s3.list_keys(get_hour_location(athena_ctas.OUTPUT_PREFIX, hour))
+    assert record['status'] == 'SUCCEEDED' and record['recompactions'] == 1, record
+    assert new_files and not set(new_files) & set(old_files[hour]), (old_files[hour], new_files)
+    assert record['output_files'] == len(new_files) and record['input_files'] == 12 + (30 if hour == 11 else 5), record
+    assert not s3.list_keys(athena_ctas.get_recompaction_location(datetime.datetime(2023, 1, 31, hour)))
+
+  athena_ctas.COMPACTION_LEDGER = ''
+  athena_ctas.LEDGER = None
+  athena_ctas.LATE_DATA_QUEUE_URL = ''
+
+
+def run_daily_rollup_scenarios(athena_ctas, options):
+  """Rolls up closed days of hourly merged files into the daily table, and collects the garbage of the hourly table."""
+  import daily_rollup
+
+  athena_ctas.OUTPUT_PREFIX = 's3://example-bucket/parquet-data'
+  athena_ctas.PARTITION_PROJECTION = False
+  athena_ctas.KNOWN_PARTITIONS.clear()
+  daily_rollup.DAILY_OUTPUT_PREFIX = 's3://example-bucket/parquet-daily'
+  glue = athena_ctas.GLUE_CLIENT = LocalGlueClient()
+  s3 = athena_ctas.S3_CLIENT = LocalS3Client()
+  days = [datetime.datetime(2023, 1, 30), datetime.datetime(2023, 1, 31)]
+  hourly_partitions = glue.partitions.setdefault(('mydatabase', 'restapi_access_log_parquet'), {})
+  daily_partitions = glue.partitions.setdefault(('mydatabase', 'restapi_access_log_parquet_daily'), {})
+  late_file_ids = itertools.count()
+
+  def put_hourly_files(basic_dt, num_files):
+    location = athena_ctas.get_hour_location(athena_ctas.OUTPUT_PREFIX, basic_dt)
+    for _ in range(num_files):
+      s3.put_sized_object(Bucket='example-bucket', Key='{}hourly-{:05d}'.format(location[len('s3://example-bucket/'):],
+        next(late_file_ids)), Size=2 * 1024**2)
+    hourly_partitions[tuple(str(e) for e in (basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour))] = {'Values': []}
+
+  for day_dt in days:
+    for hour in range(24):
+      put_hourly_files(day_dt.replace(hour=hour), 2)
+
+  def rollup_queries(athena_client):
+    return [e['query'] for e in athena_client.executions.values() if e['query'].startswith('CREATE TABLE')]
+
+  def num_hourly_files(day_dt):
+    return len(s3.list_keys(daily_rollup.get_day_location(athena_ctas.OUTPUT_PREFIX, day_dt)))
+
+  #XXX: (run, hours after now, hourly files written before the run by (day, hour), ledger, expected summary)
+  runs = [
+    ('first roll-up', 0, {}, None, {'rolled_up': 2, 'collected': 0, 'deferred': 0}),
+    ('within grace', 0, {}, None, {'rolled_up': 0, 'collected': 0, 'deferred': 0}),
+    ('late hour', 0, {(1, 5): 1}, None, {'rolled_up': 1, 'collected': 0, 'deferred': 0}),
+    ('garbage collected', 2, {}, None, {'rolled_up': 0, 'collected': 2, 'deferred': 0}),
+    ('late hour after gc', 2, {(1, 7): 2}, None, {'rolled_up': 1, 'collected': 0, 'deferred': 0}),
+    ('ledger not done', 4, {(1, 9): 1}, 'empty', {'rolled_up': 0, 'collected': 1, 'deferred': 1})
+  ]
+  print('\n{:>20} {:>8} {:>9} {:>9} {:>8} {:>13}  {}'.format('daily roll-up', 'time(s)', 'rolled up', 'collected',
+    'deferred', 'hourly files', 'result'))
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for name, hours_after, hourly_files, ledger_name, expected in runs:
+      for (day_idx, hour), num_files in hourly_files.items():
+        put_hourly_files(days[day_idx].replace(hour=hour), num_files)
+      #XXX: The versions of a day are named by the second of their roll-ups, and files written in the second before
+      # a roll-up are rolled up again.
+      time.sleep(1.1)
+      ledger = compaction_ledger.FileLedger(os.path.join(tmp_dir, 'ledger.jsonl')) if ledger_name else None
+      athena_client = LocalAthenaClient(time_scale=options.time_scale, s3=s3)
+      now = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=hours_after)
+      sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+      start = time.monotonic()
+      try:
+        summary = asyncio.run(daily_rollup.rollup_days(athena_client, glue, days, ledger=ledger, now=now))
+      finally:
+        sys.stderr = stderr
+      print('{:>20} {:>8.2f} {:>9} {:>9} {:>8} {:>13}  {}'.format(name, time.monotonic() - start, len(summary['rolled_up']),
+        len(summary['collected']), len(summary['deferred']), ','.join(str(num_hourly_files(e)) for e in days),
+        summary['failed'] or 'OK'))
+
+      assert not summary['failed'], summary
+      assert {k: len(summary[k]) for k in expected} == expected, (name, summary)
+      queries = rollup_queries(athena_client)
+      assert len(queries) == len(summary['rolled_up']), queries
+      if name == 'late hour':
+        #XXX: Every hour still has its hourly files, so the day is rolled up again from them only.
+        assert 'UNION ALL' not in queries[0], queries[0]
+        previous_location = daily_partitions[('2023', '1', '31')]['Parameters'][daily_rollup.PREVIOUS_LOCATION_PARAMETER]
+        assert previous_location and s3.list_keys(previous_location)
+      if name == 'garbage collected':
+        assert [num_hourly_files(e) for e in days] == [0, 0]
+        assert not s3.list_keys(previous_location)
+        assert not hourly_partitions, sorted(hourly_partitions)
+        assert all(not e['Parameters'][daily_rollup.PREVIOUS_LOCATION_PARAMETER] for e in daily_partitions.values())
+      if name == 'late hour after gc':
+        #XXX: The rows of the other hours are kept from the current version of the day.
+        assert 'UNION ALL' in queries[0] and 'hour NOT IN (7)' in queries[0] and 'hour IN (7)' in queries[0], queries[0]
+        assert sorted(hourly_partitions) == [('2023', '1', '31', '7')]
+      if name == 'ledger not done':
+        assert summary['deferred'] == ['2023-01-31'] and num_hourly_files(days[1]) == 1
+
+  for values, partition in sorted(daily_partitions.items()):
+    location = partition['StorageDescriptor']['Location']
+    assert location.startswith('s3://example-bucket/parquet-daily/year=2023/month=01/day={:02}/rollup='.format(int(values[2])))
+    assert s3.list_keys(location), location
+
+
+def run_verification_scenarios(athena_ctas, options):
+  """Verifies the compacted hours against their objects, and compacts again the hours with mismatched rows."""
+  import compaction_verifier
+
+  #XXX: The footer parser reads the row count written by pyarrow, also when the footer is beyond the first ranged GET.
+  storage = athena_ctas.json_to_parquet.S3Storage(LocalS3Client())
+  for num_rows in (0, 1, 12345):
+    storage.s3_client.put_object(Bucket='example-bucket', Key='footer-test', Body=gen_parquet_body(num_rows))
+    assert compaction_verifier.read_num_rows(storage, 's3://example-bucket/footer-test') == num_rows
+    footer_read_bytes, compaction_verifier.FOOTER_READ_BYTES = (compaction_verifier.FOOTER_READ_BYTES, 16)
+    try:
+      assert compaction_verifier.read_num_rows(storage, 's3://example-bucket/footer-test') == num_rows
+    finally:
+      compaction_verifier.FOOTER_READ_BYTES = footer_read_bytes
+
+  athena_ctas.CATCH_UP_HOURS = 3
+  athena_ctas.OUTPUT_PREFIX = 's3://example-bucket/parquet-data'
+  athena_ctas.COMPACTION_LEDGER = 'dynamodb://CompactionLedger'
+  athena_ctas.LEDGER = compaction_ledger.DynamoDBLedger(LocalDynamoDBClient(), 'CompactionLedger')
+  athena_ctas.VERIFY_COMPACTION = True
+  athena_ctas.VERIFY_MAX_RECOMPACTIONS = 1
+  athena_ctas.LATE_DATA_SETTLE_MINUTES = 0
+  s3 = athena_ctas.S3_CLIENT = LocalS3Client()
+
+  def put_hour_records(hour, num_objects, rows_per_object):
+    location = athena_ctas.get_hour_location(athena_ctas.OLD_TABLE_LOCATION_PREFIX, datetime.datetime(2023, 1, 31, hour))
+    for i in range(num_objects):
+      s3.put_object(Bucket='example-bucket', Key='{}random-gen-1-{:05d}'.format(location[len('s3://example-bucket/'):], i),
+        Body=b''.join(json.dumps({'requestId': 'request-{:05d}-{:05d}'.format(i, j)}).encode('utf-8') + b'\n'
+          for j in range(rows_per_object)))
+
+  def tagged_objects(hour):
+    location = athena_ctas.get_hour_location(athena_ctas.OLD_TABLE_LOCATION_PREFIX, datetime.datetime(2023, 1, 31, hour))
+    return sum(1 for e in s3.list_keys(location) if s3.objects[('example-bucket', e)].get('Tags') == athena_ctas.VERIFIED_TAGS)
+
+  for hour in range(10, 16):
+    put_hour_records(hour, 3, 100)
+  #XXX: An object created in the second a compaction started counts as late, and the start of a compaction
+  # is its end truncated to the second less its duration.
+  time.sleep(2.1)
+
+  #XXX: (run, event time, rows written by each CTAS query, expected statuses by hour)
+  runs = [
+    ('verified', '2023-01-31T13:10:00Z', 300, {10: 'VERIFIED', 11: 'VERIFIED', 12: 'VERIFIED'}),
+    ('lost rows', '2023-01-31T14:10:00Z', 290, {13: 'DIRTY'}),
+    ('compacted again', '2023-01-31T15:10:00Z', 300, {13: 'VERIFIED', 14: 'VERIFIED'}),
+    ('still lost', '2023-01-31T16:10:00Z', 290, {15: 'DIRTY'}),
+    ('mismatched', '2023-01-31T16:10:00Z', 290, {15: 'MISMATCHED'})
+  ]
+  print('\n{:>20} {:>8} {:>10} {:>11}  {}'.format('verification', 'time(s)', 'verified', 'mismatched', 'result'))
+  for name, event_time, ctas_rows, expected_statuses in runs:
+    athena_client = LocalAthenaClient(time_scale=options.time_scale, s3=s3, ctas_files=2, ctas_rows=ctas_rows, ctas_parquet=True)
+    elapsed, error = run_scenario(athena_ctas, athena_client, LocalGlueClient(), 'glue', event_time)
+    records = athena_ctas.LEDGER.get_records(athena_ctas.get_ledger_id(), '2023-01-31T00', '2023-01-31T16')
+    statuses = {int(k[-2:]): v['status'] for k, v in records.items()}
+    print('{:>20} {:>8.2f} {:>10} {:>11}  {}'.format(name, elapsed, sum(1 for e in statuses.values() if e == 'VERIFIED'),
+      sum(1 for e in statuses.values() if e == 'MISMATCHED'), error or 'OK'))
+
+    assert error is None, error
+    assert {k: statuses[k] for k in expected_statuses} == expected_statuses, (name, statuses)
+    for hour, status in expected_statuses.items():
+      #XXX: Only the objects of verified hours may be expired by the lifecycle rule of the raw data.
+      assert tagged_objects(hour) == (3 if status == 'VERIFIED' else 0), (name, hour)
+      if status == 'VERIFIED':
+        assert records['2023-01-31T{}'.format(hour)]['source_rows'] == 300
+  assert records['2023-01-31T13']['recompactions'] == 1 and records['2023-01-31T15']['verify_failures'] == 2, records
+
+  athena_ctas.COMPACTION_LEDGER = ''
+  athena_ctas.LEDGER = None
+  athena_ctas.VERIFY_COMPACTION = False
+
+
+def run_tenant_partitioning_scenarios(athena_ctas, options):
+  """Compacts an hour of the objects written under a partition per tenant by Firehose with dynamic partitioning."""
+  athena_ctas.TENANT_PARTITION_KEY = 'tenant'
+  basic_dt = datetime.datetime(2023, 1, 31, 12)
+  tenant_objects = {'alice': 3, 'bob': 2, "o'brien": 1, '1024': 1}
+
+  def put_tenant_objects(s3):
+    for tenant, num_objects in tenant_objects.items():
+      s3.put_hour_objects(athena_ctas.get_tenant_location(athena_ctas.OLD_TABLE_LOCATION_PREFIX, tenant), basic_dt,
+        num_objects, 40 * 1024)
+    #XXX: A tenant without objects in the hour has no partition of it.
+    s3.put_hour_objects(athena_ctas.get_tenant_location(athena_ctas.OLD_TABLE_LOCATION_PREFIX, 'carol'),
+      basic_dt - datetime.timedelta(hours=1), 1, 40 * 1024)
+
+  print('\n{:>20} {:>8} {:>8} {:>11}  {}'.format('tenant partitions', 'time(s)', 'queries', 'partitions', 'result'))
+  for partition_registrar in ('glue', 'athena'):
+    s3 = athena_ctas.S3_CLIENT = LocalS3Client()
+    put_tenant_objects(s3)
+    athena_ctas.KNOWN_PARTITIONS.clear()
+    athena_ctas.TABLE_STORAGE_DESCRIPTORS.clear()
+    athena_client = LocalAthenaClient(time_scale=options.time_scale, s3=s3)
+    glue_client = LocalGlueClient()
+    elapsed, error = run_scenario(athena_ctas, athena_client, glue_client, partition_registrar)
+
+    if partition_registrar == 'glue':
+      partitions = glue_client.partitions[('mydatabase', 'restapi_access_log_json')]
+      assert sorted(partitions) == [(e, '2023', '1', '31', '12') for e in sorted(tenant_objects)], sorted(partitions)
+      assert partitions[('bob', '2023', '1', '31', '12')]['StorageDescriptor']['Location'] == \
+        's3://example-bucket/json-data/tenant=bob/year=2023/month=01/day=31/hour=12/'
+    else:
+      alter_query = [e['query'] for e in athena_client.executions.values() if 'restapi_access_log_json' in e['query']
+        and e['query'].startswith('ALTER TABLE')][0]
+      partitions = re.findall(r'PARTITION \((.*?)\) LOCATION', alter_query)
+      assert partitions == ["tenant='1024', year=2023, month=1, day=31, hour=12",
+        "tenant='alice', year=2023, month=1, day=31, hour=12",
+        "tenant='bob', year=2023, month=1, day=31, hour=12",
+        "tenant='o''brien', year=2023, month=1, day=31, hour=12"], partitions
+    print('{:>20} {:>8.2f} {:>8} {:>11}  {}'.format(partition_registrar, elapsed, len(athena_client.executions),
+      len(partitions), error or 'OK'))
+    assert error is None, error
+
+  #XXX: The plan, the late objects and the local engine read the objects of every tenant of the hour.
+  s3 = athena_ctas.S3_CLIENT = LocalS3Client()
+  put_tenant_objects(s3)
+  sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+  try:
+    plan = asyncio.run(athena_ctas.plan_hours([basic_dt]))[basic_dt.strftime(athena_ctas.BACKFILL_HOUR_FMT)]
+  finally:
+    sys.stderr = stderr
+  assert plan['input_files'] == sum(tenant_objects.values()), plan
+  assert late_data.HOUR_KEY_PATTERN.match('tenant=alice/year=2023/month=01/day=31/hour=12/random-gen-1').groups() == \
+    ('2023', '01', '31', '12')
+
+  athena_ctas.TENANT_PARTITION_KEY = 'tenant_bucket'
+  query, _ = athena_ctas.get_alter_table_add_partition_query(basic_dt, 'mydatabase', 'restapi_access_log_json',
+    athena_ctas.OLD_TABLE_LOCATION_PREFIX, tenants=['7'])
+  assert 'PARTITION (tenant_bucket=7, year=2023, month=1, day=31, hour=12)' in query, query
+
+  if athena_ctas.json_to_parquet.pa is not None:
+    athena_ctas.TENANT_PARTITION_KEY = 'tenant'
+    with tempfile.TemporaryDirectory() as root:
+      athena_ctas.LOCAL_STORAGE_ROOT = root
+      for tenant, num_rows in (('alice', 3), ('bob', 2)):
+        path = os.path.join(root, 'example-bucket/json-data/tenant={}/year=2023/month=01/day=31/hour=12'.format(tenant))
+        os.makedirs(path)
+        with open(os.path.join(path, 'random-gen-1-00000'), 'w') as f:
+          f.writelines(json.dumps({'requestId': '{}-{}'.format(tenant, i), 'user': tenant}) + '\n' for i in range(num_rows))
+      sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+      try:
+        stats = asyncio.run(athena_ctas.run_local_compaction(basic_dt))
+      finally:
+        sys.stderr = stderr
+        athena_ctas.LOCAL_STORAGE_ROOT = ''
+    assert (stats['input_files'], stats['rows']) == (2, 5), stats
+
+  athena_ctas.TENANT_PARTITION_KEY = ''
+
+
+def run_parquet_source_scenarios(athena_ctas, options):
+  """Merges and verifies an hour of the Parquet files converted by Firehose with the local engine."""
+  if athena_ctas.json_to_parquet.pa is None:
+    return
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+
+  basic_dt = datetime.datetime(2023, 1, 31, 12)
+  athena_ctas.SOURCE_FORMAT = 'parquet'
+  with tempfile.TemporaryDirectory() as root:
+    athena_ctas.LOCAL_STORAGE_ROOT = root
+    path = os.path.join(root, 'example-bucket/json-data/year=2023/month=01/day=31/hour=12')
+    os.makedirs(path)
+    for i, num_rows in enumerate((300, 200, 100)):
+      #XXX: Firehose writes the lowercase column names of the Glue table, and timestamps as INT96.
+      table = pa.table({
+        'requestid': ['request-{}-{:05d}'.format(i, j) for j in range(num_rows)],
+        'user': ['user{}'.format(j % 7) for j in range(num_rows)],
+        'requesttime': pa.array([datetime.datetime(2023, 1, 31, 12, j % 60) for j in range(num_rows)], pa.timestamp('ns')),
+        'status': ['200'] * num_rows,
+        'responselength': pa.array(range(num_rows), pa.int32())
+      })
+      pq.write_table(table, os.path.join(path, 'random-gen-1-{:05d}'.format(i)), use_deprecated_int96_timestamps=True)
+
+    sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+    try:
+      plan = asyncio.run(athena_ctas.plan_hours([basic_dt]))[basic_dt.strftime(athena_ctas.BACKFILL_HOUR_FMT)]
+      stats = asyncio.run(athena_ctas.run_local_compaction(basic_dt))
+      result = athena_ctas.verify_hour(basic_dt)
+    finally:
+      sys.stderr = stderr
+      athena_ctas.LOCAL_STORAGE_ROOT = ''
+      athena_ctas.SOURCE_FORMAT = 'json'
+
+  print('\n{:>20} {:>8} {:>11} {:>12} {:>9}'.format('parquet source', 'objects', 'input(KB)', 'predicted(KB)', 'rows'))
+  print('{:>20} {:>8} {:>11.1f} {:>14.1f} {:>9}'.format('local engine', stats['input_files'], stats['input_bytes'] / 1024,
+    plan['predicted_bytes'] / 1024, stats['rows']))
+  #XXX: The merged files are predicted as large as the Parquet files, not a fifth of them like JSON objects.
+  assert plan['predicted_bytes'] == plan['input_bytes'] * athena_ctas.PARQUET_TO_PARQUET_RATIO, plan
+  assert (stats['input_files'], stats['rows'], stats['output_files']) == (3, 600, 1), stats
+  assert (result['source_rows'], result['output_rows']) == (600, 600), result
+
+
+def run_source_compression_scenarios(athena_ctas, options):
+  """Merges and verifies an hour of the JSON objects compressed by Firehose with the local engine."""
+  if athena_ctas.json_to_parquet.pa is None:
+    return
+  import gzip
+
+  from access_logs import gen_users, gen_zipf_weights, put_hour_json
+  from raw_compression_benchmark import compress_hadoop_snappy
+
+  basic_dt = datetime.datetime(2023, 1, 31, 12)
+  print('\n{:>20} {:>8} {:>11} {:>12} {:>9}'.format('source compression', 'objects', 'input(KB)', 'predicted(KB)', 'rows'))
+  for compression, extension, compress in (('UNCOMPRESSED', '', lambda e: e), ('GZIP', '.gz', gzip.compress),
+      ('HADOOP_SNAPPY', '.snappy', compress_hadoop_snappy)):
+    athena_ctas.SOURCE_COMPRESSION = compression
+    with tempfile.TemporaryDirectory() as root:
+      athena_ctas.LOCAL_STORAGE_ROOT = root
+      num_rows = put_hour_json(root, athena_ctas.get_hour_location(athena_ctas.OLD_TABLE_LOCATION_PREFIX, basic_dt),
+        basic_dt, 3, 1000, gen_users(10), gen_zipf_weights(10))
+      #XXX: Firehose appends the extension of the compression format to the objects.
+      path = os.path.join(root, 'example-bucket/json-data/year=2023/month=01/day=31/hour=12')
+      for name in os.listdir(path):
+        with open(os.path.join(path, name), 'rb') as f:
+          data = f.read()
+        os.remove(os.path.join(path, name))
+        with open(os.path.join(path, name + extension), 'wb') as f:
+          f.write(compress(data))
+
+      sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+      try:
+        plan = asyncio.run(athena_ctas.plan_hours([basic_dt]))[basic_dt.strftime(athena_ctas.BACKFILL_HOUR_FMT)]
+        stats = asyncio.run(athena_ctas.run_local_compaction(basic_dt))
+        result = athena_ctas.verify_hour(basic_dt)
+      finally:
+        sys.stderr = stderr
+        athena_ctas.LOCAL_STORAGE_ROOT = ''
+        athena_ctas.SOURCE_COMPRESSION = 'UNCOMPRESSED'
+
+    print('{:>20} {:>8} {:>11.1f} {:>14.1f} {:>9}'.format(compression, stats['input_files'], stats['input_bytes'] / 1024,
+      plan['predicted_bytes'] / 1024, stats['rows']))
+    #XXX: The merged files are predicted from the compressed bytes with the ratio of the compression format.
+    assert plan['predicted_bytes'] == int(plan['input_bytes'] * {'GZIP': athena_ctas.PARQUET_TO_GZIP_RATIO,
+      'HADOOP_SNAPPY': athena_ctas.PARQUET_TO_HADOOP_SNAPPY_RATIO}.get(compression, athena_ctas.PARQUET_TO_JSON_RATIO)), plan
+    assert (stats['input_files'], stats['rows'], stats['output_files']) == (3, num_rows, 1), stats
+    assert (result['source_rows'], result['output_rows']) == (num_rows, num_rows), result
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Run the compaction job against local Amazon Athena and AWS Glue stand-ins')
+  parser.add_argument('--time-scale', default=1.0, type=float,
+    help='The ratio of simulated query latencies (default: 1.0)')
+  parser.add_argument('--backfill-hours', default=24, type=int,
+    help='The number of hours to backfill (default: 24)')
+  parser.add_argument('--max-active-queries', default=5, type=int,
+    help='The active query quota of the simulated workgroup for backfills (default: 5)')
+  options = parser.parse_args()
+  #XXX: The backfill scenarios fail the CTAS query of the hour 5.
+  if not 6 <= options.backfill_hours <= 24:
+    parser.error('--backfill-hours must be between 6 and 24')
+
+  os.environ['DRY_RUN'] = 'false'
+  os.environ['EMIT_METRICS'] = 'false'
+  #XXX: The scenarios cover the size-aware planner, which is disabled by default.
+  os.environ.setdefault('SIZE_AWARE_PLANNING', 'true')
+  os.environ.setdefault('OLD_DATABASE', 'mydatabase')
+  os.environ.setdefault('OLD_TABLE_NAME', 'restapi_access_log_json')
+  os.environ.setdefault('NEW_DATABASE', 'mydatabase')
+  os.environ.setdefault('NEW_TABLE_NAME', 'restapi_access_log_parquet')
+  os.environ.setdefault('OLD_TABLE_LOCATION_PREFIX', 's3://example-bucket/json-data')
+  os.environ.setdefault('OUTPUT_PREFIX', 's3://example-bucket/parquet-data')
+  os.environ.setdefault('STAGING_OUTPUT_PREFIX', 's3://example-bucket/tmp')
+
+  import athena_ctas
+
+  #XXX: The queries are polled in the same steps of their simulated latencies at any time scale,
+  # so that the crashed backfill stops at the same point of progress.
+  athena_ctas.QUERY_POLL_INITIAL_DELAY *= options.time_scale
+  athena_ctas.QUERY_POLL_MAX_DELAY *= options.time_scale
+
+  source_alter_failure = (r'ALTER TABLE mydatabase\.restapi_access_log_json ', 'SemanticException [Error 10001]: Table not found')
+  ctas_failure = (r'^CREATE TABLE', 'HIVE_PATH_ALREADY_EXISTS: Target directory for table already exists')
+  warm_glue_client = LocalGlueClient()
+
+  #XXX: (scenario, partition registrar, athena failures, glue client, expected athena queries, expected glue calls, expected error)
+  # The hour to compact has objects except in the `empty hour` scenario.
+  scenarios = [
+    ('athena ddl', 'athena', [], LocalGlueClient(),
+      ['ALTER TABLE', 'ALTER TABLE', 'CREATE TABLE', 'DROP TABLE'], [], None),
+    ('athena alter failed', 'athena', [source_alter_failure], LocalGlueClient(),
+      ['ALTER TABLE', 'ALTER TABLE', 'DROP TABLE'], [], source_alter_failure[1]),
+    ('ctas failed', 'athena', [ctas_failure], LocalGlueClient(),
+      ['ALTER TABLE', 'ALTER TABLE', 'CREATE TABLE', 'DROP TABLE'], [], ctas_failure[1]),
+    ('glue', 'glue', [], warm_glue_client,
+      ['CREATE TABLE', 'DROP TABLE'], ['BatchGetPartition', 'GetTable', 'BatchCreatePartition'] * 2, None),
+    ('glue warm container', 'glue', [], warm_glue_client,
+      ['CREATE TABLE', 'DROP TABLE'], [], None),
+    ('glue access denied', 'glue', [], LocalGlueClient(denied=True),
+      ['ALTER TABLE', 'ALTER TABLE', 'CREATE TABLE', 'DROP TABLE'], ['BatchGetPartition'] * 2, None),
+    ('partition projection', 'projection', [], LocalGlueClient(),
+      ['CREATE TABLE', 'DROP TABLE'], [], None),
+    ('empty hour', 'glue', [], LocalGlueClient(),
+      ['DROP TABLE'], [], None)
+  ]
+
+  print('{:>20} {:>8} {:>8} {:>6} {:>6}  {}'.format('scenario', 'time(s)', 'queries', 'polls', 'glue', 'result'))
+  for name, partition_registrar, failures, glue_client, expected_queries, expected_glue_calls, expected_error in scenarios:
+    s3 = athena_ctas.S3_CLIENT = LocalS3Client()
+    if name != 'empty hour':
+      s3.put_hour_objects(athena_ctas.OLD_TABLE_LOCATION_PREFIX, datetime.datetime(2023, 1, 31, 12), 3, 40 * 1024)
+    athena_client = LocalAthenaClient(failures=failures, time_scale=options.time_scale, s3=s3)
+    if glue_client is not warm_glue_client:
+      athena_ctas.KNOWN_PARTITIONS.clear()
+      athena_ctas.TABLE_STORAGE_DESCRIPTORS.clear()
+    num_glue_calls = len(glue_client.api_calls)
+
+    elapsed, error = run_scenario(athena_ctas, athena_client, glue_client, partition_registrar)
+    glue_calls = glue_client.api_calls[num_glue_calls:]
+    polls = sum(1 for e in athena_client.api_calls if e[0] == 'GetQueryExecution')
+    print('{:>20} {:>8.2f} {:>8} {:>6} {:>6}  {}'.format(name, elapsed, len(athena_client.executions), polls,
+      len(glue_calls), error or 'OK'))
+
+    #XXX: Independent statements start in any order.
+    assert sorted(athena_client.queries()) == expected_queries, athena_client.queries()
+    assert sorted(glue_calls) == sorted(expected_glue_calls), glue_calls
+    if expected_error is None:
+      assert error is None, error
+    else:
+      assert isinstance(error, athena_ctas.AthenaQueryError) and error.reason == expected_error, error
+
+    executions = list(athena_client.executions.values())
+    ctas = [e for e in executions if e['query'].startswith('CREATE TABLE')]
+    others = [e for e in executions if not e['query'].startswith('CREATE TABLE')]
+    #XXX: The independent statements run concurrently, and CTAS starts after all of them succeed.
+    assert len(others) < 2 or max(e['started_at'] for e in others) < min(e['finished_at'] for e in others)
+    assert not ctas or ctas[0]['started_at'] >= max(e['finished_at'] for e in others)
+
+  print('\n[INFO] The fixed sleeps took 30 s per invocation.', file=sys.stderr)
+
+  run_backfill_scenarios(athena_ctas, options)
+  run_catch_up_scenarios(athena_ctas, options)
+  run_late_data_scenarios(athena_ctas, options)
+  run_daily_rollup_scenarios(athena_ctas, options)
+  run_verification_scenarios(athena_ctas, options)
+  run_tenant_partitioning_scenarios(athena_ctas, options)
+  run_parquet_source_scenarios(athena_ctas, options)
+  run_source_compression_scenarios(athena_ctas, options)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import asyncio
+import concurrent.futures
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python'))
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import compaction_ledger
+import json_to_parquet
+from access_logs import gen_access_log, gen_users, put_hour_json
+
+
+class SlowStorage(json_to_parquet.LocalStorage):
+  """LocalStorage with the modeled latency of a GetObject and PutObject of Amazon S3."""
+
+  def __init__(self, root, latency):
+    super().__init__(root)
+    self.latency = latency
+
+  def read(self, location):
+    time.sleep(self.latency)
+    return super().read(location)
+
+  def write_file(self, path, location):
+    time.sleep(self.latency)
+    super().write_file(path, location)
+
+
+def read_output(root, location):
+  paths = [os.path.join(root, e[len('s3://'):]) for e, _ in json_to_parquet.LocalStorage(root).list(location)]
+  return pq.ParquetDataset(paths).read() if paths else None
+
+
+def compact(root, latency, input_location, output_location, kwargs):
+  """Compacts an hour in a fresh process, and returns its statistics, time and peak memory."""
+  start = time.monotonic()
+  stats = json_to_parquet.compact(SlowStorage(root, latency), input_location, output_location, **kwargs)
+  elapsed = time.monotonic() - start
+  return (stats, elapsed, get_peak_rss(), pa.default_memory_pool().max_memory())
+
+
+def get_peak_rss():
+  #XXX: ru_maxrss is kept across execve on Linux, so a spawned process would report the peak of its parent.
+  # VmHWM of a process starts over at execve.
+  try:
+    with open('/proc/self/status') as f:
+      return next(int(e.split()[1]) * 1024 for e in f if e.startswith('VmHWM:'))
+  except OSError as _:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def benchmark_engine(root, options, num_rows):
+  """Compacts the hour with different I/O threads and block sizes, and reports throughput and peak memory."""
+  input_location = 's3://example-bucket/json-data/year=2023/month=01/day=31/hour=12/'
+  print('{:>10} {:>10} {:>8} {:>10} {:>8} {:>7} {:>10} {:>10} {:>10}'.format('io_threads', 'block(MB)', 'time(s)', 'input(MB)',
+    'MB/s', 'files', 'output(MB)', 'rss(MB)', 'arrow(MB)'))
+  for io_threads in options.io_threads:
+    for block_mb in options.block_size_mb:
+      output_location = 's3://example-bucket/parquet-data/io_threads={}/block={}/'.format(io_threads, block_mb)
+      kwargs = {
+        'row_group_rows': options.row_group_rows,
+        'target_file_size_mb': options.target_file_size_mb,
+        'io_threads': io_threads,
+        'max_prefetch_bytes': options.max_prefetch_mb * 1024**2,
+        'block_size': int(block_mb * 1024**2)
+      }
+      with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        stats, elapsed, peak_rss, peak_arrow = executor.submit(compact, root, options.latency_ms / 1000,
+          input_location, output_location, kwargs).result()
+
+      table = read_output(root, output_location)
+      assert stats['rows'] == num_rows == table.num_rows, stats
+      assert table.schema.field('status').type == pa.string(), table.schema
+      print('{:>10} {:>10} {:>8.2f} {:>10.1f} {:>8.1f} {:>7} {:>10.1f} {:>10.1f} {:>10.1f}'.format(io_threads, block_mb, elapsed,
+        stats['input_bytes'] / 1024**2, stats['input_bytes'] / 1024**2 / elapsed, stats['output_files'],
+        stats['output_bytes'] / 1024**2, peak_rss / 1024**2, peak_arrow / 1024**2))
+
+
+def benchmark_backfill(root, options):
+  """Runs a backfill of athena_ctas with the local engine, without Athena, then runs it again."""
+  os.environ.update({
+    'DRY_RUN': 'false',
+    'OLD_DATABASE': 'mydatabase',
+    'OLD_TABLE_NAME': 'restapi_access_log_json',
+    'NEW_DATABASE': 'mydatabase',
+    'NEW_TABLE_NAME': 'restapi_access_log_parquet',
+    'OLD_TABLE_LOCATION_PREFIX': 's3://example-bucket/json-data',
+    'OUTPUT_PREFIX': 's3://example-bucket/backfill-parquet-data',
+    'STAGING_OUTPUT_PREFIX': 's3://example-bucket/tmp',
+    'COMPACTION_ENGINE': 'local',
+    'EMIT_METRICS': 'false',
+    #XXX: The size-aware planner skips the hours without objects.
+    'SIZE_AWARE_PLANNING': 'true',
+    'LOCAL_STORAGE_ROOT': root,
+    #XXX: Partition projection needs no AWS Glue or Athena to add partitions.
+    'PARTITION_PROJECTION': 'true',
+    #XXX: The backfill run in a subprocess imports tracing.py from the tracing Lambda Layer, too.
+    'PYTHONPATH': os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python')
+  })
+  import athena_ctas
+
+  start_dt = datetime.datetime(2023, 1, 31, 10)
+  end_dt = datetime.datetime(2023, 1, 31, 14)
+  ledger = compaction_ledger.FileLedger(os.path.join(root, 'ledger.jsonl'))
+  summaries = []
+  sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+  try:
+    for _ in range(2):
+      summaries.append(asyncio.run(athena_ctas.backfill(None, start_dt, end_dt, concurrency=2, ledger=ledger)))
+  finally:
+    sys.stderr = stderr
+
+  first, second = summaries
+  print('\n{:>6} {:>10} {:>6} {:>7} {:>10}'.format('run', 'succeeded', 'empty', 'skipped', 'rows'))
+  for name, summary in zip(['first', 'second'], summaries):
+    print('{:>6} {:>10} {:>6} {:>7} {:>10}'.format(name, summary['succeeded'], summary['empty'], summary['skipped'], summary['rows']))
+  assert first['succeeded'] == 1 and first['empty'] == 3 and not first['failed'], first
+  assert second['skipped'] == 4, second
+
+  #XXX: An object created after the hour was compacted is replayed from a file of S3 event notifications.
+  basic_dt = datetime.datetime(2023, 1, 31, 12)
+  hour_location, late_location = [athena_ctas.get_hour_location(e, basic_dt) for e in (athena_ctas.OUTPUT_PREFIX,
+    athena_ctas.OLD_TABLE_LOCATION_PREFIX)]
+  old_files = json_to_parquet.LocalStorage(root).list(hour_location)
+
+  #XXX: The lambda function run again on the hour, e.g. retried, leaves its merged files as they are.
+  sys.stderr, stderr = open(os.devnull, 'w'), sys.stderr
+  try:
+    asyncio.run(athena_ctas.merge_hour(None, basic_dt - datetime.timedelta(hours=1), basic_dt))
+  finally:
+    sys.stderr = stderr
+  assert json_to_parquet.LocalStorage(root).list(hour_location) == old_files, old_files
+  late_path = json_to_parquet.LocalStorage(root).path(late_location + 'late-00000')
+  rng = random.Random(47)
+  with open(late_path, 'w') as f:
+    for _ in range(1000):
+      f.write(json.dumps(gen_access_log(rng, basic_dt, gen_users(options.users))) + '\n')
+  events_path = os.path.join(root, 'late-events.jsonl')
+  with open(events_path, 'w') as f:
+    f.write(json.dumps({'Records': [{
+      'eventTime': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+      'eventName': 'ObjectCreated:Put',
+      's3': {'bucket': {'name': 'example-bucket'}, 'object': {'key': late_location[len('s3://example-bucket/'):] + 'late-00000',
+        'size': os.path.getsize(late_path)}}
+    }]}) + '\n')
+
+  subprocess.run([sys.executable, athena_ctas.__file__, '--engine', 'local', '--local-root', root, '--partition-projection',
+    '--old-table-location-prefix', os.environ['OLD_TABLE_LOCATION_PREFIX'], '--output-prefix', os.environ['OUTPUT_PREFIX'],
+    '--staging-output-prefix', os.environ['STAGING_OUTPUT_PREFIX'], '--ledger', ledger.path, '--late-events', events_path, '--late-data-settle-minutes', '0',
+    '--run'], check=True, stderr=subprocess.DEVNULL)
+  new_files = json_to_parquet.LocalStorage(root).list(hour_location)
+  record = ledger.get_records(athena_ctas.get_ledger_id(), '2023-01-31T12', '2023-01-31T13')['2023-01-31T12']
+  print('{:>6} {:>10} {:>6} {:>7} {:>10}'.format('late', int(record['status'] == 'SUCCEEDED'), 0, 0, record['rows']))
+  assert record['rows'] == first['rows'] + 1000 and record['recompactions'] == 1, record
+  assert new_files and not set(new_files) & set(old_files), (old_files, new_files)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the local JSON to Parquet compaction engine on a local filesystem')
+  parser.add_argument('--objects', default=12, type=int,
+    help='The number of JSON objects of the hour (default: 12)')
+  parser.add_argument('--rows-per-object', default=50000, type=int,
+    help='The number of rows of a JSON object (default: 50000)')
+  parser.add_argument('--users', default=100, type=int,
+    help='The number of tenants of the access logs (default: 100)')
+  parser.add_argument('--io-threads', default=[1, 8], type=int, nargs='+',
+    help='The numbers of I/O threads to compare (default: 1 8)')
+  parser.add_argument('--block-size-mb', default=[1, 8], type=float, nargs='+',
+    help='The sizes of JSON blocks parsed at a time to compare (default: 1 8)')
+  parser.add_argument('--row-group-rows', default=500000, type=int,
+    help='The rows of a Parquet row group (default: 500000)')
+  parser.add_argument('--target-file-size-mb', default=128, type=float,
+    help='The target size of Parquet files (default: 128)')
+  parser.add_argument('--max-prefetch-mb', default=64, type=int,
+    help='The bytes of objects read ahead of parsing (default: 64)')
+  parser.add_argument('--latency-ms', default=50, type=float,
+    help='The modeled latency of a GetObject and PutObject (default: 50)')
+  options = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as root:
+    num_rows = put_hour_json(root, 's3://example-bucket/json-data/year=2023/month=01/day=31/hour=12/',
+      datetime.datetime(2023, 1, 31, 12), options.objects, options.rows_per_object, gen_users(options.users))
+    benchmark_engine(root, options, num_rows)
+    benchmark_backfill(root, options)
+
+  print('\n[INFO] rss(MB) is the peak memory of the process compacting the hour, which is bounded by --max-prefetch-mb of'
+    ' objects read ahead, a block of --block-size-mb and a row group of --row-group-rows rather than the size of the hour.',
+    file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
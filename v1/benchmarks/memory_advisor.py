@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python'))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/RestAPIs'))
+
+#XXX: AWS Lambda allocates CPU power in proportion to the memory size,
+# and a function has the equivalent of one vCPU at 1,769 MB.
+# https://docs.aws.amazon.com/lambda/latest/dg/configuration-memory.html
+LAMBDA_MEMORY_PER_VCPU_MB = 1769
+LAMBDA_MIN_MEMORY_MB, LAMBDA_MAX_MEMORY_MB = (128, 10240)
+LAMBDA_MEMORY_STEP_MB = 64
+
+#XXX: Lambda function names in saas_metering_demo
+MERGE_SMALL_FILES_FN_NAME = 'MergeSmallFilesWithAthenaCTAS'
+RANDOM_STRINGS_FN_NAME = 'RandomStrings'
+
+
+def gen_random_strings_event():
+  # The largest response of random_strings.lambda_handler
+  return {
+    'resource': '/random/strings',
+    'path': '/random/strings',
+    'httpMethod': 'GET',
+    'queryStringParameters': {'chars': 'letters', 'num': '100', 'len': '20'}
+  }
+
+
+def gen_scheduled_event():
+  return {
+    'id': 'cdc73f9d-aea9-11e3-9d5a-835b769c0d9c',
+    'detail-type': 'Scheduled Event',
+    'source': 'aws.events',
+    'time': '2023-01-31T13:10:00Z',
+    'detail': {}
+  }
+
+
+def measure(function_name, iterations):
+  """Runs a lambda handler in a fresh process and measures its peak memory and CPU time."""
+  if function_name == MERGE_SMALL_FILES_FN_NAME:
+    #XXX: The compaction job runs in dry-run mode, so it measures the cost of
+    # the AWS SDK and the job itself without waiting for Amazon Athena.
+    os.environ['DRY_RUN'] = 'true'
+    os.environ['EMIT_METRICS'] = 'false'
+    import athena_ctas
+    handler = athena_ctas.lambda_handler
+    event = gen_scheduled_event()
+  else:
+    import random_strings
+    handler = random_strings.lambda_handler
+    event = gen_random_strings_event()
+
+  sys.stderr = open(os.devnull, 'w')
+
+  cpu_times = []
+  for _ in range(iterations + 1):
+    start = time.process_time()
+    handler(event, {})
+    cpu_times.append(time.process_time() - start)
+
+  tracemalloc.start()
+  handler(event, {})
+  _, peak_traced_bytes = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  return {
+    'function_name': function_name,
+    'cold_cpu_time_ms': cpu_times[0] * 1000,
+    'cpu_time_ms': min(cpu_times[1:]) * 1000,
+    'peak_traced_mb': peak_traced_bytes / 1024 / 1024,
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+  }
+
+
+def estimate_duration_ms(cpu_time_ms, memory_size):
+  return cpu_time_ms / min(1.0, memory_size / LAMBDA_MEMORY_PER_VCPU_MB)
+
+
+def recommend_memory_size(measurement, headroom, target_duration_ms):
+  """Returns the smallest memory size that fits the peak RSS with headroom and meets the target duration."""
+  memory_size = math.ceil(measurement['peak_rss_mb'] * headroom / LAMBDA_MEMORY_STEP_MB) * LAMBDA_MEMORY_STEP_MB
+  memory_size = max(LAMBDA_MIN_MEMORY_MB, memory_size)
+  while memory_size < LAMBDA_MAX_MEMORY_MB and estimate_duration_ms(measurement['cold_cpu_time_ms'], memory_size) > target_duration_ms:
+    memory_size += LAMBDA_MEMORY_STEP_MB
+  return min(memory_size, LAMBDA_MAX_MEMORY_MB)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--context-file', default='cdk.context.json',
+    help='cdk context file to write the recommendation to (default: cdk.context.json)')
+  parser.add_argument('--iterations', default=3, type=int,
+    help='The number of invocations to measure CPU time (default: 3)')
+  parser.add_argument('--headroom', default=1.5, type=float,
+    help='The ratio of memory size to the measured peak RSS (default: 1.5)')
+  parser.add_argument('--target-duration-ms', default=1000, type=float,
+    help='The target duration of a cold invocation used to size CPU power (default: 1000)')
+  parser.add_argument('--update-context', action='store_true',
+    help='write the recommendation to the cdk context file')
+
+  options = parser.parse_args()
+
+  ctx = multiprocessing.get_context('spawn')
+
+  recommendation = {}
+  print('{:>30} {:>14} {:>10} {:>10} {:>9} {:>9}'.format('function', 'cold cpu(ms)', 'cpu(ms)', 'traced(MB)', 'rss(MB)', 'memory'))
+  for function_name in (MERGE_SMALL_FILES_FN_NAME, RANDOM_STRINGS_FN_NAME):
+    with ctx.Pool(1) as pool:
+      measurement = pool.apply(measure, (function_name, options.iterations))
+    memory_size = recommend_memory_size(measurement, options.headroom, options.target_duration_ms)
+    recommendation[function_name] = memory_size
+
+    print('{:>30} {:>14.1f} {:>10.1f} {:>10.1f} {:>9.1f} {:>9}'.format(function_name, measurement['cold_cpu_time_ms'],
+      measurement['cpu_time_ms'], measurement['peak_traced_mb'], measurement['peak_rss_mb'], memory_size))
+
+  print('\n[INFO] Recommended cdk context:\n{}'.format(json.dumps({'lambda_memory_size': recommendation}, indent=2)), file=sys.stderr)
+
+  if options.update_context:
+    with open(options.context_file) as f:
+      cdk_context = json.load(f)
+    cdk_context['lambda_memory_size'] = dict(cdk_context.get('lambda_memory_size', {}), **recommendation)
+    with open(options.context_file, 'w') as f:
+      json.dump(cdk_context, f, indent=2)
+    print(f'[INFO] Updated {options.context_file}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import concurrent.futures
+import datetime
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import pyarrow.parquet as pq
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+
+import json_to_parquet
+from access_logs import gen_users, gen_zipf_weights, put_hour_json
+
+#XXX: PARQUET_COMPRESSION[:PARQUET_COMPRESSION_LEVEL] settings to compare
+DEFAULT_SETTINGS = ['SNAPPY', 'ZSTD:1', 'ZSTD:3', 'ZSTD:9', 'GZIP:1', 'GZIP:6']
+
+
+def parse_setting(setting):
+  codec, _, level = setting.upper().partition(':')
+  return (codec, int(level) if level else None)
+
+
+def write_hour(root, tables, setting, row_group_rows, target_file_size_mb):
+  """Writes the tables of an hour as the compaction engine does. Returns the paths of the files and the write time."""
+  codec, level = parse_setting(setting)
+  storage = json_to_parquet.LocalStorage(root)
+  output_location = 's3://example-bucket/parquet-data/{}/row_group_rows={}/'.format(setting.replace(':', '_'), row_group_rows)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+    writer = json_to_parquet.PartitionWriter(storage, output_location, tables[0].schema, executor,
+      compression=codec,
+      compression_level=level,
+      row_group_rows=row_group_rows,
+      target_file_bytes=int(target_file_size_mb * 1024**2))
+    start = time.monotonic()
+    for table in tables:
+      writer.write(table)
+    files = writer.close()
+    elapsed = time.monotonic() - start
+  return ([storage.path(e) for e, _ in files], elapsed)
+
+
+def read_hour(paths, iterations):
+  """Returns the median time to read every column of the files, like a full scan of the hour."""
+  elapsed = []
+  for _ in range(iterations):
+    start = time.monotonic()
+    for path in paths:
+      pq.read_table(path, use_threads=False)
+    elapsed.append(time.monotonic() - start)
+  return statistics.median(elapsed)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark Parquet codecs and row group sizes on an hour of synthetic access logs')
+  parser.add_argument('--settings', default=DEFAULT_SETTINGS, nargs='+',
+    help='codecs with optional compression levels to compare (default: {})'.format(' '.join(DEFAULT_SETTINGS)))
+  parser.add_argument('--row-group-rows', default=[500000], type=int, nargs='+',
+    help='The rows of a Parquet row group to compare (default: 500000)')
+  parser.add_argument('--target-file-size-mb', default=128, type=float,
+    help='The target size of Parquet files (default: 128)')
+  parser.add_argument('--objects', default=12, type=int,
+    help='The number of JSON objects of the hour (default: 12)')
+  parser.add_argument('--rows-per-object', default=50000, type=int,
+    help='The number of rows of a JSON object (default: 50000)')
+  parser.add_argument('--users', default=200, type=int,
+    help='The number of tenants, whose requests follow Zipf\'s law (default: 200)')
+  parser.add_argument('--iterations', default=3, type=int,
+    help='The number of full scans of each setting (default: 3)')
+  options = parser.parse_args()
+
+  input_location = 's3://example-bucket/json-data/year=2023/month=01/day=31/hour=12/'
+  with tempfile.TemporaryDirectory() as root:
+    put_hour_json(root, input_location, datetime.datetime(2023, 1, 31, 12), options.objects, options.rows_per_object,
+      gen_users(options.users), gen_zipf_weights(options.users))
+    storage = json_to_parquet.LocalStorage(root)
+    objects = storage.list(input_location)
+    input_bytes = sum(size for _, size in objects)
+
+    #XXX: The hour is parsed once, so that write times compare the codecs only.
+    schema = json_to_parquet.get_schema()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+      tables = list(json_to_parquet.iter_tables(storage, objects, schema, executor, 4, 64 * 1024**2, json_to_parquet.BLOCK_SIZE))
+
+    print('{:>8} {:>11} {:>6} {:>11} {:>7} {:>9} {:>8}'.format('setting', 'row_groups', 'files', 'output(MB)',
+      'ratio', 'write(s)', 'read(s)'))
+    results = []
+    for row_group_rows in options.row_group_rows:
+      for setting in options.settings:
+        paths, write_s = write_hour(root, tables, setting, row_group_rows, options.target_file_size_mb)
+        output_bytes = sum(os.path.getsize(e) for e in paths)
+        read_s = read_hour(paths, options.iterations)
+        num_row_groups = sum(pq.ParquetFile(e).metadata.num_row_groups for e in paths)
+        results.append((setting, row_group_rows, output_bytes, write_s, read_s))
+        print('{:>8} {:>11} {:>6} {:>11.1f} {:>7.3f} {:>9.2f} {:>8.2f}'.format(setting, num_row_groups, len(paths),
+          output_bytes / 1024**2, output_bytes / input_bytes, write_s, read_s))
+
+  smallest = min(results, key=lambda e: e[2])
+  fastest = min(results, key=lambda e: e[4])
+  print('\n[INFO] {:.1f} MB of JSON; the smallest output is {} with row groups of {} rows, and the fastest full scan is {} '
+    'with row groups of {} rows. Set PARQUET_COMPRESSION, PARQUET_COMPRESSION_LEVEL and PARQUET_TO_JSON_RATIO (ratio) '
+    'in merge_small_files_lambda_env accordingly.'.format(input_bytes / 1024**2, smallest[0], smallest[1], fastest[0], fastest[1]),
+    file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import math
+import os
+import statistics
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python'))
+#XXX: saas_metering_demo/__init__.py imports aws_cdk, so the module is imported by itself.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../saas_metering_demo'))
+
+import partition_projection
+
+#XXX: The maximum number of partitions AWS Glue returns in a page of GetPartitions
+GLUE_PARTITIONS_PER_PAGE = 1000
+
+#XXX: Predicates of typical queries on the access log tables, relative to the latest partition
+PREDICATES = [
+  ('hour', ['year', 'month', 'day', 'hour']),
+  ('day', ['year', 'month', 'day']),
+  ('month', ['year', 'month'])
+]
+
+
+def gen_partition_values(num_partitions, start_dt):
+  return [(dt.year, dt.month, dt.day, dt.hour) for dt in (start_dt + datetime.timedelta(hours=i) for i in range(num_partitions))]
+
+
+def plan_with_glue(partition_values, predicate, page_latency_ms):
+  """Models query planning on registered partitions: Athena pages through AWS Glue GetPartitions,
+  which evaluates the predicate against every partition of the table.
+
+  Returns (number of matched partitions, GetPartitions calls, modeled planning time in ms).
+  """
+  keys = partition_projection.PARTITION_KEYS
+  start = time.perf_counter()
+  matched, pages = [], 0
+  for i in range(0, max(1, len(partition_values)), GLUE_PARTITIONS_PER_PAGE):
+    pages += 1
+    for values in partition_values[i:i + GLUE_PARTITIONS_PER_PAGE]:
+      if all(values[keys.index(k)] == v for k, v in predicate.items()):
+        matched.append(values)
+  cpu_ms = (time.perf_counter() - start) * 1000
+  return (len(matched), pages, cpu_ms + pages * page_latency_ms)
+
+
+def plan_with_projection(properties, predicate):
+  """Enumerates the locations of the partitions projected from the table properties for the predicate.
+
+  Returns (number of projected partitions, planning time in ms).
+  """
+  start = time.perf_counter()
+  candidates = []
+  for key in partition_projection.PARTITION_KEYS:
+    if key in predicate:
+      candidates.append([predicate[key]])
+    else:
+      low, high = [int(e) for e in properties[f'projection.{key}.range'].split(',')]
+      candidates.append(range(low, high + 1))
+
+  template = properties['storage.location.template']
+  digits = {k: int(properties.get(f'projection.{k}.digits', '0')) for k in partition_projection.PARTITION_KEYS}
+  locations = []
+  for values in itertools.product(*candidates):
+    location = template
+    for key, value in zip(partition_projection.PARTITION_KEYS, values):
+      location = location.replace('${%s}' % key, str(value).zfill(digits[key]))
+    locations.append(location)
+  return (len(locations), (time.perf_counter() - start) * 1000)
+
+
+def run_local(options):
+  with open(options.context_file) as f:
+    cdk_context = json.load(f)
+  firehose_prefix = cdk_context['firehose']['prefix']
+
+  start_dt = datetime.datetime(2023, 1, 1)
+  print('{:>10} {:>6} {:>9} {:>7} {:>14} {:>10} {:>14}'.format('partitions', 'query', 'matched', 'pages',
+    'registered(ms)', 'projected', 'projected(ms)'))
+  for num_partitions in options.num_partitions:
+    partition_values = gen_partition_values(num_partitions, start_dt)
+    latest = dict(zip(partition_projection.PARTITION_KEYS, partition_values[-1]))
+    year_range = '{},{}'.format(start_dt.year, partition_values[-1][0])
+    properties = partition_projection.get_partition_projection_properties(firehose_prefix, 's3://example-bucket/json-data', year_range)
+
+    for name, keys in PREDICATES:
+      predicate = {k: latest[k] for k in keys}
+      matched, pages, registered_ms = plan_with_glue(partition_values, predicate, options.glue_page_latency_ms)
+      projected, projected_ms = plan_with_projection(properties, predicate)
+      print('{:>10,} {:>6} {:>9} {:>7} {:>14.1f} {:>10} {:>14.3f}'.format(num_partitions, name, matched, pages,
+        registered_ms, projected, projected_ms))
+
+  print('\n[INFO] registered(ms) models {:.0f} ms per page of AWS Glue GetPartitions; '
+    'run with --athena to measure QueryPlanningTimeInMillis of real tables.'.format(options.glue_page_latency_ms), file=sys.stderr)
+
+
+def register_partitions(glue_client, database_name, table_name, num_partitions, start_dt):
+  """Registers hourly partitions to a table without partition projection, 100 partitions per BatchCreatePartition."""
+  storage_descriptor = glue_client.get_table(DatabaseName=database_name, Name=table_name)['Table']['StorageDescriptor']
+  location = storage_descriptor['Location'].rstrip('/')
+  partition_values = gen_partition_values(num_partitions, start_dt)
+  for i in range(0, len(partition_values), 100):
+    glue_client.batch_create_partition(DatabaseName=database_name, TableName=table_name, PartitionInputList=[{
+      'Values': [str(e) for e in values],
+      'StorageDescriptor': dict(storage_descriptor,
+        Location='{}/year={}/month={:02}/day={:02}/hour={:02}/'.format(location, *values))
+    } for values in partition_values[i:i + 100]])
+  print(f'[INFO] Registered {num_partitions} partitions to {database_name}.{table_name}', file=sys.stderr)
+
+
+def run_athena(options):
+  import boto3
+  import athena_ctas
+
+  athena_client = boto3.client('athena', region_name=options.region_name)
+  start_dt = datetime.datetime.strptime(options.start_date, '%Y-%m-%d')
+  if options.register_partitions:
+    register_partitions(boto3.client('glue', region_name=options.region_name),
+      options.database, options.table, options.register_partitions, start_dt)
+
+  num_partitions = options.register_partitions or options.num_partitions[0]
+  latest = dict(zip(partition_projection.PARTITION_KEYS, gen_partition_values(num_partitions, start_dt)[-1]))
+
+  print('{:>40} {:>6} {:>14} {:>14}'.format('table', 'query', 'planning(ms)', 'execution(ms)'))
+  for table in filter(None, [options.table, options.projected_table]):
+    for name, keys in PREDICATES:
+      where = ' AND '.join('{}={}'.format(k, latest[k]) for k in keys)
+      planning_ms, execution_ms = [], []
+      for _ in range(options.iterations):
+        response = athena_client.start_query_execution(
+          QueryString=f'SELECT COUNT(*) FROM {options.database}.{table} WHERE {where}',
+          ResultConfiguration={'OutputLocation': options.output_location},
+          WorkGroup=options.work_group)
+        query_execution = asyncio.run(athena_ctas.wait_for_query(athena_client, response['QueryExecutionId']))
+        planning_ms.append(query_execution['Statistics'].get('QueryPlanningTimeInMillis', math.nan))
+        execution_ms.append(query_execution['Statistics']['TotalExecutionTimeInMillis'])
+      print('{:>40} {:>6} {:>14.0f} {:>14.0f}'.format(table, name, statistics.median(planning_ms), statistics.median(execution_ms)))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark query planning on tables with registered or projected partitions')
+  parser.add_argument('--context-file', default='cdk.context.json',
+    help='cdk context file to read the Firehose prefix from (default: cdk.context.json)')
+  parser.add_argument('--num-partitions', default=[1000, 10000, 50000], type=int, nargs='+',
+    help='The numbers of hourly partitions of a table (default: 1000 10000 50000)')
+  parser.add_argument('--glue-page-latency-ms', default=50, type=float,
+    help='The modeled latency of a page of AWS Glue GetPartitions (default: 50)')
+  parser.add_argument('--athena', action='store_true',
+    help='run queries on Amazon Athena and report QueryPlanningTimeInMillis instead of the local model')
+  parser.add_argument('--region-name', default='us-east-1', help='aws region name')
+  parser.add_argument('--work-group', default='primary', help='aws athena work group')
+  parser.add_argument('--database', default='mydatabase', help='aws athena database name')
+  parser.add_argument('--table', default='restapi_access_log_json', help='table with registered partitions')
+  parser.add_argument('--projected-table', help='table with partition projection')
+  parser.add_argument('--output-location', help='s3 path for query results')
+  parser.add_argument('--start-date', default='2023-01-01', help='the first hourly partition (default: 2023-01-01)')
+  parser.add_argument('--register-partitions', type=int,
+    help='register this number of hourly partitions to --table through aws glue before running queries')
+  parser.add_argument('--iterations', default=5, type=int,
+    help='The number of queries for each table and predicate (default: 5)')
+
+  options = parser.parse_args()
+
+  if options.athena:
+    if not options.output_location:
+      parser.error('--output-location is required with --athena')
+    run_athena(options)
+  else:
+    run_local(options)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import datetime
+import gzip
+import io
+import os
+import statistics
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+
+import pyarrow as pa
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+
+import compaction_verifier
+import json_to_parquet
+import source_compression
+from access_logs import gen_users, gen_zipf_weights, put_hour_json
+
+#XXX: compression_format of Firehose to compare
+DEFAULT_FORMATS = ['UNCOMPRESSED', 'GZIP', 'HADOOP_SNAPPY', 'Snappy', 'ZIP']
+#XXX: The uncompressed bytes of a block of the Hadoop Snappy format, the default of io.compression.codec.snappy.buffersize
+HADOOP_SNAPPY_BLOCK_SIZE = 256 * 1024
+#XXX: Athena bills the bytes scanned, which are the compressed bytes of the objects read by CTAS.
+ATHENA_PRICE_PER_TB = 5.0
+
+
+def compress_hadoop_snappy(data):
+  out = io.BytesIO()
+  for i in range(0, len(data), HADOOP_SNAPPY_BLOCK_SIZE):
+    block = data[i:i + HADOOP_SNAPPY_BLOCK_SIZE]
+    chunk = pa.compress(block, codec='snappy', asbytes=True)
+    out.write(struct.pack('>II', len(block), len(chunk)))
+    out.write(chunk)
+  return out.getvalue()
+
+
+def compress_zip(data):
+  out = io.BytesIO()
+  with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as f:
+    f.writestr('records', data)
+  return out.getvalue()
+
+
+def decompress_zip(data):
+  with zipfile.ZipFile(io.BytesIO(data)) as f:
+    return f.read(f.namelist()[0])
+
+
+def get_codec(compression_format):
+  """Returns (compress, decompress) of a compression format of Firehose, or None if it is not available here."""
+  if compression_format == 'Snappy':
+    #XXX: The Snappy framing format needs python-snappy, and Athena cannot read it anyway.
+    if source_compression.snappy is None:
+      return None
+    return (lambda e: source_compression.snappy.StreamCompressor().add_chunk(e),
+      lambda e: source_compression.snappy.StreamDecompressor().decompress(e))
+  if compression_format == 'ZIP':
+    return (compress_zip, decompress_zip)
+  compress = {
+    'UNCOMPRESSED': lambda e: e,
+    'GZIP': lambda e: gzip.compress(e, compresslevel=6),
+    'HADOOP_SNAPPY': compress_hadoop_snappy
+  }[compression_format]
+  return (compress, lambda e: source_compression.decompress(e, compression_format))
+
+
+def measure_decompression(objects, decompress, iterations):
+  """Returns the median CPU seconds to decompress the objects."""
+  elapsed = []
+  for _ in range(iterations):
+    start = time.process_time()
+    for data in objects:
+      decompress(data)
+    elapsed.append(time.process_time() - start)
+  return statistics.median(elapsed)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the compression formats of the raw JSON objects of Firehose'
+    ' on an hour of synthetic access logs')
+  parser.add_argument('--formats', default=DEFAULT_FORMATS, nargs='+',
+    help='compression_format of Firehose to compare (default: {})'.format(' '.join(DEFAULT_FORMATS)))
+  parser.add_argument('--objects', default=12, type=int,
+    help='The number of JSON objects of the hour (default: 12)')
+  parser.add_argument('--rows-per-object', default=20000, type=int,
+    help='The number of rows of a JSON object (default: 20000)')
+  parser.add_argument('--users', default=200, type=int,
+    help='The number of tenants, whose requests follow Zipf\'s law (default: 200)')
+  parser.add_argument('--iterations', default=3, type=int,
+    help='The number of decompressions of each format (default: 3)')
+  options = parser.parse_args()
+
+  input_location = 's3://example-bucket/json-data/year=2023/month=01/day=31/hour=12/'
+  with tempfile.TemporaryDirectory() as root:
+    num_rows = put_hour_json(root, input_location, datetime.datetime(2023, 1, 31, 12), options.objects,
+      options.rows_per_object, gen_users(options.users), gen_zipf_weights(options.users))
+    storage = json_to_parquet.LocalStorage(root)
+    raw_objects = [storage.read(e) for e, _ in storage.list(input_location)]
+    raw_bytes = sum(len(e) for e in raw_objects)
+    #XXX: The merged files are the same whatever the compression of the objects they are merged from.
+    stats = json_to_parquet.compact(storage, input_location, 's3://example-bucket/parquet-data/year=2023/month=01/day=31/hour=12/')
+    parquet_bytes = stats['output_bytes']
+
+    print('{:>14} {:>11} {:>7} {:>13} {:>10} {:>13} {:>14} {:>14}'.format('format', 'stored(MB)', 'ratio',
+      'decompress(s)', 'MB/s', 'ctas scan(MB)', 'ctas($/month)', 'parquet/stored'))
+    results = []
+    for compression_format in options.formats:
+      codec = get_codec(compression_format)
+      if codec is None:
+        print('{:>14}  skipped without python-snappy'.format(compression_format))
+        continue
+      compress, decompress = codec
+      objects = [compress(e) for e in raw_objects]
+      stored_bytes = sum(len(e) for e in objects)
+      assert all(decompress(e) == raw for e, raw in zip(objects, raw_objects)), compression_format
+
+      athena_readable = compression_format in source_compression.COMPRESSION_FORMATS
+      if athena_readable:
+        #XXX: Verification counts the records of the objects as they are stored.
+        location = 's3://example-bucket/{}/object'.format(compression_format)
+        os.makedirs(os.path.dirname(storage.path(location)), exist_ok=True)
+        with open(storage.path(location), 'wb') as f:
+          f.write(objects[0])
+        assert compaction_verifier.count_json_rows(storage, location, compression=compression_format) == \
+          options.rows_per_object, compression_format
+
+      cpu_s = measure_decompression(objects, decompress, options.iterations)
+      #XXX: CTAS of every hour of a 30-day month scans the stored bytes of the objects.
+      monthly_cost = stored_bytes * 24 * 30 / 1024**4 * ATHENA_PRICE_PER_TB
+      results.append((compression_format, stored_bytes, cpu_s, athena_readable))
+      print('{:>14} {:>11.2f} {:>7.3f} {:>13.3f} {:>10} {:>13} {:>14} {:>14}'.format(compression_format,
+        stored_bytes / 1024**2, stored_bytes / raw_bytes, cpu_s,
+        '{:.1f}'.format(raw_bytes / 1024**2 / cpu_s) if compression_format != 'UNCOMPRESSED' else '-',
+        '{:.2f}'.format(stored_bytes / 1024**2) if athena_readable else 'n/a',
+        '{:.4f}'.format(monthly_cost) if athena_readable else 'n/a',
+        '{:.3f}'.format(parquet_bytes / stored_bytes)))
+
+  readable = [e for e in results if e[3]]
+  smallest = min(readable, key=lambda e: e[1])
+  print('\n[INFO] {} rows of {:.1f} MB of JSON, merged into {:.1f} MB of Parquet. {} stores and scans the fewest bytes'
+    ' among the formats Athena reads; set compression_format under firehose in cdk.context.json, and PARQUET_TO_JSON_RATIO'
+    ' (parquet/stored) in merge_small_files_lambda_env accordingly.'.format(num_rows, raw_bytes / 1024**2,
+      parquet_bytes / 1024**2, smallest[0]), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
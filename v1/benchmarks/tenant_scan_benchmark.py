@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import asyncio
+import collections
+import datetime
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/MergeSmallFiles'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python'))
+
+import json_to_parquet
+from access_logs import gen_users, gen_zipf_weights, put_hour_json
+
+#XXX: The columns read by the per-tenant usage query
+USAGE_QUERY_COLUMNS = ['user', 'responseLength']
+USAGE_QUERY_FMT = '''SELECT COUNT(*) AS requests, SUM(responseLength) AS response_bytes
+FROM {database}.{table}
+WHERE year={year} AND month={month} AND day={day} AND hour={hour} AND "user" = '{user}'
+'''
+#XXX: (layout, cluster_by) of the files merged by json_to_parquet and Athena CTAS
+LOCAL_LAYOUTS = [('unclustered', None), ('clustered', ['user', 'requestTime'])]
+CTAS_LAYOUTS = [('ctas', None), ('ctas clustered', ['user', 'requestTime'])]
+
+
+def get_bucket(value, bucket_count):
+  """Models the bucket of a value. Athena hashes it with the Hive bucketing function instead of CRC32."""
+  return zlib.crc32(str(value).encode('utf-8')) % bucket_count
+
+
+def write_ctas_files(table, query, output_dir, row_group_rows):
+  """Models the files written by a CTAS query of athena_ctas: a file per bucket of its `bucketed_by` column,
+  or a single file without bucketing, with the rows of each file sorted by its ORDER BY.
+
+  Returns (statistics, paths, bucket column, bucket count).
+  """
+  start = time.perf_counter()
+  bucketed_by = re.search(r"bucketed_by = ARRAY\['(\w+)'\],\s*bucket_count = (\d+)", query)
+  order_by = re.search(r'^ORDER BY (.+)$', query, re.MULTILINE)
+  bucket_column, bucket_count = (bucketed_by.group(1), int(bucketed_by.group(2))) if bucketed_by else (None, 1)
+  buckets = [get_bucket(e, bucket_count) for e in table.column(bucket_column).to_pylist()] if bucket_column else [0] * table.num_rows
+  buckets = pa.array(buckets, pa.int32())
+
+  os.makedirs(output_dir)
+  paths = []
+  for i in range(bucket_count):
+    rows = table.filter(pa.compute.equal(buckets, i))
+    if order_by:
+      rows = rows.sort_by([(e.strip(), 'ascending') for e in order_by.group(1).split(',')])
+    paths.append(os.path.join(output_dir, 'bucket-{:05d}'.format(i)))
+    pq.write_table(rows, paths[-1], row_group_size=row_group_rows)
+  stats = {'output_bytes': sum(os.path.getsize(e) for e in paths), 'elapsed_s': time.perf_counter() - start}
+  return (stats, paths, bucket_column, bucket_count)
+
+
+def get_scanned_bytes(paths, user, bucket_column=None, bucket_count=1):
+  """Models the bytes a query filtering on `user` reads from Parquet files: the footer of each file, and
+  the column chunks of USAGE_QUERY_COLUMNS of the row groups whose statistics of `user` may include it.
+  If the files are bucketed by `user`, only the file of the bucket of `user` is read.
+
+  Returns (scanned bytes, row groups read, row groups).
+  """
+  scanned, read, total = (0, 0, 0)
+  for i, path in enumerate(paths):
+    metadata = pq.ParquetFile(path).metadata
+    if bucket_column == 'user' and i != get_bucket(user, bucket_count):
+      total += metadata.num_row_groups
+      continue
+    scanned += metadata.serialized_size
+    names = [metadata.schema.column(j).name for j in range(metadata.num_columns)]
+    for j in range(metadata.num_row_groups):
+      row_group = metadata.row_group(j)
+      total += 1
+      stats = row_group.column(names.index('user')).statistics
+      if stats is not None and stats.has_min_max and not (stats.min <= user <= stats.max):
+        continue
+      read += 1
+      scanned += sum(row_group.column(names.index(e)).total_compressed_size for e in USAGE_QUERY_COLUMNS)
+  return (scanned, read, total)
+
+
+def get_ctas_query(cluster_by, bucket_count):
+  import athena_ctas
+
+  #XXX: An hour the size-aware planner buckets into bucket_count files
+  athena_ctas.CLUSTER_BY = cluster_by or []
+  query, _, _ = athena_ctas.get_ctas_query(datetime.datetime(2023, 1, 31, 12), plan={'bucket_count': bucket_count})
+  return query
+
+
+def run_local(options):
+  users = gen_users(options.users)
+  weights = gen_zipf_weights(options.users)
+  input_location = 's3://example-bucket/json-data/year=2023/month=01/day=31/hour=12/'
+
+  with tempfile.TemporaryDirectory() as root:
+    num_rows = put_hour_json(root, input_location, datetime.datetime(2023, 1, 31, 12), options.objects,
+      options.rows_per_object, users, weights)
+    storage = json_to_parquet.LocalStorage(root)
+
+    #XXX: (layout, row_group_rows) => (statistics, paths, bucket column, bucket count)
+    outputs = {}
+    for name, cluster_by in LOCAL_LAYOUTS:
+      for row_group_rows in options.row_group_rows:
+        output_location = 's3://example-bucket/parquet-data/{}/row_group_rows={}/'.format(name, row_group_rows)
+        stats = json_to_parquet.compact(storage, input_location, output_location,
+          row_group_rows=row_group_rows,
+          cluster_by=cluster_by)
+        assert stats['rows'] == num_rows, stats
+        outputs[(name, row_group_rows)] = (stats, [storage.path(e) for e, _ in storage.list(output_location)], None, 1)
+
+    #XXX: The rows of the hour as CTAS reads them from the source table
+    table = pa.concat_tables([pq.read_table(e) for e in outputs[('unclustered', options.row_group_rows[0])][1]])
+    for name, cluster_by in CTAS_LAYOUTS:
+      query = get_ctas_query(cluster_by, options.bucket_count)
+      for row_group_rows in options.row_group_rows:
+        output_dir = os.path.join(root, 'ctas', name.replace(' ', '_'), 'row_group_rows={}'.format(row_group_rows))
+        outputs[(name, row_group_rows)] = write_ctas_files(table, query, output_dir, row_group_rows)
+      #XXX: Clustered files are bucketed by the tenant instead of requestId.
+      assert outputs[(name, row_group_rows)][2] == (cluster_by[0] if cluster_by else 'requestId'), query
+
+    #XXX: The heaviest, a median and the lightest tenant by the number of requests
+    counts = collections.Counter()
+    for path in outputs[('unclustered', options.row_group_rows[0])][1]:
+      counts.update(pq.read_table(path, columns=['user']).column('user').to_pylist())
+    ranked = [user for user, _ in counts.most_common()]
+    tenants = [('heaviest', ranked[0]), ('median', ranked[len(ranked) // 2]), ('lightest', ranked[-1])]
+
+    print('{:>14} {:>10} {:>10} {:>10} {:>9} {:>12} {:>10} {:>8}'.format('layout', 'row_groups', 'output(MB)', 'write(s)',
+      'tenant', 'requests', 'scanned(KB)', 'read'))
+    scanned_by_layout = collections.defaultdict(list)
+    for (name, row_group_rows), (stats, paths, bucket_column, bucket_count) in outputs.items():
+      for tenant, user in tenants:
+        scanned, read, total = get_scanned_bytes(paths, user, bucket_column, bucket_count)
+        scanned_by_layout[(name, row_group_rows)].append(scanned)
+        print('{:>14} {:>10} {:>10.1f} {:>10.2f} {:>9} {:>12} {:>10.1f} {:>8}'.format(name, total,
+          stats['output_bytes'] / 1024**2, stats['elapsed_s'], tenant, counts[user], scanned / 1024, '{}/{}'.format(read, total)))
+
+    print()
+    for row_group_rows in options.row_group_rows:
+      for engine, (unclustered, clustered) in (('local engine', LOCAL_LAYOUTS), ('athena ctas', CTAS_LAYOUTS)):
+        before, after = [statistics.mean(scanned_by_layout[(e, row_group_rows)]) for e, _ in (unclustered, clustered)]
+        print('[INFO] {}, row groups of {} rows: a per-tenant query scans {:.1f} KB unclustered, {:.1f} KB clustered'
+          ' ({:.1f}x less)'.format(engine, row_group_rows, before / 1024, after / 1024, before / after), file=sys.stderr)
+        assert after < before, (engine, row_group_rows, before, after)
+
+
+def run_athena(options):
+  import boto3
+  import athena_ctas
+
+  athena_client = boto3.client('athena', region_name=options.region_name)
+  basic_dt = datetime.datetime.strptime(options.hour, '%Y-%m-%dT%H')
+  print('{:>40} {:>40} {:>14}'.format('table', 'user', 'scanned(KB)'))
+  for table in [options.table, options.clustered_table]:
+    for user in options.user:
+      query = USAGE_QUERY_FMT.format(database=options.database, table=table, user=user,
+        year=basic_dt.year, month=basic_dt.month, day=basic_dt.day, hour=basic_dt.hour)
+      response = athena_client.start_query_execution(QueryString=query,
+        ResultConfiguration={'OutputLocation': options.output_location},
+        WorkGroup=options.work_group)
+      query_execution = asyncio.run(athena_ctas.wait_for_query(athena_client, response['QueryExecutionId']))
+      print('{:>40} {:>40} {:>14.1f}'.format(table, user, query_execution['Statistics']['DataScannedInBytes'] / 1024))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the bytes scanned by per-tenant queries on unclustered and clustered Parquet files')
+  parser.add_argument('--objects', default=6, type=int,
+    help='The number of JSON objects of the hour (default: 6)')
+  parser.add_argument('--rows-per-object', default=50000, type=int,
+    help='The number of rows of a JSON object (default: 50000)')
+  parser.add_argument('--users', default=200, type=int,
+    help='The number of tenants, whose requests follow Zipf\'s law (default: 200)')
+  parser.add_argument('--row-group-rows', default=[500000, 50000], type=int, nargs='+',
+    help='The rows of a Parquet row group to compare (default: 500000 50000)')
+  parser.add_argument('--bucket-count', default=4, type=int,
+    help='The number of files of the hour planned for Athena CTAS (default: 4)')
+  parser.add_argument('--athena', action='store_true',
+    help='run the per-tenant query on Amazon Athena and report DataScannedInBytes instead of the local model')
+  parser.add_argument('--region-name', default='us-east-1', help='aws region name')
+  parser.add_argument('--work-group', default='primary', help='aws athena work group')
+  parser.add_argument('--database', default='mydatabase', help='aws athena database name')
+  parser.add_argument('--table', default='restapi_access_log_parquet', help='table merged without CLUSTER_BY')
+  parser.add_argument('--clustered-table', help='table merged with CLUSTER_BY=user,requestTime')
+  parser.add_argument('--hour', help='the hour to query, ex) 2023-01-31T12')
+  parser.add_argument('--user', nargs='+', help='the tenants to query')
+  parser.add_argument('--output-location', help='s3 path for query results')
+  options = parser.parse_args()
+
+  for name, value in (('OLD_DATABASE', 'mydatabase'), ('OLD_TABLE_NAME', 'restapi_access_log_json'),
+      ('NEW_DATABASE', 'mydatabase'), ('NEW_TABLE_NAME', 'restapi_access_log_parquet'),
+      ('OUTPUT_PREFIX', 's3://example-bucket/parquet-data'), ('STAGING_OUTPUT_PREFIX', 's3://example-bucket/tmp'),
+      ('EMIT_METRICS', 'false')):
+    os.environ.setdefault(name, value)
+
+  if options.athena:
+    if not (options.clustered_table and options.hour and options.user and options.output_location):
+      parser.error('--clustered-table, --hour, --user and --output-location are required with --athena')
+    run_athena(options)
+  else:
+    run_local(options)
+
+
+if __name__ == '__main__':
+  main()
@@ -10,12 +10,83 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+from .partition_projection import (
+  get_partition_projection_properties,
+  to_tblproperties
+)
+from .tenant_partitioning import (
+  get_tenant_partitioning,
+  get_firehose_prefix,
+  get_tenant_bucket,
+  get_tenant_bucket_sql
+)
+
 
 class AthenaNamedQueryStack(Stack):
 
-  def __init__(self, scope: Construct, construct_id: str, athena_work_group_name, s3_json_location, s3_parquet_location, **kwargs) -> None:
+  def __init__(self, scope: Construct, construct_id: str, athena_work_group_name, s3_json_location, s3_parquet_location, s3_daily_location=None, **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
 
+    firehose_config = self.node.try_get_context('firehose')
+    athena_config = self.node.try_get_context('athena')
+    partition_projection_config = athena_config.get('partition_projection', {})
+    partition_projection_enabled = partition_projection_config.get('enabled', False)
+    #XXX: With record format conversion, Firehose writes Parquet files with the columns of the Parquet table,
+    # so the source table reads them with the Parquet SerDe instead.
+    parquet_conversion_enabled = firehose_config.get('parquet_conversion', {}).get('enabled', False)
+    if parquet_conversion_enabled:
+      json_table_storage_format = '''ROW FORMAT SERDE
+  'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'
+STORED AS INPUTFORMAT
+  'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat'
+OUTPUTFORMAT
+  'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat'
+'''
+    else:
+      #XXX: TextInputFormat decompresses the objects by their extensions, .gz with GZIP and .snappy with HADOOP_SNAPPY
+      # of firehose.compression_format, so the table is the same whether the raw JSON is compressed or not.
+      json_table_storage_format = '''ROW FORMAT SERDE
+  'org.openx.data.jsonserde.JsonSerDe'
+STORED AS INPUTFORMAT
+  'org.apache.hadoop.mapred.TextInputFormat'
+OUTPUTFORMAT
+  'org.apache.hadoop.hive.ql.io.IgnoreKeyTextOutputFormat'
+'''
+
+    #XXX: With dynamic partitioning, the JSON table has the partition of the tenants before the hourly partitions.
+    tenant_partition_key, tenant_buckets = get_tenant_partitioning(firehose_config)
+
+    if partition_projection_enabled:
+      year_range = partition_projection_config.get('year_range', '2023,2033')
+      json_table_properties = '\n' + to_tblproperties(get_partition_projection_properties(get_firehose_prefix(firehose_config),
+        s3_json_location, year_range, tenant_buckets=tenant_buckets))
+      parquet_table_properties = '\n' + to_tblproperties(get_partition_projection_properties(firehose_config['prefix'], s3_parquet_location, year_range))
+      load_partitions_stmt = '''/* Partitions are projected from the table properties, so they are not loaded */'''
+    else:
+      json_table_properties, parquet_table_properties = ('', '')
+      load_partitions_stmt = '''/* Next we will load the partitions for this table */
+MSCK REPAIR TABLE {table_name};'''
+
+    json_tenant_partition, json_tenant_location, json_tenant_query = ('', '', '')
+    if tenant_partition_key == 'tenant':
+      json_tenant_partition = "tenant='alice', "
+      json_tenant_location = 'tenant=alice/'
+      json_tenant_query = '''
+/* Query the requests of a tenant, reading its partitions only */
+SELECT COUNT(*) FROM mydatabase.restapi_access_log_json
+WHERE tenant='alice' AND year=2023 AND month=1 AND day=31;
+'''
+    elif tenant_partition_key == 'tenant_bucket':
+      json_tenant_partition = 'tenant_bucket={}, '.format(get_tenant_bucket('alice', tenant_buckets))
+      json_tenant_location = 'tenant_bucket={}/'.format(get_tenant_bucket('alice', tenant_buckets))
+      json_tenant_query = '''
+/* Query the requests of a tenant, reading the partitions of its bucket only */
+SELECT COUNT(*) FROM mydatabase.restapi_access_log_json
+WHERE tenant_bucket={tenant_bucket} AND "user"='alice' AND year=2023 AND month=1 AND day=31;
+'''.format(tenant_bucket=get_tenant_bucket_sql(tenant_buckets, "'alice'"))
+    json_partition_columns = '  `{}` {},\n'.format(tenant_partition_key,
+      'int' if tenant_partition_key == 'tenant_bucket' else 'string') if tenant_partition_key else ''
+
     query_for_json_table = '''/* Create your database */
 CREATE DATABASE IF NOT EXISTS mydatabase;
 
@@ -31,34 +102,30 @@ CREATE EXTERNAL TABLE `mydatabase.restapi_access_log_json`(
   `protocol` string, 
   `responseLength` integer)
 PARTITIONED BY (
-  `year` int,
+{partition_columns}  `year` int,
   `month` int,
   `day` int,
   `hour` int)
-ROW FORMAT SERDE
-  'org.openx.data.jsonserde.JsonSerDe'
-STORED AS INPUTFORMAT
-  'org.apache.hadoop.mapred.TextInputFormat'
-OUTPUTFORMAT
-  'org.apache.hadoop.hive.ql.io.IgnoreKeyTextOutputFormat'
-LOCATION
-  '{s3_location}';
+{storage_format}LOCATION
+  '{s3_location}'{table_properties};
 
-/* Next we will load the partitions for this table */
-MSCK REPAIR TABLE mydatabase.restapi_access_log_json;
+{load_partitions_stmt}
 
 /* Check the partitions */
 SHOW PARTITIONS mydatabase.restapi_access_log_json;
 
 SELECT COUNT(*) FROM mydatabase.restapi_access_log_json;
-'''.format(s3_location=s3_json_location)
+{tenant_query}'''.format(s3_location=s3_json_location, table_properties=json_table_properties,
+  load_partitions_stmt=load_partitions_stmt.format(table_name='mydatabase.restapi_access_log_json'),
+  partition_columns=json_partition_columns, tenant_query=json_tenant_query, storage_format=json_table_storage_format)
 
     named_query_for_json_table = aws_athena.CfnNamedQuery(self, "MyAthenaCfnNamedQuery1",
       database="default",
       query_string=query_for_json_table,
 
       # the properties below are optional
-      description="Sample Hive DDL statement to create a partitioned table pointing to web log data (json)",
+      description="Sample Hive DDL statement to create a partitioned table pointing to web log data ({})".format(
+        'parquet converted by firehose' if parquet_conversion_enabled else 'json'),
       name="JSON Web Log table with partitions",
       work_group=athena_work_group_name
     )
@@ -89,16 +156,16 @@ STORED AS INPUTFORMAT
 OUTPUTFORMAT
   'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat'
 LOCATION
-  '{s3_location}';
+  '{s3_location}'{table_properties};
 
-/* Next we will load the partitions for this table */
-MSCK REPAIR TABLE mydatabase.restapi_access_log_parquet;
+{load_partitions_stmt}
 
 /* Check the partitions */
 SHOW PARTITIONS mydatabase.restapi_access_log_parquet;
 
 SELECT COUNT(*) FROM mydatabase.restapi_access_log_parquet;
-'''.format(s3_location=s3_parquet_location)
+'''.format(s3_location=s3_parquet_location, table_properties=parquet_table_properties,
+  load_partitions_stmt=load_partitions_stmt.format(table_name='mydatabase.restapi_access_log_parquet'))
 
     named_query_for_parquet_table = aws_athena.CfnNamedQuery(self, "MyAthenaCfnNamedQuery2",
       database="default",
@@ -110,14 +177,11 @@ SELECT COUNT(*) FROM mydatabase.restapi_access_log_parquet;
       work_group=athena_work_group_name
     )
 
-    ctas_query = '''/* Drop a temp table */
-DROP TABLE IF EXISTS mydatabase.tmp_restapi_access_log_parquet_2023013111;
-
-/* Add partitions to the JSON table */
+    add_partitions_stmt = '' if partition_projection_enabled else '''/* Add partitions to the JSON table */
 ALTER TABLE mydatabase.restapi_access_log_json ADD IF NOT EXISTS 
-PARTITION (year=2023, month=1, day=31, hour=11) LOCATION "{s3_json_location}/year=2023/month=01/day=31/hour=11/"
-PARTITION (year=2023, month=1, day=31, hour=12) LOCATION "{s3_json_location}/year=2023/month=01/day=31/hour=12/"
-PARTITION (year=2023, month=1, day=31, hour=13) LOCATION "{s3_json_location}/year=2023/month=01/day=31/hour=13/";
+PARTITION ({tenant_partition}year=2023, month=1, day=31, hour=11) LOCATION "{s3_json_location}/{tenant_location}year=2023/month=01/day=31/hour=11/"
+PARTITION ({tenant_partition}year=2023, month=1, day=31, hour=12) LOCATION "{s3_json_location}/{tenant_location}year=2023/month=01/day=31/hour=12/"
+PARTITION ({tenant_partition}year=2023, month=1, day=31, hour=13) LOCATION "{s3_json_location}/{tenant_location}year=2023/month=01/day=31/hour=13/";
 
 /* Add partitions to the Parquet table */
 ALTER TABLE mydatabase.restapi_access_log_parquet ADD IF NOT EXISTS 
@@ -125,7 +189,13 @@ PARTITION (year=2023, month=1, day=31, hour=11) LOCATION "{s3_parquet_location}/
 PARTITION (year=2023, month=1, day=31, hour=12) LOCATION "{s3_parquet_location}/parquet-data/year=2023/month=01/day=31/hour=12/"
 PARTITION (year=2023, month=1, day=31, hour=13) LOCATION "{s3_parquet_location}/year=2023/month=01/day=31/hour=13/";
 
-/* Run CTAS */
+'''.format(s3_json_location=s3_json_location, s3_parquet_location=s3_parquet_location,
+  tenant_partition=json_tenant_partition, tenant_location=json_tenant_location)
+
+    ctas_query = '''/* Drop a temp table */
+DROP TABLE IF EXISTS mydatabase.tmp_restapi_access_log_parquet_2023013111;
+
+{add_partitions_stmt}/* Run CTAS */
 CREATE TABLE mydatabase.tmp_restapi_access_log_parquet_2023013112
 WITH (
 external_location='{s3_parquet_location}/year=2023/month=01/day=31/hour=12/',
@@ -135,7 +205,7 @@ AS SELECT requestId,ip,user,requestTime,httpMethod,resourcePath,status,protocol,
 FROM mydatabase.restapi_access_log_json
 WHERE year=2023 AND month=1 AND day=31 AND hour=12
 WITH DATA;
-'''.format(s3_json_location=s3_json_location, s3_parquet_location=s3_parquet_location)
+'''.format(s3_json_location=s3_json_location, s3_parquet_location=s3_parquet_location, add_partitions_stmt=add_partitions_stmt)
 
     named_ctas_query = aws_athena.CfnNamedQuery(self, "MyAthenaCfnNamedQuery3",
       database="default",
@@ -147,3 +217,59 @@ WITH DATA;
       work_group=athena_work_group_name
     )
 
+    if s3_daily_location is None:
+      return
+
+    #XXX: The partitions of the daily table are switched by the daily roll-up, so they are neither loaded nor projected.
+    query_for_daily_table = '''/* Create the table of the days rolled up */
+CREATE EXTERNAL TABLE `mydatabase.restapi_access_log_parquet_daily`(
+  `requestId` string,
+  `ip` string,
+  `user` string, 
+  `requestTime` timestamp, 
+  `httpMethod` string, 
+  `resourcePath` string, 
+  `status` string,
+  `protocol` string, 
+  `responseLength` integer,
+  `hour` int)
+PARTITIONED BY (
+  `year` int,
+  `month` int,
+  `day` int)
+ROW FORMAT SERDE
+  'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'
+STORED AS INPUTFORMAT
+  'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat'
+OUTPUTFORMAT
+  'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat'
+LOCATION
+  '{s3_location}';
+
+/* Create the view of the days rolled up and the hours of the other days */
+CREATE OR REPLACE VIEW mydatabase.restapi_access_log_parquet_all AS
+SELECT requestId, ip, "user", requestTime, httpMethod, resourcePath, status, protocol, responseLength, year, month, day, hour
+FROM mydatabase.restapi_access_log_parquet_daily
+UNION ALL
+SELECT requestId, ip, "user", requestTime, httpMethod, resourcePath, status, protocol, responseLength, year, month, day, hour
+FROM mydatabase.restapi_access_log_parquet h
+WHERE NOT EXISTS (
+  SELECT 1 FROM mydatabase."restapi_access_log_parquet_daily$partitions" d
+  WHERE d.year = h.year AND d.month = h.month AND d.day = h.day);
+
+/* Query the usage of a month */
+SELECT "user", COUNT(*) AS requests, SUM(responseLength) AS response_bytes
+FROM mydatabase.restapi_access_log_parquet_all
+WHERE year=2023 AND month=1
+GROUP BY "user";
+'''.format(s3_location=s3_daily_location)
+
+    named_query_for_daily_table = aws_athena.CfnNamedQuery(self, "MyAthenaCfnNamedQuery4",
+      database="default",
+      query_string=query_for_daily_table,
+
+      # the properties below are optional
+      description="Sample Hive DDL statement to create the daily table and the view of the daily and the hourly tables",
+      name="Daily roll-up table and view",
+      work_group=athena_work_group_name
+    )
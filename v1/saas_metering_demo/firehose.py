@@ -6,12 +6,19 @@ import aws_cdk as cdk
 
 from aws_cdk import (
   Stack,
+  aws_cloudwatch,
   aws_iam,
   aws_s3 as s3,
   aws_kinesisfirehose
 )
 from constructs import Construct
 
+from .tenant_partitioning import (
+  get_tenant_partitioning,
+  get_firehose_prefix,
+  get_metadata_extraction_query
+)
+from .raw_data_compression import get_compression_format
 
 from aws_cdk.aws_kinesisfirehose import CfnDeliveryStream as firehose_cfn
 
@@ -32,12 +39,45 @@ class KinesisFirehoseStack(Stack):
     FIREHOSE_STREAM_NAME = f"amazon-apigateway-{firehose_config['stream_name']}"
     FIREHOSE_BUFFER_SIZE = firehose_config['buffer_size_in_mbs']
     FIREHOSE_BUFFER_INTERVAL = firehose_config['buffer_interval_in_seconds']
-    FIREHOSE_TO_S3_PREFIX = firehose_config['prefix']
+    #XXX: With dynamic partitioning, the objects of each tenant are written under a partition of its own.
+    FIREHOSE_TO_S3_PREFIX = get_firehose_prefix(firehose_config)
     FIREHOSE_TO_S3_ERROR_OUTPUT_PREFIX = firehose_config['error_output_prefix']
     FIREHOSE_TO_S3_OUTPUT_FOLDER = firehose_config['s3_output_folder']
+    #XXX: Compressing the raw JSON cuts its storage and the bytes scanned by the queries of the JSON table and CTAS.
+    FIREHOSE_COMPRESSION_FORMAT = get_compression_format(firehose_config)
 
     assert f'{FIREHOSE_TO_S3_OUTPUT_FOLDER}/' == FIREHOSE_TO_S3_PREFIX[:len(FIREHOSE_TO_S3_OUTPUT_FOLDER) + 1]
 
+    #XXX: The raw data is expired or transitioned only once the compaction has verified its rows in the merged files,
+    # and tagged it with compaction=verified.
+    raw_data_lifecycle = firehose_config.get('raw_data_lifecycle', {})
+    if raw_data_lifecycle.get('enabled', False):
+      raw_data_lifecycle_action = raw_data_lifecycle.get('action', 'expire') # [expire, transition]
+      raw_data_lifecycle_days = int(raw_data_lifecycle.get('days', 7))
+      #XXX: An hour with late objects is compacted again from its raw data, so the raw data must outlive the hours caught up.
+      merge_small_files_lambda_env = self.node.try_get_context('merge_small_files_lambda_env') or {}
+      catch_up_hours = int(merge_small_files_lambda_env.get('CATCH_UP_HOURS', 24))
+      if raw_data_lifecycle_days * 24 <= catch_up_hours:
+        raise ValueError(f'firehose.raw_data_lifecycle.days must be longer than CATCH_UP_HOURS ({catch_up_hours} hours)')
+
+      if raw_data_lifecycle_action == 'expire':
+        lifecycle_rule = {'expiration': cdk.Duration.days(raw_data_lifecycle_days)}
+      elif raw_data_lifecycle_action == 'transition':
+        #XXX: Athena ignores the objects in the S3 Glacier Flexible Retrieval and S3 Glacier Deep Archive storage classes,
+        # so an hour compacted again from them would lose rows.
+        storage_class = raw_data_lifecycle.get('storage_class', 'GLACIER_IR')
+        if storage_class not in ('STANDARD_IA', 'ONEZONE_IA', 'INTELLIGENT_TIERING', 'GLACIER_IR'):
+          raise ValueError(f'Amazon Athena cannot read the raw data in the storage class: {storage_class}')
+        lifecycle_rule = {'transitions': [s3.Transition(storage_class=s3.StorageClass(storage_class),
+          transition_after=cdk.Duration.days(raw_data_lifecycle_days))]}
+      else:
+        raise ValueError(f'Unknown raw_data_lifecycle action: {raw_data_lifecycle_action}')
+
+      s3_bucket.add_lifecycle_rule(id='RawDataLifecycle',
+        prefix=f'{FIREHOSE_TO_S3_OUTPUT_FOLDER}/',
+        tag_filters={'compaction': 'verified'},
+        **lifecycle_rule)
+
     firehose_role_policy_doc = aws_iam.PolicyDocument()
     firehose_role_policy_doc.add_statements(aws_iam.PolicyStatement(**{
       "effect": aws_iam.Effect.ALLOW,
@@ -92,6 +132,70 @@ class KinesisFirehoseStack(Stack):
       }
     )
 
+    tenant_partition_key, tenant_buckets = get_tenant_partitioning(firehose_config)
+    dynamic_partitioning_configuration = {"enabled": False}
+    processing_configuration = None
+    if tenant_partition_key:
+      dynamic_partitioning_configuration = {
+        "enabled": True,
+        "retryOptions": {
+          "durationInSeconds": 300
+        }
+      }
+      #XXX: The partition key is extracted by an inline JQ query instead of a lambda function.
+      processing_configuration = {
+        "enabled": True,
+        "processors": [{
+          "type": "MetadataExtraction",
+          "parameters": [
+            {"parameterName": "MetadataExtractionQuery",
+             "parameterValue": get_metadata_extraction_query(tenant_partition_key, tenant_buckets)},
+            {"parameterName": "JsonParsingEngine", "parameterValue": "JQ-1.6"}
+          ]
+        }]
+      }
+
+    #XXX: With record format conversion, Firehose writes Parquet files with the schema of the Parquet table,
+    # so the compaction only merges them into files of the target size.
+    # The table is created by its named query after the stacks are deployed, so Firehose converts the records
+    # only once schema_table_created is set; until then, records would fail the conversion.
+    parquet_conversion = firehose_config.get('parquet_conversion', {})
+    data_format_conversion_configuration = {"enabled": False}
+    if parquet_conversion.get('enabled', False) and parquet_conversion.get('schema_table_created', False):
+      if FIREHOSE_BUFFER_SIZE < 64:
+        raise ValueError('buffer_size_in_mbs must be at least 64 with parquet_conversion')
+      parquet_compression = parquet_conversion.get('compression', 'SNAPPY')
+      if parquet_compression not in ('SNAPPY', 'GZIP', 'UNCOMPRESSED'):
+        raise ValueError(f'Unknown parquet_conversion compression: {parquet_compression}')
+
+      merge_small_files_lambda_env = self.node.try_get_context('merge_small_files_lambda_env')
+      data_format_conversion_configuration = {
+        "enabled": True,
+        "inputFormatConfiguration": {
+          "deserializer": {
+            #XXX: requestTime is $context.requestTimeEpoch of Amazon API Gateway, in milliseconds.
+            "hiveJsonSerDe": {
+              "timestampFormats": ["millis"]
+            }
+          }
+        },
+        "outputFormatConfiguration": {
+          "serializer": {
+            "parquetSerDe": {
+              "compression": parquet_compression
+            }
+          }
+        },
+        "schemaConfiguration": {
+          "catalogId": cdk.Aws.ACCOUNT_ID,
+          "databaseName": merge_small_files_lambda_env['NEW_DATABASE'],
+          "tableName": merge_small_files_lambda_env['NEW_TABLE_NAME'],
+          "region": cdk.Aws.REGION,
+          "roleArn": firehose_role.role_arn,
+          "versionId": "LATEST"
+        }
+      }
+
     ext_s3_dest_config = firehose_cfn.ExtendedS3DestinationConfigurationProperty(
       bucket_arn=s3_bucket.bucket_arn,
       role_arn=firehose_role.role_arn,
@@ -104,13 +208,10 @@ class KinesisFirehoseStack(Stack):
         "logGroupName": firehose_log_group_name,
         "logStreamName": f"{self.stack_name}-S3Delivery"
       },
-      compression_format="UNCOMPRESSED", # [GZIP | HADOOP_SNAPPY | Snappy | UNCOMPRESSED | ZIP]
-      data_format_conversion_configuration={
-        "enabled": False
-      },
-      dynamic_partitioning_configuration={
-        "enabled": False
-      },
+      compression_format=FIREHOSE_COMPRESSION_FORMAT, # [GZIP | HADOOP_SNAPPY | UNCOMPRESSED]
+      data_format_conversion_configuration=data_format_conversion_configuration,
+      dynamic_partitioning_configuration=dynamic_partitioning_configuration,
+      processing_configuration=processing_configuration,
       error_output_prefix=FIREHOSE_TO_S3_ERROR_OUTPUT_PREFIX,
       prefix=FIREHOSE_TO_S3_PREFIX
     )
@@ -121,6 +222,20 @@ class KinesisFirehoseStack(Stack):
       extended_s3_destination_configuration=ext_s3_dest_config
     )
 
+    if tenant_partition_key:
+      #XXX: The records of the partitions beyond the active partitions of Firehose are sent to the error output.
+      aws_cloudwatch.Alarm(self, "PartitionCountExceededAlarm",
+        alarm_description="More tenant partitions than Firehose writes at a time; set dynamic_partitioning.partition_key to tenant_bucket",
+        metric=aws_cloudwatch.Metric(namespace="AWS/Firehose",
+          metric_name="PartitionCountExceeded",
+          dimensions_map={"DeliveryStreamName": FIREHOSE_STREAM_NAME},
+          statistic="Maximum",
+          period=cdk.Duration.minutes(5)),
+        threshold=1,
+        evaluation_periods=1,
+        comparison_operator=aws_cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD,
+        treat_missing_data=aws_cloudwatch.TreatMissingData.NOT_BREACHING)
+
     self.firehose_arn = firehose_to_s3_delivery_stream.attr_arn
     self.s3_dest_bucket_name = s3_bucket.bucket_name
     self.s3_dest_folder_name = FIREHOSE_TO_S3_OUTPUT_FOLDER
@@ -12,7 +12,7 @@ from constructs import Construct
 
 class DataLakePermissionsStack(Stack):
 
-  def __init__(self, scope: Construct, construct_id: str, job_role, **kwargs) -> None:
+  def __init__(self, scope: Construct, construct_id: str, job_roles, **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
 
     athena_database_info = self.node.try_get_context('merge_small_files_lambda_env')
@@ -32,8 +32,14 @@ class DataLakePermissionsStack(Stack):
       )]
     )
 
+    #XXX: Construct ids of the first role are kept, so that its permissions are not replaced.
+    for role_idx, job_role in enumerate(job_roles):
+      role_suffix = f"Role{role_idx}" if role_idx else ""
+      self.grant_permissions(job_role, database_list, cfn_data_lake_settings, role_suffix)
+
+  def grant_permissions(self, job_role, database_list, cfn_data_lake_settings, role_suffix):
     for idx, database_name in enumerate(database_list):
-      lf_permissions_on_database = aws_lakeformation.CfnPrincipalPermissions(self, f"LFPermissionsOnDatabase{idx}",
+      lf_permissions_on_database = aws_lakeformation.CfnPrincipalPermissions(self, f"LFPermissionsOnDatabase{idx}{role_suffix}",
         permissions=["CREATE_TABLE", "DROP", "ALTER", "DESCRIBE"],
         permissions_with_grant_option=[],
         principal=aws_lakeformation.CfnPrincipalPermissions.DataLakePrincipalProperty(
@@ -53,7 +59,7 @@ class DataLakePermissionsStack(Stack):
       lf_permissions_on_database.add_dependency(cfn_data_lake_settings)
 
     for idx, database_name in enumerate(database_list):
-      lf_permissions_on_table = aws_lakeformation.CfnPrincipalPermissions(self, f"LFPermissionsOnTable{idx}",
+      lf_permissions_on_table = aws_lakeformation.CfnPrincipalPermissions(self, f"LFPermissionsOnTable{idx}{role_suffix}",
         permissions=["SELECT", "INSERT", "DELETE", "DESCRIBE", "ALTER"],
         permissions_with_grant_option=[],
         principal=aws_lakeformation.CfnPrincipalPermissions.DataLakePrincipalProperty(
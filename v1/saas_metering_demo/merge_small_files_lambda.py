@@ -8,14 +8,24 @@ import aws_cdk as cdk
 
 from aws_cdk import (
   Stack,
+  aws_dynamodb,
   aws_iam,
   aws_lambda,
   aws_logs,
   aws_events,
-  aws_events_targets
+  aws_events_targets,
+  aws_s3 as s3,
+  aws_s3_notifications,
+  aws_sqs,
+  aws_stepfunctions as sfn,
+  aws_stepfunctions_tasks as sfn_tasks
 )
 from constructs import Construct
 
+from .tenant_partitioning import get_tenant_partitioning
+from .raw_data_compression import get_compression_format
+from .tracing_layer import create_tracing_layer
+
 class MergeSmallFilesLambdaStack(Stack):
 
   def __init__(self, scope: Construct, construct_id: str, s3_bucket_name, s3_folder_name, athena_work_group, **kwargs) -> None:
@@ -32,7 +42,33 @@ class MergeSmallFilesLambdaStack(Stack):
       'OLD_TABLE_LOCATION_PREFIX',
       'OUTPUT_PREFIX',
       'STAGING_OUTPUT_PREFIX',
-      'COLUMN_NAMES'
+      'COLUMN_NAMES',
+      'QUERY_POLL_INITIAL_DELAY',
+      'QUERY_POLL_MAX_DELAY',
+      'QUERY_START_MAX_RETRIES',
+      'PARTITION_REGISTRAR',
+      'CATCH_UP_HOURS',
+      'MAX_CONCURRENT_QUERIES',
+      'SIZE_AWARE_PLANNING',
+      'TARGET_FILE_SIZE_MB',
+      'BUCKET_COLUMN',
+      'PARQUET_TO_JSON_RATIO',
+      'PARQUET_COMPRESSION',
+      'PARQUET_COMPRESSION_LEVEL',
+      'PARQUET_ROW_GROUP_ROWS',
+      'LOCAL_ENGINE_IO_THREADS',
+      'LOCAL_ENGINE_MAX_PREFETCH_MB',
+      'LOCAL_ENGINE_MAX_SORT_ROWS',
+      'CLUSTER_BY',
+      'ATHENA_PRICE_PER_TB',
+      'REGRESSION_THRESHOLD',
+      'LATE_DATA_MAX_MESSAGES',
+      'VERIFY_COMPACTION',
+      'VERIFY_MAX_RECOMPACTIONS',
+      'MAX_TENANT_PARTITIONS',
+      'PARQUET_TO_PARQUET_RATIO',
+      'PARQUET_TO_GZIP_RATIO',
+      'PARQUET_TO_HADOOP_SNAPPY_RATIO'
     ]
 
     lambda_fn_env = {k: v for k, v in _lambda_env.items() if k in LAMBDA_ENV_VARS}
@@ -45,8 +81,121 @@ class MergeSmallFilesLambdaStack(Stack):
     }
     lambda_fn_env.update(additional_lambda_fn_env)
 
+    #XXX: The tables created with partition projection do not need partitions to be registered.
+    athena_config = self.node.try_get_context('athena') or {}
+    partition_projection_enabled = athena_config.get('partition_projection', {}).get('enabled', False)
+    lambda_fn_env['PARTITION_PROJECTION'] = str(partition_projection_enabled).lower()
+
+    #XXX: With dynamic partitioning of Firehose, the objects of an hour are under the partition of each tenant.
+    firehose_config = self.node.try_get_context('firehose') or {}
+    tenant_partition_key, _ = get_tenant_partitioning(firehose_config)
+    lambda_fn_env['TENANT_PARTITION_KEY'] = tenant_partition_key
+
+    #XXX: With record format conversion of Firehose, the objects are Parquet files to merge into files of the target size.
+    parquet_conversion_enabled = firehose_config.get('parquet_conversion', {}).get('enabled', False)
+    lambda_fn_env['SOURCE_FORMAT'] = 'parquet' if parquet_conversion_enabled else 'json'
+    #XXX: The local engine and the verification decompress the JSON objects compressed by Firehose.
+    lambda_fn_env['SOURCE_COMPRESSION'] = get_compression_format(firehose_config)
+
+    #XXX: The statistics of the queries are written to CloudWatch Logs in Embedded Metric Format only if enabled.
+    compaction_metrics = self.node.try_get_context("compaction_metrics") or {}
+    lambda_fn_env.update({
+      'EMIT_METRICS': str(compaction_metrics.get("enabled", False)).lower(),
+      'METRICS_NAMESPACE': compaction_metrics.get("namespace", "SaaSMetering/Compaction")
+    })
+
+    lambda_tracing = self.node.try_get_context("lambda_tracing") or {}
+    lambda_fn_env.update({
+      'TracingEnabled': str(lambda_tracing.get("enabled", False)).lower(),
+      'TracingSampleRate': str(lambda_tracing.get("sample_rate", 0.01))
+    })
+    self.tracing_layer = create_tracing_layer(self, aws_lambda.Runtime.PYTHON_3_9)
+
+    #XXX: The compaction ledger records compacted hours, so that each run catches up the hours not compacted yet.
+    compaction_ledger = self.node.try_get_context("compaction_ledger") or {}
+    compaction_ledger_type = compaction_ledger.get("type", "none") # [dynamodb, s3, none]
+    compaction_ledger_table = None
+    if compaction_ledger_type == 'dynamodb':
+      compaction_ledger_table = aws_dynamodb.Table(self, "CompactionLedger",
+        partition_key=aws_dynamodb.Attribute(name="ledger_id", type=aws_dynamodb.AttributeType.STRING),
+        sort_key=aws_dynamodb.Attribute(name="hour", type=aws_dynamodb.AttributeType.STRING),
+        billing_mode=aws_dynamodb.BillingMode.PAY_PER_REQUEST,
+        removal_policy=cdk.RemovalPolicy.DESTROY #XXX: for testing
+      )
+      lambda_fn_env['COMPACTION_LEDGER'] = f"dynamodb://{compaction_ledger_table.table_name}"
+    elif compaction_ledger_type == 's3':
+      lambda_fn_env['COMPACTION_LEDGER'] = f"s3://{os.path.join(s3_bucket_name, compaction_ledger.get('prefix', 'compaction-ledger'))}"
+
+    #XXX: The local compaction engine converts JSON to Parquet in the function with pyarrow instead of Athena CTAS.
+    compaction_engine = self.node.try_get_context("compaction_engine") or {}
+    compaction_engine_type = compaction_engine.get("type", "athena") # [athena, local]
+    lambda_fn_env['COMPACTION_ENGINE'] = compaction_engine_type
+    lambda_layers = [self.tracing_layer]
+    if compaction_engine_type == 'local':
+      #XXX: pyarrow is not included in the AWS Lambda Python runtime, e.g. use the AWS SDK for pandas layer.
+      # https://aws-sdk-pandas.readthedocs.io/en/stable/layers.html
+      if not compaction_engine.get("pyarrow_layer_arn"):
+        raise ValueError('compaction_engine.pyarrow_layer_arn is required by the local compaction engine')
+      lambda_layers.append(aws_lambda.LayerVersion.from_layer_version_arn(self, "PyArrowLayer",
+        compaction_engine["pyarrow_layer_arn"]))
+
+    #XXX: S3 event notifications of the objects created under the source table location are queued,
+    # so that each run compacts again the hours which had objects created after they were compacted.
+    late_data = self.node.try_get_context("late_data") or {}
+    late_data_enabled = late_data.get("enabled", False)
+    late_data_queue = None
+    if late_data_enabled:
+      if compaction_ledger_type == 'none':
+        raise ValueError('compaction_ledger is required by late_data')
+      late_data_queue = aws_sqs.Queue(self, "LateDataQueue",
+        #XXX: Longer than the timeout of the lambda function, so that no messages are received twice by a run.
+        visibility_timeout=cdk.Duration.minutes(15),
+        retention_period=cdk.Duration.days(4),
+        enforce_ssl=True
+      )
+      s3_bucket = s3.Bucket.from_bucket_name(self, "S3SourceBucket", s3_bucket_name)
+      s3_bucket.add_event_notification(s3.EventType.OBJECT_CREATED,
+        aws_s3_notifications.SqsDestination(late_data_queue),
+        s3.NotificationKeyFilter(prefix=f"{s3_folder_name}/"))
+      lambda_fn_env.update({
+        'LATE_DATA_QUEUE_URL': late_data_queue.queue_url,
+        'LATE_DATA_SETTLE_MINUTES': str(late_data.get("settle_minutes", 15))
+      })
+
+    #XXX: The step_functions orchestration runs the queries of each hour in a state machine with the native Amazon Athena
+    # integration, so that no lambda function is billed while waiting for them.
+    orchestration = self.node.try_get_context("orchestration") or {}
+    orchestration_type = orchestration.get("type", "lambda") # [lambda, step_functions]
+    if orchestration_type not in ('lambda', 'step_functions'):
+      raise ValueError(f'Unknown orchestration type: {orchestration_type}')
+    if orchestration_type == 'step_functions':
+      #XXX: The compaction ledger, the local compaction engine and late data are handled by the lambda function only.
+      if compaction_ledger_type != 'none':
+        raise ValueError('compaction_ledger.type must be none with the step_functions orchestration')
+      if compaction_engine_type != 'athena':
+        raise ValueError('compaction_engine.type must be athena with the step_functions orchestration')
+      if late_data_enabled:
+        raise ValueError('late_data is not supported with the step_functions orchestration')
+
+    #XXX: The lifecycle rule of the raw data in KinesisFirehoseStack applies only to the objects tagged
+    # by the compaction once their rows are verified in the merged files.
+    raw_data_lifecycle = (self.node.try_get_context("firehose") or {}).get("raw_data_lifecycle", {})
+    verify_enabled = raw_data_lifecycle.get("enabled", False) or lambda_fn_env.get('VERIFY_COMPACTION', 'false').lower() == 'true'
+    if verify_enabled:
+      if orchestration_type == 'step_functions':
+        raise ValueError('the compaction is not verified with the step_functions orchestration; disable firehose.raw_data_lifecycle')
+      lambda_fn_env['VERIFY_COMPACTION'] = 'true'
+
+    lambda_memory_size = self.node.try_get_context("lambda_memory_size") or {}
+
     self.s3_json_location, self.s3_parquet_location = (lambda_fn_env['OLD_TABLE_LOCATION_PREFIX'], lambda_fn_env['OUTPUT_PREFIX'])
 
+    #XXX: The daily roll-up merges the hourly files of closed days into a table partitioned by day.
+    daily_rollup = self.node.try_get_context("daily_rollup") or {}
+    daily_rollup_enabled = daily_rollup.get("enabled", False)
+    daily_s3_folder_name = daily_rollup.get("s3_folder_name", f"{_lambda_env['NEW_TABLE_S3_FOLDER_NAME']}-daily")
+    self.s3_daily_location = f"s3://{os.path.join(s3_bucket_name, daily_s3_folder_name)}" if daily_rollup_enabled else None
+
     merge_small_files_lambda_fn = aws_lambda.Function(self, "MergeSmallFiles",
       runtime=aws_lambda.Runtime.PYTHON_3_9,
       function_name="MergeSmallFilesWithAthenaCTAS",
@@ -54,9 +203,19 @@ class MergeSmallFilesLambdaStack(Stack):
       description="Merge small files in S3 with Athena CTAS query",
       code=aws_lambda.Code.from_asset('./src/main/python/MergeSmallFiles'),
       environment=lambda_fn_env,
-      timeout=cdk.Duration.minutes(10)
+      timeout=cdk.Duration.minutes(10),
+      memory_size=lambda_memory_size.get("MergeSmallFilesWithAthenaCTAS", 1024 if compaction_engine_type == 'local' else 128),
+      layers=lambda_layers,
+      #XXX: Runs catching up the same hours must not overlap.
+      reserved_concurrent_executions=1 if compaction_ledger_type != 'none' else None
     )
 
+    if compaction_ledger_table is not None:
+      compaction_ledger_table.grant_read_write_data(merge_small_files_lambda_fn)
+
+    if late_data_queue is not None:
+      late_data_queue.grant_consume_messages(merge_small_files_lambda_fn)
+
     merge_small_files_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
       effect=aws_iam.Effect.ALLOW,
       resources=["*"],
@@ -71,7 +230,28 @@ class MergeSmallFilesLambdaStack(Stack):
         "s3:PutObject",
       ]))
 
-    merge_small_files_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+    if compaction_engine_type == 'local':
+      #XXX: The local engine deletes the files it wrote if it fails in the middle of an hour.
+      merge_small_files_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=[f"arn:aws:s3:::{s3_bucket_name}/{_lambda_env['NEW_TABLE_S3_FOLDER_NAME']}/*"],
+        actions=["s3:DeleteObject"]))
+
+    if verify_enabled:
+      merge_small_files_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=[f"arn:aws:s3:::{s3_bucket_name}/{s3_folder_name}/*"],
+        actions=["s3:PutObjectTagging"]))
+
+    if late_data_enabled or (verify_enabled and compaction_ledger_type != 'none'):
+      #XXX: An hour compacted again replaces its merged files with those in its recompaction location.
+      merge_small_files_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=[f"arn:aws:s3:::{s3_bucket_name}/{_lambda_env['NEW_TABLE_S3_FOLDER_NAME']}/*",
+          f"arn:aws:s3:::{s3_bucket_name}/tmp/recompaction/*"],
+        actions=["s3:DeleteObject"]))
+
+    glue_policy_statement = aws_iam.PolicyStatement(
       effect=aws_iam.Effect.ALLOW,
       resources=["*"],
       actions=["glue:CreateDatabase",
@@ -93,17 +273,43 @@ class MergeSmallFilesLambdaStack(Stack):
         "glue:GetPartition",
         "glue:GetPartitions",
         "glue:BatchGetPartition"
-      ]))
+      ])
+    merge_small_files_lambda_fn.add_to_role_policy(glue_policy_statement)
 
     merge_small_files_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
       effect=aws_iam.Effect.ALLOW,
       resources=["*"],
       actions=["lakeformation:GetDataAccess"]))
 
-    lambda_fn_target = aws_events_targets.LambdaFunction(merge_small_files_lambda_fn)
+    self.job_roles = [merge_small_files_lambda_fn.role]
+
+    if daily_rollup_enabled:
+      daily_rollup_lambda_fn = self.create_daily_rollup_function(dict(lambda_fn_env, **{
+          'DAILY_TABLE_NAME': daily_rollup.get("table_name", f"{_lambda_env['NEW_TABLE_NAME']}_daily"),
+          'DAILY_OUTPUT_PREFIX': self.s3_daily_location,
+          'ROLLUP_DELAY_HOURS': str(daily_rollup.get("delay_hours", 2)),
+          'ROLLUP_DAYS': str(daily_rollup.get("days", 3)),
+          'ROLLUP_GC_GRACE_HOURS': str(daily_rollup.get("gc_grace_hours", 1))
+        }), s3_bucket_name, [_lambda_env['NEW_TABLE_S3_FOLDER_NAME'], daily_s3_folder_name], glue_policy_statement)
+      if compaction_ledger_table is not None:
+        compaction_ledger_table.grant_read_data(daily_rollup_lambda_fn)
+      self.job_roles.append(daily_rollup_lambda_fn.role)
+
+    if orchestration_type == 'step_functions':
+      state_machine = self.create_compaction_state_machine(lambda_fn_env, athena_work_group,
+        s3_bucket_name, _lambda_env['NEW_DATABASE'], glue_policy_statement)
+      self.job_roles.append(state_machine.role)
+      schedule_target = aws_events_targets.SfnStateMachine(state_machine)
+
+      cdk.CfnOutput(self, 'CompactionStateMachineArn',
+        value=state_machine.state_machine_arn,
+        export_name=f'{self.stack_name}-CompactionStateMachineArn')
+    else:
+      schedule_target = aws_events_targets.LambdaFunction(merge_small_files_lambda_fn)
+
     aws_events.Rule(self, "ScheduleRule",
       schedule=aws_events.Schedule.cron(minute="10"),
-      targets=[lambda_fn_target]
+      targets=[schedule_target]
     )
 
     log_group = aws_logs.LogGroup(self, "MergeSmallFilesLogGroup",
@@ -122,3 +328,143 @@ class MergeSmallFilesLambdaStack(Stack):
       value=merge_small_files_lambda_fn.role.role_arn,
       export_name=f'{self.stack_name}-LambdaExecRoleArn')
 
+  def create_daily_rollup_function(self, lambda_fn_env, s3_bucket_name, s3_folder_names, glue_policy_statement):
+    daily_rollup_lambda_fn = aws_lambda.Function(self, "DailyRollup",
+      runtime=aws_lambda.Runtime.PYTHON_3_9,
+      function_name="RollUpMergedFilesDaily",
+      handler="daily_rollup.lambda_handler",
+      description="Roll up the merged files of closed days into a daily table",
+      code=aws_lambda.Code.from_asset('./src/main/python/MergeSmallFiles'),
+      environment=lambda_fn_env,
+      timeout=cdk.Duration.minutes(15),
+      layers=[self.tracing_layer],
+      #XXX: Runs switching and collecting the garbage of the same days must not overlap.
+      reserved_concurrent_executions=1
+    )
+
+    daily_rollup_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["athena:*"]))
+
+    daily_rollup_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["s3:Get*",
+        "s3:List*",
+        "s3:AbortMultipartUpload",
+        "s3:PutObject",
+      ]))
+
+    #XXX: The hourly files rolled up and the previous versions of the days are deleted.
+    daily_rollup_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=[f"arn:aws:s3:::{s3_bucket_name}/{e}/*" for e in s3_folder_names],
+      actions=["s3:DeleteObject"]))
+
+    daily_rollup_lambda_fn.add_to_role_policy(glue_policy_statement)
+
+    daily_rollup_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["lakeformation:GetDataAccess"]))
+
+    aws_events.Rule(self, "DailyRollupScheduleRule",
+      schedule=aws_events.Schedule.cron(minute="40"),
+      targets=[aws_events_targets.LambdaFunction(daily_rollup_lambda_fn)]
+    )
+
+    cdk.CfnOutput(self, 'DailyRollupFuncName',
+      value=daily_rollup_lambda_fn.function_name,
+      export_name=f'{self.stack_name}-DailyRollupFuncName')
+    return daily_rollup_lambda_fn
+
+  def create_compaction_state_machine(self, lambda_fn_env, athena_work_group, s3_bucket_name, database_name, glue_policy_statement):
+    get_queries_lambda_fn = aws_lambda.Function(self, "GetCompactionQueries",
+      runtime=aws_lambda.Runtime.PYTHON_3_9,
+      function_name="GetCompactionQueries",
+      handler="athena_ctas.get_queries_handler",
+      description="Get the Athena queries merging small files of an hour",
+      code=aws_lambda.Code.from_asset('./src/main/python/MergeSmallFiles'),
+      environment=lambda_fn_env,
+      timeout=cdk.Duration.minutes(1),
+      layers=[self.tracing_layer]
+    )
+
+    #XXX: The size-aware planner lists the objects of the hour.
+    get_queries_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["s3:Get*",
+        "s3:List*"
+      ]))
+
+    get_queries = sfn_tasks.LambdaInvoke(self, "GetQueries",
+      lambda_function=get_queries_lambda_fn,
+      payload_response_only=True,
+      result_path="$.queries")
+
+    #XXX: Each query waits for its completion with the .sync integration pattern, so no polling is coded.
+    query_result_location = s3.Location(bucket_name=s3_bucket_name, object_key='tmp/step-functions/')
+
+    prepare_query = sfn_tasks.AthenaStartQueryExecution(self, "RunPrepareQuery",
+      query_string=sfn.JsonPath.string_at("$.QueryString"),
+      work_group=athena_work_group,
+      result_configuration=sfn_tasks.ResultConfiguration(output_location=query_result_location),
+      integration_pattern=sfn.IntegrationPattern.RUN_JOB)
+    prepare_query.add_retry(
+      errors=["Athena.TooManyRequestsException", "States.TaskFailed"],
+      interval=cdk.Duration.seconds(5),
+      max_attempts=3,
+      backoff_rate=2)
+
+    #XXX: Dropping the temporary table of the hour before and adding the partitions to both tables run in parallel.
+    prepare_tables = sfn.Map(self, "PrepareTables",
+      items_path="$.queries.prepare_queries",
+      result_path=sfn.JsonPath.DISCARD)
+    prepare_tables.item_processor(prepare_query)
+
+    #XXX: CTAS is not retried on failure, since it fails again once it has written to its external location.
+    run_ctas = sfn_tasks.AthenaStartQueryExecution(self, "RunCTAS",
+      query_string=sfn.JsonPath.string_at("$.queries.ctas.QueryString"),
+      query_execution_context=sfn_tasks.QueryExecutionContext(database_name=database_name),
+      work_group=athena_work_group,
+      result_configuration=sfn_tasks.ResultConfiguration(output_location=query_result_location),
+      integration_pattern=sfn.IntegrationPattern.RUN_JOB,
+      result_selector={
+        "QueryExecutionId.$": "$.QueryExecution.QueryExecutionId",
+        "Statistics.$": "$.QueryExecution.Statistics"
+      },
+      result_path="$.ctas")
+    run_ctas.add_retry(
+      errors=["Athena.TooManyRequestsException"],
+      interval=cdk.Duration.seconds(5),
+      max_attempts=3,
+      backoff_rate=2)
+
+    definition = get_queries.next(prepare_tables).next(
+      sfn.Choice(self, "IsEmptyHour")
+        .when(sfn.Condition.boolean_equals("$.queries.skip", True), sfn.Succeed(self, "SkipEmptyHour"))
+        .otherwise(run_ctas))
+
+    state_machine = sfn.StateMachine(self, "CompactionStateMachine",
+      state_machine_name="MergeSmallFilesWithAthenaCTAS",
+      definition_body=sfn.DefinitionBody.from_chainable(definition),
+      timeout=cdk.Duration.hours(1))
+
+    #XXX: Queries started by the state machine access the tables and S3 with its role.
+    state_machine.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["s3:Get*",
+        "s3:List*",
+        "s3:AbortMultipartUpload",
+        "s3:PutObject",
+      ]))
+    state_machine.add_to_role_policy(glue_policy_statement)
+    state_machine.add_to_role_policy(aws_iam.PolicyStatement(
+      effect=aws_iam.Effect.ALLOW,
+      resources=["*"],
+      actions=["lakeformation:GetDataAccess"]))
+
+    return state_machine
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import re
+
+#XXX: Partition keys of the access log tables, in the order of the Firehose `prefix`
+PARTITION_KEYS = ['year', 'month', 'day', 'hour']
+
+FIREHOSE_PREFIX_PARTITION = re.compile(r'(\w+)=!\{timestamp:(\w+)\}')
+#XXX: The tenant partition of dynamic partitioning, before the partitions of PARTITION_KEYS
+FIREHOSE_PREFIX_TENANT_PARTITION = re.compile(r'^(\w+)=!\{partitionKeyFromQuery:\w+\}/')
+
+#XXX: Integer projection of each timestamp format of the Firehose `prefix`
+# https://docs.aws.amazon.com/athena/latest/ug/partition-projection-supported-types.html
+PROJECTIONS_BY_TIMESTAMP_FORMAT = {
+  'yyyy': {'type': 'integer'},
+  'MM': {'type': 'integer', 'range': '1,12', 'digits': '2'},
+  'dd': {'type': 'integer', 'range': '1,31', 'digits': '2'},
+  'HH': {'type': 'integer', 'range': '0,23', 'digits': '2'}
+}
+
+
+def get_partition_projection_properties(firehose_prefix, s3_location, year_range, tenant_buckets=0):
+  """Returns the table properties projecting the partitions of the Firehose `prefix` onto a table at `s3_location`.
+
+  e.g. `json-data/year=!{timestamp:yyyy}/month=!{timestamp:MM}/...` is projected
+  onto `{s3_location}/year=${year}/month=${month}/...`
+  The `tenant_bucket` partition of dynamic partitioning is projected onto integers below `tenant_buckets`.
+  """
+  _, _, partition_prefix = firehose_prefix.partition('/')
+  properties = {'projection.enabled': 'true'}
+  tenant_partition = FIREHOSE_PREFIX_TENANT_PARTITION.match(partition_prefix)
+  if tenant_partition:
+    #XXX: A CTAS query reads every tenant of an hour, which an injected projection of tenants cannot enumerate.
+    if tenant_partition.group(1) != 'tenant_bucket' or not tenant_buckets:
+      raise ValueError(f'Only the tenant_bucket partition of dynamic partitioning can be projected: {firehose_prefix}')
+    properties.update({'projection.tenant_bucket.type': 'integer', 'projection.tenant_bucket.range': f'0,{tenant_buckets - 1}'})
+    partition_prefix = FIREHOSE_PREFIX_TENANT_PARTITION.sub('tenant_bucket=${tenant_bucket}/', partition_prefix)
+
+  partitions = FIREHOSE_PREFIX_PARTITION.findall(partition_prefix)
+  if [name for name, _ in partitions] != PARTITION_KEYS:
+    raise ValueError(f'The partitions of the Firehose prefix must be {PARTITION_KEYS}: {firehose_prefix}')
+
+  for name, timestamp_format in partitions:
+    if timestamp_format not in PROJECTIONS_BY_TIMESTAMP_FORMAT:
+      raise ValueError(f'Unsupported timestamp format for partition projection: {name}=!{{timestamp:{timestamp_format}}}')
+    projection = dict(PROJECTIONS_BY_TIMESTAMP_FORMAT[timestamp_format])
+    projection.setdefault('range', year_range)
+    properties.update({f'projection.{name}.{k}': v for k, v in projection.items()})
+
+  location_template = FIREHOSE_PREFIX_PARTITION.sub(lambda m: '{0}=${{{0}}}'.format(m.group(1)), partition_prefix)
+  properties['storage.location.template'] = f'{s3_location}/{location_template}'
+  return properties
+
+
+def to_tblproperties(properties):
+  return 'TBLPROPERTIES (\n{})'.format(',\n'.join(f"  '{k}'='{v}'" for k, v in properties.items()))
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: Athena reads the objects of Firehose by the extension it appends, .gz of GZIP and .snappy of HADOOP_SNAPPY.
+# It cannot read the Snappy framing format of `Snappy`, nor ZIP archives, so the JSON table would return no rows of them.
+# https://docs.aws.amazon.com/athena/latest/ug/compression-formats.html
+COMPRESSION_FORMATS = ('UNCOMPRESSED', 'GZIP', 'HADOOP_SNAPPY')
+UNREADABLE_COMPRESSION_FORMATS = {
+  'Snappy': 'HADOOP_SNAPPY',
+  'ZIP': 'GZIP'
+}
+
+
+def get_compression_format(firehose_config):
+  """Returns the `compression_format` of the Firehose config, UNCOMPRESSED by default.
+
+  Raises ValueError if Athena cannot read the objects compressed with it.
+  """
+  compression_format = firehose_config.get('compression_format', 'UNCOMPRESSED')
+  if compression_format in UNREADABLE_COMPRESSION_FORMATS:
+    raise ValueError(f'Amazon Athena cannot read the raw data compressed with {compression_format};'
+      f' set firehose.compression_format to {UNREADABLE_COMPRESSION_FORMATS[compression_format]}')
+  if compression_format not in COMPRESSION_FORMATS:
+    raise ValueError(f'Unknown firehose compression_format: {compression_format}')
+  #XXX: Firehose compresses the Parquet files it converts with parquet_conversion.compression instead.
+  if compression_format != 'UNCOMPRESSED' and firehose_config.get('parquet_conversion', {}).get('enabled', False):
+    raise ValueError('firehose.compression_format must be UNCOMPRESSED with parquet_conversion;'
+      ' set parquet_conversion.compression instead')
+  return compression_format
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+#XXX: Partition keys of the raw data by tenant, written before the partitions of the Firehose `prefix`.
+# `tenant` is the user of a request, and `tenant_bucket` is a hash of it, for too many tenants to have a partition each.
+TENANT_PARTITION_KEYS = ('tenant', 'tenant_bucket')
+
+#XXX: Firehose writes to up to 500 partitions at a time by default, and sends the records of other partitions
+# to the error output. Both the partitions of the last hour and the current one are written around the hour.
+# https://docs.aws.amazon.com/firehose/latest/dev/dynamic-partitioning.html
+FIREHOSE_ACTIVE_PARTITIONS_QUOTA = 500
+ACTIVE_HOURS = 2
+
+#XXX: Firehose buffers at least 64 MB with dynamic partitioning.
+MIN_BUFFER_SIZE_IN_MBS = 64
+
+#XXX: The partition of the requests without a user, as Firehose cannot write a record with an empty partition key.
+UNKNOWN_TENANT = '_unknown'
+
+#XXX: JQ 1.6 has no hash function, so the tenant bucket is a polynomial hash of the code points of the user,
+# which TENANT_BUCKET_SQL_FMT computes in Athena, too.
+HASH_MULTIPLIER = 31
+HASH_MODULUS = 1000003
+
+TENANT_QUERY = '{tenant: ((.user // "") | if . == "" then "%s" else split("/") | join("_") end)}' % UNKNOWN_TENANT
+TENANT_BUCKET_QUERY_FMT = ('{{tenant_bucket: ((reduce ((.user // "") | explode[]) as $c (0; (. * {multiplier} + $c) % {modulus}))'
+  ' % {tenant_buckets} | tostring)}}')
+TENANT_BUCKET_SQL_FMT = ('''reduce(regexp_extract_all(COALESCE({value}, ''), '.'), 0, (h, c) -> (h * {multiplier} + codepoint(CAST(c AS varchar(1)))) % {modulus},'''
+  ''' h -> h % {tenant_buckets})''')
+
+
+def get_tenant_partitioning(firehose_config):
+  """Returns (partition key, tenant buckets) of the `dynamic_partitioning` of the Firehose config, or ('', 0) if disabled.
+
+  Raises ValueError if the partitions of the tenants may exceed the active partitions of Firehose.
+  """
+  dynamic_partitioning = firehose_config.get('dynamic_partitioning', {})
+  if not dynamic_partitioning.get('enabled', False):
+    return ('', 0)
+
+  partition_key = dynamic_partitioning.get('partition_key', 'tenant')
+  if partition_key not in TENANT_PARTITION_KEYS:
+    raise ValueError(f'Unknown dynamic_partitioning partition_key: {partition_key}')
+  if firehose_config['buffer_size_in_mbs'] < MIN_BUFFER_SIZE_IN_MBS:
+    raise ValueError(f'buffer_size_in_mbs must be at least {MIN_BUFFER_SIZE_IN_MBS} with dynamic_partitioning')
+
+  max_partitions = FIREHOSE_ACTIVE_PARTITIONS_QUOTA // ACTIVE_HOURS
+  if partition_key == 'tenant':
+    expected_tenants = int(dynamic_partitioning.get('expected_tenants', 0))
+    if expected_tenants > max_partitions:
+      raise ValueError(f'{expected_tenants} tenants may exceed the {FIREHOSE_ACTIVE_PARTITIONS_QUOTA} active partitions'
+        f' of Firehose; set dynamic_partitioning.partition_key to tenant_bucket')
+    return (partition_key, 0)
+
+  tenant_buckets = int(dynamic_partitioning.get('tenant_buckets', 64))
+  if not 0 < tenant_buckets <= max_partitions:
+    raise ValueError(f'dynamic_partitioning.tenant_buckets must be from 1 to {max_partitions}')
+  return (partition_key, tenant_buckets)
+
+
+def get_firehose_prefix(firehose_config):
+  """Returns the Firehose `prefix` with the tenant partition before its other partitions,
+  e.g. `json-data/tenant=!{partitionKeyFromQuery:tenant}/year=!{timestamp:yyyy}/...`
+  """
+  partition_key, _ = get_tenant_partitioning(firehose_config)
+  if not partition_key:
+    return firehose_config['prefix']
+  folder, _, partition_prefix = firehose_config['prefix'].partition('/')
+  return f'{folder}/{partition_key}=!{{partitionKeyFromQuery:{partition_key}}}/{partition_prefix}'
+
+
+def get_metadata_extraction_query(partition_key, tenant_buckets):
+  """Returns the JQ query extracting the tenant partition key from a record."""
+  if partition_key == 'tenant':
+    return TENANT_QUERY
+  return TENANT_BUCKET_QUERY_FMT.format(multiplier=HASH_MULTIPLIER, modulus=HASH_MODULUS, tenant_buckets=tenant_buckets)
+
+
+def get_tenant_bucket(user, tenant_buckets):
+  """Returns the tenant bucket of a user, which the JQ query of Firehose writes its requests under."""
+  h = 0
+  for c in user or '':
+    h = (h * HASH_MULTIPLIER + ord(c)) % HASH_MODULUS
+  return h % tenant_buckets
+
+
+def get_tenant_bucket_sql(tenant_buckets, value='"user"'):
+  """Returns the SQL expression of the tenant bucket of `value`, e.g. of a user to read the partition of its tenant only."""
+  return TENANT_BUCKET_SQL_FMT.format(multiplier=HASH_MULTIPLIER, modulus=HASH_MODULUS, tenant_buckets=tenant_buckets,
+    value=value)
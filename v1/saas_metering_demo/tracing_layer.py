@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import os
+
+from aws_cdk import aws_lambda
+
+#XXX: tracing.py is shared by the lambda functions of every version of this demo,
+# so it is shipped once in a Lambda Layer instead of being copied into each function.
+TRACING_LAYER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../lambda_layers/tracing')
+
+
+def create_tracing_layer(scope, runtime):
+  """Returns the Lambda Layer of tracing.py for the lambda functions of `scope`."""
+  return aws_lambda.LayerVersion(scope, "TracingLayer",
+    code=aws_lambda.Code.from_asset(TRACING_LAYER_PATH),
+    compatible_runtimes=[runtime],
+    description="Sampled span tracing of the lambda functions")
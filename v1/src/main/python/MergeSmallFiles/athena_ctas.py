@@ -4,11 +4,26 @@
 
 import sys
 import os
+import asyncio
+import collections
+import concurrent.futures
 import datetime
+import itertools
+import json
+import math
+import statistics
 import time
 import random
 
 import boto3
+import botocore.exceptions
+
+import compaction_ledger
+import compaction_planner
+import compaction_verifier
+import json_to_parquet
+import late_data
+import tracing
 
 random.seed(47)
 
@@ -24,6 +39,129 @@ OLD_TABLE_LOCATION_PREFIX = os.getenv('OLD_TABLE_LOCATION_PREFIX')
 OUTPUT_PREFIX = os.getenv('OUTPUT_PREFIX')
 STAGING_OUTPUT_PREFIX = os.getenv('STAGING_OUTPUT_PREFIX')
 COLUMN_NAMES = os.getenv('COLUMN_NAMES', '*')
+QUERY_POLL_INITIAL_DELAY = float(os.getenv('QUERY_POLL_INITIAL_DELAY', '0.5'))
+QUERY_POLL_MAX_DELAY = float(os.getenv('QUERY_POLL_MAX_DELAY', '5'))
+PARTITION_REGISTRAR = os.getenv('PARTITION_REGISTRAR', 'glue') # [glue, athena]
+PARTITION_PROJECTION = (os.getenv('PARTITION_PROJECTION', 'false').lower() == 'true')
+COMPACTION_LEDGER = os.getenv('COMPACTION_LEDGER', '') # [dynamodb://{table}, s3://{bucket}/{prefix}, {local file path}]
+CATCH_UP_HOURS = int(os.getenv('CATCH_UP_HOURS', '24'))
+MAX_CONCURRENT_QUERIES = int(os.getenv('MAX_CONCURRENT_QUERIES', '5'))
+SIZE_AWARE_PLANNING = (os.getenv('SIZE_AWARE_PLANNING', 'false').lower() == 'true')
+TARGET_FILE_SIZE_MB = float(os.getenv('TARGET_FILE_SIZE_MB', '128'))
+BUCKET_COLUMN = os.getenv('BUCKET_COLUMN', 'requestId')
+#XXX: Columns to sort merged files by, e.g. user,requestTime for queries filtering on the tenant
+CLUSTER_BY = [e.strip() for e in os.getenv('CLUSTER_BY', '').split(',') if e.strip()]
+#XXX: The format of the objects of the source table, parquet if Firehose converts the records with the schema of the new table
+SOURCE_FORMAT = os.getenv('SOURCE_FORMAT', 'json') # [json, parquet]
+#XXX: The compression format of the JSON objects of Firehose, which Athena decompresses by their extensions
+SOURCE_COMPRESSION = os.getenv('SOURCE_COMPRESSION', 'UNCOMPRESSED') # [UNCOMPRESSED, GZIP, HADOOP_SNAPPY]
+#XXX: The ratio of Parquet bytes to JSON bytes, until the ledger records compacted hours
+PARQUET_TO_JSON_RATIO = float(os.getenv('PARQUET_TO_JSON_RATIO', '0.2'))
+#XXX: The ratios of Parquet bytes to compressed JSON bytes, measured by benchmarks/raw_compression_benchmark.py
+PARQUET_TO_GZIP_RATIO = float(os.getenv('PARQUET_TO_GZIP_RATIO', '1.2'))
+PARQUET_TO_HADOOP_SNAPPY_RATIO = float(os.getenv('PARQUET_TO_HADOOP_SNAPPY_RATIO', '0.7'))
+#XXX: The ratio of merged Parquet bytes to the Parquet bytes converted by Firehose, which only lose the footers of small files
+PARQUET_TO_PARQUET_RATIO = float(os.getenv('PARQUET_TO_PARQUET_RATIO', '1.0'))
+COMPACTION_ENGINE = os.getenv('COMPACTION_ENGINE', 'athena') # [athena, local]
+PARQUET_COMPRESSION = os.getenv('PARQUET_COMPRESSION', 'SNAPPY').upper() # [SNAPPY, ZSTD, GZIP]
+#XXX: The codec's default level if empty. Athena applies it to ZSTD only.
+PARQUET_COMPRESSION_LEVEL = int(os.getenv('PARQUET_COMPRESSION_LEVEL') or '0') or None
+PARQUET_ROW_GROUP_ROWS = int(os.getenv('PARQUET_ROW_GROUP_ROWS', '500000'))
+LOCAL_ENGINE_IO_THREADS = int(os.getenv('LOCAL_ENGINE_IO_THREADS', '8'))
+LOCAL_ENGINE_MAX_PREFETCH_MB = int(os.getenv('LOCAL_ENGINE_MAX_PREFETCH_MB', '64'))
+LOCAL_ENGINE_MAX_SORT_ROWS = int(os.getenv('LOCAL_ENGINE_MAX_SORT_ROWS', '1000000'))
+#XXX: A local directory standing in for Amazon S3 to run the local engine on a laptop
+LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT', '')
+EMIT_METRICS = (os.getenv('EMIT_METRICS', 'false').lower() == 'true')
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'SaaSMetering/Compaction')
+#XXX: USD per TB of data scanned, https://aws.amazon.com/athena/pricing/
+ATHENA_PRICE_PER_TB = float(os.getenv('ATHENA_PRICE_PER_TB', '5.0'))
+#XXX: An hour is flagged if its queries take this many times the median of similar hours; 0 to disable.
+REGRESSION_THRESHOLD = float(os.getenv('REGRESSION_THRESHOLD', '2.0'))
+#XXX: The SQS queue of the S3 event notifications of the objects created under OLD_TABLE_LOCATION_PREFIX
+LATE_DATA_QUEUE_URL = os.getenv('LATE_DATA_QUEUE_URL', '')
+#XXX: A dirty hour is compacted again once no late objects have arrived for this long, so that a burst costs one query.
+LATE_DATA_SETTLE_MINUTES = float(os.getenv('LATE_DATA_SETTLE_MINUTES', '15'))
+LATE_DATA_MAX_MESSAGES = int(os.getenv('LATE_DATA_MAX_MESSAGES', '10000'))
+#XXX: Compare the rows of each compacted hour with its objects, and tag the objects of the verified hours
+# for the lifecycle rule of the raw data to expire them.
+VERIFY_COMPACTION = (os.getenv('VERIFY_COMPACTION', 'false').lower() == 'true')
+#XXX: A mismatched hour is compacted again this many times before it is recorded as MISMATCHED.
+VERIFY_MAX_RECOMPACTIONS = int(os.getenv('VERIFY_MAX_RECOMPACTIONS', '1'))
+#XXX: The partition key of the tenants before the hourly partitions of the source table, written by Firehose with dynamic partitioning
+TENANT_PARTITION_KEY = os.getenv('TENANT_PARTITION_KEY', '') # [tenant, tenant_bucket]
+#XXX: Warn of more tenant partitions than Firehose writes at a time, beyond which their records go to the error output.
+MAX_TENANT_PARTITIONS = int(os.getenv('MAX_TENANT_PARTITIONS', '500'))
+
+#XXX: Seconds to stop waiting for a query before the lambda function times out
+QUERY_WAIT_MARGIN = 10
+
+#XXX: Errors of StartQueryExecution retried with backoff, e.g. when the workgroup reaches its active query quota
+THROTTLING_ERROR_CODES = ('TooManyRequestsException', 'ThrottlingException')
+QUERY_START_MAX_RETRIES = int(os.getenv('QUERY_START_MAX_RETRIES', '8'))
+THROTTLED_QUERY_STARTS = collections.Counter()
+#XXX: A private unseeded random generator for the backoff jitter, so that the containers do not
+# retry throttled queries in lockstep with the same sequence of the global random generator seeded above.
+_JITTER = random.Random()
+
+#XXX: A semaphore bounding the number of active queries, set while a backfill is running
+QUERY_SLOTS = None
+
+BACKFILL_HOUR_FMT = compaction_ledger.HOUR_FMT
+
+#XXX: The tag of the objects of VERIFIED hours, which the lifecycle rule of the raw data in KinesisFirehoseStack filters by
+VERIFIED_TAGS = {'compaction': 'verified'}
+
+#XXX: Threads copying the files of an hour compacted again into its output location
+MAX_COPY_THREADS = 16
+#XXX: The timeout of a lambda function can be up to 15 minutes.
+MAX_COMPACTION_SECONDS = 900
+
+#XXX: BatchCreatePartition of AWS Glue creates up to 100 partitions at a time.
+GLUE_PARTITION_BATCH_SIZE = 100
+
+#XXX: Athena bills the data scanned by a query, rounded up to a megabyte, with a minimum of 10 MB.
+MIN_BILLED_BYTES = 10 * 1024**2
+
+#XXX: (metric name, unit, key of the Statistics of a query execution)
+QUERY_METRICS = [
+  ('DataScannedInBytes', 'Bytes', 'DataScannedInBytes'),
+  ('EngineExecutionTime', 'Milliseconds', 'EngineExecutionTimeInMillis'),
+  ('QueryQueueTime', 'Milliseconds', 'QueryQueueTimeInMillis'),
+  ('QueryPlanningTime', 'Milliseconds', 'QueryPlanningTimeInMillis'),
+  ('ServiceProcessingTime', 'Milliseconds', 'ServiceProcessingTimeInMillis'),
+  ('TotalExecutionTime', 'Milliseconds', 'TotalExecutionTimeInMillis')
+]
+QUERY_METRIC_DEFINITIONS = [{'Name': name, 'Unit': unit} for name, unit, _ in QUERY_METRICS] + [{'Name': 'Cost', 'Unit': 'None'}]
+
+#XXX: (metric name, unit, key of the summary of an hour)
+HOUR_METRICS = [
+  ('CompactionQueries', 'Count', 'queries'),
+  ('CompactionDataScannedInBytes', 'Bytes', 'query_data_scanned_bytes'),
+  ('CompactionCost', 'None', 'query_cost_usd'),
+  ('CompactionQueryQueueTime', 'Milliseconds', 'query_queue_ms'),
+  ('CompactionEngineExecutionTime', 'Milliseconds', 'query_engine_ms'),
+  ('CompactionRegressions', 'Count', 'num_regressions')
+]
+HOUR_METRIC_DEFINITIONS = [{'Name': name, 'Unit': unit} for name, unit, _ in HOUR_METRICS]
+
+#XXX: Keys of the summary of an hour compared with the hours of similar input bytes to flag regressions
+REGRESSION_KEYS = ['query_engine_ms', 'query_queue_ms', 'query_data_scanned_bytes', 'query_cost_usd']
+MIN_REGRESSION_BASELINE = 3
+
+#XXX: The statistics of the queries finished by an invocation or a backfill, tagged by statement and hour
+QUERY_STATISTICS = []
+
+#XXX: One client is shared by the queries running concurrently and by the invocations of a warm container.
+ATHENA_CLIENT = None
+GLUE_CLIENT = None
+S3_CLIENT = None
+SQS_CLIENT = None
+LEDGER = None
+
+#XXX: Partition values known to be registered by (database, table), kept across invocations of a warm container
+KNOWN_PARTITIONS = collections.defaultdict(set)
+TABLE_STORAGE_DESCRIPTORS = {}
 
 EXTERNAL_LOCATION_FMT = '''{output_prefix}/year={year}/month={month:02}/day={day:02}/hour={hour:02}/'''
 
@@ -31,14 +169,103 @@ CTAS_QUERY_FMT = '''CREATE TABLE {new_database}.tmp_{new_table_name}
 WITH (
   external_location='{location}',
   format = 'PARQUET',
-  parquet_compression = 'SNAPPY')
+  write_compression = '{compression}'{compression_level}{bucketing})
 AS SELECT {columns}
 FROM {old_database}.{old_table_name}
-WHERE year={year} AND month={month} AND day={day} AND hour={hour}
+WHERE year={year} AND month={month} AND day={day} AND hour={hour}{order_by}
 WITH DATA
 '''
 
-def run_alter_table_add_partition(athena_client, basic_dt, database_name, table_name, output_prefix):
+BUCKETING_FMT = ''',
+  bucketed_by = ARRAY['{column}'],
+  bucket_count = {bucket_count}'''
+
+COMPRESSION_LEVEL_FMT = ''',
+  compression_level = {level}'''
+
+ORDER_BY_FMT = '''
+ORDER BY {columns}'''
+
+
+class AthenaQueryError(Exception):
+  def __init__(self, query_execution_id, state, reason, query_execution=None):
+    super().__init__('Query {} {}: {}'.format(query_execution_id, state, reason))
+    self.query_execution_id = query_execution_id
+    self.state = state
+    self.reason = reason
+    self.query_execution = query_execution
+
+
+class PartitionRegistrationError(Exception):
+  pass
+
+
+class CompactionError(Exception):
+  pass
+
+
+def get_athena_client():
+  global ATHENA_CLIENT
+
+  if ATHENA_CLIENT is None:
+    ATHENA_CLIENT = boto3.client('athena', region_name=AWS_REGION)
+  return ATHENA_CLIENT
+
+
+def get_glue_client():
+  global GLUE_CLIENT
+
+  if GLUE_CLIENT is None:
+    GLUE_CLIENT = boto3.client('glue', region_name=AWS_REGION)
+  return GLUE_CLIENT
+
+
+def get_s3_client():
+  global S3_CLIENT
+
+  if S3_CLIENT is None:
+    S3_CLIENT = boto3.client('s3', region_name=AWS_REGION)
+  return S3_CLIENT
+
+
+def get_sqs_client():
+  global SQS_CLIENT
+
+  if SQS_CLIENT is None:
+    SQS_CLIENT = boto3.client('sqs', region_name=AWS_REGION)
+  return SQS_CLIENT
+
+
+def get_storage():
+  if LOCAL_STORAGE_ROOT:
+    return json_to_parquet.LocalStorage(LOCAL_STORAGE_ROOT)
+  return json_to_parquet.S3Storage(get_s3_client())
+
+
+def get_tenant_location(location_prefix, tenant):
+  return '{}/{}={}'.format(location_prefix, TENANT_PARTITION_KEY, tenant)
+
+
+def get_partitions(basic_dt, output_prefix, tenants=None):
+  """Returns (values, location) of the partitions of an hour and its neighbours.
+
+  With `tenants`, returns those of the hour of each tenant instead, whose values start with the tenant.
+  """
+  if tenants is not None:
+    values = (str(basic_dt.year), str(basic_dt.month), str(basic_dt.day), str(basic_dt.hour))
+    return [((tenant,) + values, get_hour_location(get_tenant_location(output_prefix, tenant), basic_dt)) for tenant in tenants]
+
+  partitions = []
+  for i in (1, 0, -1):
+    dt = basic_dt - datetime.timedelta(hours=i)
+    values = (str(dt.year), str(dt.month), str(dt.day), str(dt.hour))
+    partitions.append((values, get_hour_location(output_prefix, dt)))
+  return partitions
+
+
+def get_alter_table_add_partition_query(basic_dt, database_name, table_name, output_prefix, tenants=None):
+  """Returns the query adding the partitions of an hour and its neighbours to a table, or those of the hour
+  of each of `tenants`, and its output location."""
   year, month, day, hour = (basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour)
 
   tmp_table_name = '{table}_{year}{month:02}{day:02}{hour:02}'.format(table=table_name,
@@ -49,22 +276,30 @@ def run_alter_table_add_partition(athena_client, basic_dt, database_name, table_
   alter_table_stmt = '''ALTER TABLE {database}.{table_name} ADD IF NOT EXISTS'''.format(database=database_name,
     table_name=table_name)
 
-  partition_expr = '''PARTITION (year={year}, month={month}, day={day}, hour={hour}) LOCATION "{output_prefix}/year={year}/month={month:02}/day={day:02}/hour={hour:02}/"'''
+  partition_expr = '''PARTITION ({partition_spec}) LOCATION "{location}"'''
+  partition_keys = ([TENANT_PARTITION_KEY] if tenants is not None else []) + ['year', 'month', 'day', 'hour']
 
   partition_expr_list = []
-  for i in (1, 0, -1):
-     dt = basic_dt - datetime.timedelta(hours=i)
-     year, month, day, hour = (dt.year, dt.month, dt.day, dt.hour)
-     part_expr = partition_expr.format(year=year, month=month, day=day, hour=hour, output_prefix=output_prefix)
-     partition_expr_list.append(part_expr)
+  for values, location in get_partitions(basic_dt, output_prefix, tenants=tenants):
+    #XXX: The values of the tenant partition are strings, even if a tenant looks like a number,
+    # and those of tenant_bucket and the hourly partitions are integers.
+    partition_spec = ', '.join('{}={}'.format(key, "'{}'".format(value.replace("'", "''")) if key == 'tenant' else value)
+      for key, value in zip(partition_keys, values))
+    partition_expr_list.append(partition_expr.format(partition_spec=partition_spec, location=location))
 
   query = '{} {}'.format(alter_table_stmt, '\n'.join(partition_expr_list))
+  return (query, output_location)
+
+
+def run_alter_table_add_partition(athena_client, basic_dt, database_name, table_name, output_prefix, tenants=None):
+  query, output_location = get_alter_table_add_partition_query(basic_dt, database_name, table_name, output_prefix,
+    tenants=tenants)
   print('[INFO] QueryString:\n{}'.format(query), file=sys.stderr)
   print('[INFO] OutputLocation: {}'.format(output_location), file=sys.stderr)
 
   if DRY_RUN:
     print('[INFO] End of dry-run', file=sys.stderr)
-    return
+    return None
 
   response = athena_client.start_query_execution(
     QueryString=query,
@@ -74,9 +309,65 @@ def run_alter_table_add_partition(athena_client, basic_dt, database_name, table_
     WorkGroup=WORK_GROUP
   )
   print('[INFO] QueryExecutionId: {}'.format(response['QueryExecutionId']), file=sys.stderr)
+  return response['QueryExecutionId']
 
 
-def run_drop_tmp_table(athena_client, basic_dt):
+def get_table_storage_descriptor(glue_client, database_name, table_name):
+  key = (database_name, table_name)
+  if key not in TABLE_STORAGE_DESCRIPTORS:
+    response = glue_client.get_table(DatabaseName=database_name, Name=table_name)
+    TABLE_STORAGE_DESCRIPTORS[key] = response['Table']['StorageDescriptor']
+  return TABLE_STORAGE_DESCRIPTORS[key]
+
+
+def run_batch_create_partition(glue_client, basic_dt, database_name, table_name, output_prefix, tenants=None):
+  """Registers the same partitions as `run_alter_table_add_partition` through AWS Glue. Returns the number of new partitions.
+
+  Partitions known to exist in a warm container are skipped without calling AWS Glue.
+  """
+  known_partitions = KNOWN_PARTITIONS[(database_name, table_name)]
+
+  partitions = [(values, location) for values, location in get_partitions(basic_dt, output_prefix, tenants=tenants)
+    if values not in known_partitions]
+
+  if not partitions:
+    print('[INFO] Partitions are already registered in {}.{}'.format(database_name, table_name), file=sys.stderr)
+    return 0
+
+  print('[INFO] Partitions to register in {}.{}: {}'.format(database_name, table_name,
+    [location for _, location in partitions]), file=sys.stderr)
+
+  if DRY_RUN:
+    print('[INFO] End of dry-run', file=sys.stderr)
+    return 0
+
+  #XXX: The hour of every tenant may be more partitions than a call of AWS Glue takes.
+  for i in range(0, len(partitions), GLUE_PARTITION_BATCH_SIZE):
+    response = glue_client.batch_get_partition(DatabaseName=database_name, TableName=table_name,
+      PartitionsToGet=[{'Values': list(values)} for values, _ in partitions[i:i + GLUE_PARTITION_BATCH_SIZE]])
+    known_partitions.update(tuple(e['Values']) for e in response['Partitions'])
+
+  partitions = [(values, location) for values, location in partitions if values not in known_partitions]
+  if not partitions:
+    return 0
+
+  storage_descriptor = get_table_storage_descriptor(glue_client, database_name, table_name)
+  errors = []
+  for i in range(0, len(partitions), GLUE_PARTITION_BATCH_SIZE):
+    response = glue_client.batch_create_partition(DatabaseName=database_name, TableName=table_name,
+      PartitionInputList=[{'Values': list(values), 'StorageDescriptor': dict(storage_descriptor, Location=location)}
+        for values, location in partitions[i:i + GLUE_PARTITION_BATCH_SIZE]])
+    errors.extend(e for e in response.get('Errors', []) if e['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException')
+  if errors:
+    raise PartitionRegistrationError('Failed to create partitions in {}.{}: {}'.format(database_name, table_name,
+      ['{}: {}'.format(e['PartitionValues'], e['ErrorDetail'].get('ErrorMessage', e['ErrorDetail']['ErrorCode'])) for e in errors]))
+
+  known_partitions.update(values for values, _ in partitions)
+  print('[INFO] Registered {} partitions in {}.{}'.format(len(partitions), database_name, table_name), file=sys.stderr)
+  return len(partitions)
+
+
+def get_drop_tmp_table_query(basic_dt):
   year, month, day, hour = (basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour)
 
   tmp_table_name = '{table}_{year}{month:02}{day:02}{hour:02}'.format(table=NEW_TABLE_NAME,
@@ -85,13 +376,17 @@ def run_drop_tmp_table(athena_client, basic_dt):
   output_location = '{}/tmp_{}'.format(STAGING_OUTPUT_PREFIX, tmp_table_name)
   query = 'DROP TABLE IF EXISTS {database}.tmp_{table_name}'.format(database=NEW_DATABASE,
       table_name=tmp_table_name)
+  return (query, output_location)
 
+
+def run_drop_tmp_table(athena_client, basic_dt):
+  query, output_location = get_drop_tmp_table_query(basic_dt)
   print('[INFO] QueryString:\n{}'.format(query), file=sys.stderr)
   print('[INFO] OutputLocation: {}'.format(output_location), file=sys.stderr)
 
   if DRY_RUN:
     print('[INFO] End of dry-run', file=sys.stderr)
-    return
+    return None
 
   response = athena_client.start_query_execution(
     QueryString=query,
@@ -101,29 +396,55 @@ def run_drop_tmp_table(athena_client, basic_dt):
     WorkGroup=WORK_GROUP
   )
   print('[INFO] QueryExecutionId: {}'.format(response['QueryExecutionId']), file=sys.stderr)
+  return response['QueryExecutionId']
+
 
+def get_bucket_column():
+  """Returns the column to bucket merged files by: the first column of CLUSTER_BY if it is set, or BUCKET_COLUMN."""
+  #XXX: Buckets by the hash of requestId would spread the rows of every tenant over every file of the hour.
+  return CLUSTER_BY[0] if CLUSTER_BY else BUCKET_COLUMN
 
-def run_ctas(athena_client, basic_dt):
+
+def get_ctas_query(basic_dt, plan=None, external_location=None):
+  """Returns the CTAS query of an hour, its output location and the external location of its files."""
   year, month, day, hour = (basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour)
 
   new_table_name = '{table}_{year}{month:02}{day:02}{hour:02}'.format(table=NEW_TABLE_NAME,
     year=year, month=month, day=day, hour=hour)
 
   output_location = '{}/tmp_{}'.format(STAGING_OUTPUT_PREFIX, new_table_name)
-  external_location = EXTERNAL_LOCATION_FMT.format(output_prefix=OUTPUT_PREFIX,
+  #XXX: An hour compacted again is written to its recompaction location first.
+  external_location = external_location or EXTERNAL_LOCATION_FMT.format(output_prefix=OUTPUT_PREFIX,
     year=year, month=month, day=day, hour=hour)
 
+  #XXX: Without a plan, or for an hour predicted to fit in a single file, Athena chooses the number of files.
+  bucketing = BUCKETING_FMT.format(column=get_bucket_column(),
+    bucket_count=plan['bucket_count']) if plan and plan['bucket_count'] > 1 else ''
+  #XXX: Sorted rows let the statistics of row groups skip the rows of other values of the first column.
+  order_by = ORDER_BY_FMT.format(columns=', '.join(CLUSTER_BY)) if CLUSTER_BY else ''
+  compression_level = ''
+  if PARQUET_COMPRESSION_LEVEL is not None:
+    if PARQUET_COMPRESSION == 'ZSTD':
+      compression_level = COMPRESSION_LEVEL_FMT.format(level=PARQUET_COMPRESSION_LEVEL)
+    else:
+      print('[WARNING] Athena ignores the compression level of {}'.format(PARQUET_COMPRESSION), file=sys.stderr)
+
   query = CTAS_QUERY_FMT.format(new_database=NEW_DATABASE, new_table_name=new_table_name,
     old_database=OLD_DATABASE, old_table_name=OLD_TABLE_NAME, columns=COLUMN_NAMES,
-    year=year, month=month, day=day, hour=hour, location=external_location)
+    year=year, month=month, day=day, hour=hour, location=external_location, bucketing=bucketing,
+    order_by=order_by, compression=PARQUET_COMPRESSION, compression_level=compression_level)
+  return (query, output_location, external_location)
+
 
+def run_ctas(athena_client, basic_dt, plan=None, external_location=None):
+  query, output_location, external_location = get_ctas_query(basic_dt, plan=plan, external_location=external_location)
   print('[INFO] QueryString:\n{}'.format(query), file=sys.stderr)
   print('[INFO] ExternalLocation: {}'.format(external_location), file=sys.stderr)
   print('[INFO] OutputLocation: {}'.format(output_location), file=sys.stderr)
 
   if DRY_RUN:
     print('[INFO] End of dry-run', file=sys.stderr)
-    return
+    return None
 
   response = athena_client.start_query_execution(
     QueryString=query,
@@ -136,38 +457,934 @@ def run_ctas(athena_client, basic_dt):
     WorkGroup=WORK_GROUP
   )
   print('[INFO] QueryExecutionId: {}'.format(response['QueryExecutionId']), file=sys.stderr)
+  return response['QueryExecutionId']
+
+
+def get_hour_location(location_prefix, basic_dt):
+  return EXTERNAL_LOCATION_FMT.format(output_prefix=location_prefix,
+    year=basic_dt.year, month=basic_dt.month, day=basic_dt.day, hour=basic_dt.hour)
+
+
+def get_recompaction_location(basic_dt):
+  return get_hour_location('{}/recompaction/{}'.format(STAGING_OUTPUT_PREFIX, NEW_TABLE_NAME), basic_dt)
+
+
+def delete_location(s3_location):
+  storage = get_storage()
+  storage.delete([e for e, _ in storage.list(s3_location)])
+
+
+def replace_hour_output(basic_dt):
+  """Replaces the merged files of an hour, if any, with the files compacted into its recompaction location.
+  Returns the number of files replaced.
+
+  The new files are copied before the old ones are deleted, so a query in between may read both for a moment,
+  but never misses the hour. The names of the files are unique to each query or run, so it can be run again
+  after it stopped in the middle.
+  """
+  storage = get_storage()
+  staging_location, hour_location = (get_recompaction_location(basic_dt), get_hour_location(OUTPUT_PREFIX, basic_dt))
+  new_files = [e for e, _ in storage.list(staging_location)]
+  if not new_files:
+    print('[WARNING] No files to replace the merged files of {} with: {}'.format(basic_dt.strftime(BACKFILL_HOUR_FMT),
+      staging_location), file=sys.stderr)
+    return 0
+
+  names = [e[len(staging_location):] for e in new_files]
+  old_files = [e for e, _ in storage.list(hour_location) if e[len(hour_location):] not in names]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_COPY_THREADS) as executor:
+    list(executor.map(storage.copy, new_files, [hour_location + e for e in names]))
+  storage.delete(old_files)
+  storage.delete(new_files)
+  print('[INFO] Replaced {} merged files of {} with {} files'.format(len(old_files), basic_dt.strftime(BACKFILL_HOUR_FMT),
+    len(new_files)), file=sys.stderr)
+  return len(old_files)
+
+
+def list_location(s3_location):
+  """Returns the number and bytes of the objects under an S3 location, listing a page of up to 1000 objects at a time."""
+  objects = get_storage().list(s3_location)
+  return (len(objects), sum(size for _, size in objects))
+
 
+def list_tenant_locations():
+  """Returns the locations of the tenant partitions under OLD_TABLE_LOCATION_PREFIX, e.g. s3://{bucket}/json-data/tenant=alice"""
+  prefixes = get_storage().list_prefixes(get_tenant_location(OLD_TABLE_LOCATION_PREFIX, ''))
+  if len(prefixes) > MAX_TENANT_PARTITIONS:
+    print('[WARNING] {} tenant partitions are more than the {} partitions Firehose writes at a time;'
+      ' partition by tenant_bucket instead of tenant'.format(len(prefixes), MAX_TENANT_PARTITIONS), file=sys.stderr)
+  return [e.rstrip('/') for e in prefixes]
+
+
+def get_source_hour_locations(basic_dt, tenant_locations=None):
+  """Returns the locations of the objects of an hour of the source table, one per tenant partition with TENANT_PARTITION_KEY."""
+  if not TENANT_PARTITION_KEY:
+    return [get_hour_location(OLD_TABLE_LOCATION_PREFIX, basic_dt)]
+  if tenant_locations is None:
+    tenant_locations = list_tenant_locations()
+  return [get_hour_location(e, basic_dt) for e in tenant_locations]
+
+
+def list_source_hour(basic_dt, tenant_locations=None, modified=False):
+  """Returns (location, size) of the objects of an hour of the source table, or (location, size, last modified time)
+  if `modified` is set. The hour of each tenant partition is listed concurrently."""
+  storage = get_storage()
+  list_fn = storage.list_modified if modified else storage.list
+  locations = get_source_hour_locations(basic_dt, tenant_locations=tenant_locations)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_COPY_THREADS) as executor:
+    return list(itertools.chain.from_iterable(executor.map(list_fn, locations)))
+
+
+def list_source_hour_tenants(basic_dt):
+  """Returns the tenants with objects in an hour of the source table, e.g. the partitions for CTAS to read."""
+  prefix = get_tenant_location(OLD_TABLE_LOCATION_PREFIX, '')
+  return sorted({e[len(prefix):].split('/', 1)[0] for e, _ in list_source_hour(basic_dt)})
+
+
+def get_default_ratio():
+  if SOURCE_FORMAT == 'parquet':
+    return PARQUET_TO_PARQUET_RATIO
+  return {'GZIP': PARQUET_TO_GZIP_RATIO, 'HADOOP_SNAPPY': PARQUET_TO_HADOOP_SNAPPY_RATIO}.get(SOURCE_COMPRESSION,
+    PARQUET_TO_JSON_RATIO)
+
+
+async def plan_hours(basic_dts, ratio=None):
+  """Lists the objects of the hours under OLD_TABLE_LOCATION_PREFIX concurrently, and returns the plan of each hour.
+
+  The plan of an hour is None if its objects cannot be listed, and then Athena chooses the number of files.
+  """
+  with tracing.span('plan_hours', hours=len(basic_dts)):
+    tenant_locations = None
+    if TENANT_PARTITION_KEY:
+      #XXX: The tenant partitions are listed once for all the hours.
+      try:
+        tenant_locations = await asyncio.to_thread(list_tenant_locations)
+      except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as ex:
+        print('[WARNING] Failed to list the tenant partitions of {}: {}'.format(OLD_TABLE_LOCATION_PREFIX, ex), file=sys.stderr)
+        return {e.strftime(BACKFILL_HOUR_FMT): None for e in basic_dts}
+    results = await asyncio.gather(*[asyncio.to_thread(list_source_hour, e, tenant_locations) for e in basic_dts],
+      return_exceptions=True)
+
+  plans = {}
+  for basic_dt, result in zip(basic_dts, results):
+    hour = basic_dt.strftime(BACKFILL_HOUR_FMT)
+    if isinstance(result, (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError)):
+      print('[WARNING] Failed to list the objects of {}: {}'.format(hour, result), file=sys.stderr)
+      plans[hour] = None
+      continue
+    elif isinstance(result, BaseException):
+      raise result
+
+    plans[hour] = compaction_planner.plan_hour(hour, len(result), sum(size for _, size in result),
+      get_default_ratio() if ratio is None else ratio, TARGET_FILE_SIZE_MB)
+    compaction_planner.log_plan(plans[hour])
+  return plans
+
+
+async def wait_for_query(athena_client, query_execution_id, deadline=None):
+  """Polls the state of a query with exponential backoff until it succeeds. Raises AthenaQueryError if it fails."""
+  delay = QUERY_POLL_INITIAL_DELAY
+  while True:
+    response = await asyncio.to_thread(athena_client.get_query_execution, QueryExecutionId=query_execution_id)
+    status = response['QueryExecution']['Status']
+    if status['State'] == 'SUCCEEDED':
+      return response['QueryExecution']
+    if status['State'] in ('FAILED', 'CANCELLED'):
+      raise AthenaQueryError(query_execution_id, status['State'], status.get('StateChangeReason', ''), response['QueryExecution'])
+
+    if deadline is not None and time.monotonic() + delay > deadline:
+      raise TimeoutError('Query {} is still {} before the lambda function times out'.format(query_execution_id, status['State']))
+    await asyncio.sleep(delay)
+    delay = min(delay * 2, QUERY_POLL_MAX_DELAY)
+
+
+async def start_query(athena_client, query_fn, *args, **kwargs):
+  """Starts a query by `query_fn`, and retries it with exponential backoff and jitter while Athena throttles it."""
+  delay = QUERY_POLL_INITIAL_DELAY
+  for attempt in itertools.count():
+    try:
+      return await asyncio.to_thread(query_fn, athena_client, *args, **kwargs)
+    except botocore.exceptions.ClientError as ex:
+      error_code = ex.response.get('Error', {}).get('Code')
+      if error_code not in THROTTLING_ERROR_CODES or attempt >= QUERY_START_MAX_RETRIES:
+        raise
+      THROTTLED_QUERY_STARTS[error_code] += 1
+      print('[WARNING] Retry a throttled query in {:.1f} s: {}'.format(delay, ex), file=sys.stderr)
+      await asyncio.sleep(_JITTER.uniform(delay / 2, delay))
+      delay = min(delay * 2, QUERY_POLL_MAX_DELAY)
+
+
+def get_query_cost(query_execution):
+  """Returns the cost of a query in USD. Failed queries, and queries scanning no data, e.g. DDL, are not billed."""
+  data_scanned_bytes = query_execution.get('Statistics', {}).get('DataScannedInBytes', 0)
+  if not data_scanned_bytes or query_execution['Status']['State'] == 'FAILED':
+    return 0.0
+  billed_bytes = max(MIN_BILLED_BYTES, math.ceil(data_scanned_bytes / 1024**2) * 1024**2)
+  return billed_bytes / 1024**4 * ATHENA_PRICE_PER_TB
+
+
+def record_query_statistics(statement, basic_dt, query_execution):
+  """Records the statistics of a finished query of an hour, and emits them as metrics."""
+  query_statistics = query_execution.get('Statistics', {})
+  entry = {
+    'statement': statement,
+    'hour': basic_dt.strftime(BACKFILL_HOUR_FMT),
+    'query_execution_id': query_execution['QueryExecutionId'],
+    'state': query_execution['Status']['State'],
+    'cost_usd': get_query_cost(query_execution)
+  }
+  entry.update({key: query_statistics.get(key, 0) for _, _, key in QUERY_METRICS})
+  QUERY_STATISTICS.append(entry)
+
+  if EMIT_METRICS:
+    emit_metrics(QUERY_METRIC_DEFINITIONS, [['TableName', 'Statement']], dict(
+      {name: entry[key] for name, _, key in QUERY_METRICS},
+      Cost=entry['cost_usd'],
+      Statement=statement,
+      Hour=entry['hour'],
+      QueryExecutionId=entry['query_execution_id'],
+      State=entry['state']))
+  return entry
+
+
+def emit_metrics(metric_definitions, dimensions, values):
+  """Prints metrics as a log line in CloudWatch Embedded Metric Format, tagged by the target table.
+
+  `values` has the metrics, the dimensions and the other properties to search the logs by, e.g. the hour.
+  """
+  document = {
+    '_aws': {
+      'Timestamp': int(time.time() * 1000),
+      'CloudWatchMetrics': [{
+        'Namespace': METRICS_NAMESPACE,
+        'Dimensions': dimensions,
+        'Metrics': metric_definitions
+      }]
+    },
+    'TableName': '{}.{}'.format(NEW_DATABASE, NEW_TABLE_NAME)
+  }
+  document.update(values)
+  print(json.dumps(document), flush=True)
 
+
+def summarize_queries(hour=None):
+  """Returns the number, cost and latency of the queries of an hour, or of every hour, finished so far."""
+  entries = [e for e in QUERY_STATISTICS if hour is None or e['hour'] == hour]
+  return {
+    'queries': len(entries),
+    'query_data_scanned_bytes': sum(e['DataScannedInBytes'] for e in entries),
+    'query_cost_usd': round(sum(e['cost_usd'] for e in entries), 6),
+    'query_queue_ms': sum(e['QueryQueueTimeInMillis'] for e in entries),
+    'query_engine_ms': sum(e['EngineExecutionTimeInMillis'] for e in entries)
+  }
+
+
+def find_regressions(record, baseline_records):
+  """Compares the queries of an hour with the median of the hours compacted before with similar input bytes,
+  i.e. from half to twice as many, and returns the keys of the summary above REGRESSION_THRESHOLD times the median.
+  """
+  if REGRESSION_THRESHOLD <= 0 or not record.get('queries') or not record.get('input_bytes'):
+    return []
+  baseline = [e for e in baseline_records if e.get('status') in compaction_ledger.COMPACTED_STATUSES and e.get('queries')
+    and e['hour'] != record['hour']
+    and record['input_bytes'] / 2 <= e.get('input_bytes', 0) <= record['input_bytes'] * 2]
+  if len(baseline) < MIN_REGRESSION_BASELINE:
+    return []
+
+  regressions = []
+  for key in REGRESSION_KEYS:
+    median = statistics.median(e.get(key, 0) for e in baseline)
+    if median > 0 and record[key] > REGRESSION_THRESHOLD * median:
+      regressions.append({'key': key, 'value': record[key], 'baseline': median})
+  return regressions
+
+
+def log_hour_summary(record):
+  """Prints the cost and latency of the queries of an hour with its regressions, and emits them as metrics."""
+  print('[INFO] Queries of {hour}: {queries} queries, {scanned_mb:.1f} MB scanned, ${query_cost_usd:.4f},'
+    ' {query_queue_ms} ms queued, {query_engine_ms} ms running'.format(
+      scanned_mb=record['query_data_scanned_bytes'] / 1024**2, **record), file=sys.stderr)
+  for e in record.get('regressions', []):
+    print('[WARNING] Regression of {}: {} is {} against the median of {} of similar hours'.format(record['hour'],
+      e['key'], e['value'], e['baseline']), file=sys.stderr)
+
+  if EMIT_METRICS:
+    values = dict(record, num_regressions=len(record.get('regressions', [])))
+    emit_metrics(HOUR_METRIC_DEFINITIONS, [['TableName']], dict(
+      {name: values[key] for name, _, key in HOUR_METRICS},
+      Hour=record['hour'],
+      Status=record.get('status', '')))
+
+
+async def run_query(athena_client, span_name, query_fn, *args, deadline=None, on_start=None, **kwargs):
+  """Starts a query by `query_fn` and waits for it to succeed. Returns None in dry-run.
+
+  `args` start with the hour of the query, e.g. `basic_dt` of `run_ctas`, which tags the statistics of the query
+  recorded as soon as it finishes. `on_start` is awaited with the QueryExecutionId as soon as the query starts.
+  """
+  query_slots = QUERY_SLOTS
+  with tracing.span(span_name):
+    if query_slots is not None:
+      await query_slots.acquire()
+    try:
+      query_execution_id = await start_query(athena_client, query_fn, *args, **kwargs)
+      if query_execution_id is None:
+        return None
+      if on_start is not None:
+        await on_start(query_execution_id)
+
+      #XXX: The statement of a query is tagged without the table name of its span, e.g. `alter_table_add_partition`.
+      statement = span_name.split(':')[0]
+      try:
+        query_execution = await wait_for_query(athena_client, query_execution_id, deadline=deadline)
+      except AthenaQueryError as ex:
+        if ex.query_execution is not None:
+          record_query_statistics(statement, args[0], ex.query_execution)
+        raise
+      record_query_statistics(statement, args[0], query_execution)
+    finally:
+      if query_slots is not None:
+        query_slots.release()
+
+    print('[INFO] QueryExecutionId: {} SUCCEEDED in {} ms'.format(query_execution_id,
+      query_execution.get('Statistics', {}).get('TotalExecutionTimeInMillis', '-')), file=sys.stderr)
+    return query_execution
+
+
+async def add_partitions(athena_client, basic_dt, database_name, table_name, output_prefix, tenants=None, deadline=None):
+  """Registers partitions through AWS Glue, and falls back to Athena DDL if it is not available."""
+  if PARTITION_REGISTRAR == 'glue':
+    try:
+      with tracing.span(f'batch_create_partition:{table_name}'):
+        await asyncio.to_thread(run_batch_create_partition, get_glue_client(), basic_dt,
+          database_name=database_name,
+          table_name=table_name,
+          output_prefix=output_prefix,
+          tenants=tenants)
+      return
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, PartitionRegistrationError) as ex:
+      print('[WARNING] Fall back to Athena DDL to add partitions to table: {}.{}: {}'.format(database_name, table_name, ex), file=sys.stderr)
+
+  await run_query(athena_client, f'alter_table_add_partition:{table_name}', run_alter_table_add_partition, basic_dt,
+    database_name=database_name,
+    table_name=table_name,
+    output_prefix=output_prefix,
+    tenants=tenants,
+    deadline=deadline)
+
+
+async def add_source_partitions(athena_client, basic_dt, deadline=None):
+  """Registers the partitions of an hour in the source table.
+
+  With TENANT_PARTITION_KEY, only the hour of each tenant with objects in it is registered, which is all that CTAS reads.
+  """
+  tenants = None
+  if TENANT_PARTITION_KEY:
+    tenants = await asyncio.to_thread(list_source_hour_tenants, basic_dt)
+    if not tenants:
+      print('[INFO] Skip adding partitions to {}.{}: no tenants with objects in {}'.format(OLD_DATABASE, OLD_TABLE_NAME,
+        basic_dt.strftime(BACKFILL_HOUR_FMT)), file=sys.stderr)
+      return
+  await add_partitions(athena_client, basic_dt,
+    database_name=OLD_DATABASE,
+    table_name=OLD_TABLE_NAME,
+    output_prefix=OLD_TABLE_LOCATION_PREFIX,
+    tenants=tenants,
+    deadline=deadline)
+
+
+async def run_concurrently(*coroutines):
+  """Runs coroutines concurrently. As soon as one of them fails, cancels the others and raises its exception."""
+  if not coroutines:
+    return []
+  tasks = [asyncio.ensure_future(e) for e in coroutines]
+  done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+  for task in pending:
+    task.cancel()
+  if pending:
+    await asyncio.wait(pending)
+
+  errors = [task.exception() for task in tasks if task in done and task.exception() is not None]
+  if errors:
+    raise errors[0]
+  return [task.result() for task in tasks]
+
+
+def add_partitions_to_tables(athena_client, basic_dt, deadline=None):
+  """Returns the coroutines adding partitions to the source and the target tables."""
+  return [
+    add_source_partitions(athena_client, basic_dt, deadline=deadline),
+    add_partitions(athena_client, basic_dt,
+      database_name=NEW_DATABASE,
+      table_name=NEW_TABLE_NAME,
+      output_prefix=OUTPUT_PREFIX,
+      deadline=deadline)
+  ]
+
+
+def use_local_engine():
+  """Returns True if hours are compacted by json_to_parquet instead of CTAS, which needs pyarrow."""
+  if COMPACTION_ENGINE != 'local':
+    return False
+  if json_to_parquet.pa is None:
+    print('[WARNING] pyarrow is not available; fall back to the athena compaction engine', file=sys.stderr)
+    return False
+  return True
+
+
+async def run_local_compaction(basic_dt, deadline=None):
+  """Compacts an hour with json_to_parquet in a thread. Returns its statistics, or None in the dry run.
+
+  The hour is compacted into its recompaction location, and its files are moved into the output location
+  only after all of them are written, replacing the merged files of the hour if any.
+  """
+  staging_location = get_recompaction_location(basic_dt)
+  if DRY_RUN:
+    print('[INFO] Compact {} into {} with the local engine'.format(get_hour_location(OLD_TABLE_LOCATION_PREFIX, basic_dt),
+      get_hour_location(OUTPUT_PREFIX, basic_dt)), file=sys.stderr)
+    return None
+
+  with tracing.span('local_compaction'):
+    #XXX: Files may be left by an attempt that stopped before deleting them.
+    await asyncio.to_thread(delete_location, staging_location)
+    input_locations = await asyncio.to_thread(get_source_hour_locations, basic_dt)
+    stats = await asyncio.to_thread(json_to_parquet.compact, get_storage(), input_locations, staging_location,
+      column_names=COLUMN_NAMES,
+      compression=PARQUET_COMPRESSION,
+      compression_level=PARQUET_COMPRESSION_LEVEL,
+      row_group_rows=PARQUET_ROW_GROUP_ROWS,
+      target_file_size_mb=TARGET_FILE_SIZE_MB,
+      io_threads=LOCAL_ENGINE_IO_THREADS,
+      max_prefetch_bytes=LOCAL_ENGINE_MAX_PREFETCH_MB * 1024**2,
+      cluster_by=CLUSTER_BY,
+      max_sort_rows=LOCAL_ENGINE_MAX_SORT_ROWS,
+      deadline=deadline,
+      input_format=SOURCE_FORMAT,
+      input_compression=SOURCE_COMPRESSION)
+    if stats['output_files']:
+      await asyncio.to_thread(replace_hour_output, basic_dt)
+  print('[INFO] Compacted {input_files} objects of {input_bytes} bytes into {output_files} files of {output_bytes} bytes,'
+    ' {rows} rows in {elapsed_s} s'.format(**stats), file=sys.stderr)
+  return stats
+
+
+async def merge_small_files(athena_client, prev_basic_dt, basic_dt, deadline=None):
+  QUERY_STATISTICS.clear()
+  started_at = datetime.datetime.now(datetime.timezone.utc).strftime(compaction_ledger.TIME_FMT)
+  try:
+    await merge_hour(athena_client, prev_basic_dt, basic_dt, deadline=deadline)
+  finally:
+    #XXX: The summary includes the temporary table of the previous hour dropped by this run.
+    if QUERY_STATISTICS:
+      log_hour_summary(dict(summarize_queries(), hour=basic_dt.strftime(BACKFILL_HOUR_FMT)))
+
+  if VERIFY_COMPACTION and not DRY_RUN:
+    #XXX: Without a ledger, a mismatched hour is not compacted again, and its objects are kept untagged.
+    with tracing.span('verify_hour', hour=basic_dt.strftime(BACKFILL_HOUR_FMT)):
+      result = await asyncio.to_thread(verify_hour, basic_dt, started_at)
+    if result['late_objects']:
+      print('[WARNING] {} objects of {} were created since it was compacted; run a backfill with a ledger'
+        ' to compact it again'.format(len(result['late_objects']), basic_dt.strftime(BACKFILL_HOUR_FMT)), file=sys.stderr)
+    if result['source_rows'] == result['output_rows']:
+      await asyncio.to_thread(tag_verified_objects, result['source_objects'])
+    log_verify_result(basic_dt.strftime(BACKFILL_HOUR_FMT), result)
+
+
+async def merge_hour(athena_client, prev_basic_dt, basic_dt, deadline=None):
+  local_engine = use_local_engine()
+  #XXX: The local engine creates no temporary tables.
+  coroutines = []
+  if not local_engine:
+    coroutines.append(run_query(athena_client, 'drop_tmp_table', run_drop_tmp_table, prev_basic_dt, deadline=deadline))
+
+  plan = None
+  if SIZE_AWARE_PLANNING:
+    plan = (await plan_hours([basic_dt]))[basic_dt.strftime(BACKFILL_HOUR_FMT)]
+    if compaction_planner.is_empty(plan):
+      print('[INFO] Skip {}: no objects to compact'.format(plan['hour']), file=sys.stderr)
+      await run_concurrently(*coroutines)
+      return
+
+  if PARTITION_PROJECTION:
+    #XXX: Athena projects the partitions of both tables from their table properties.
+    print('[INFO] Skip adding partitions to the tables with partition projection', file=sys.stderr)
+  else:
+    #XXX: Dropping the temporary table of the previous hour and
+    # adding partitions to each table do not depend on each other.
+    coroutines.extend(add_partitions_to_tables(athena_client, basic_dt, deadline=deadline))
+  await run_concurrently(*coroutines)
+
+  if local_engine:
+    #XXX: Like CTAS on a location with files, the local engine does not compact an hour merged before,
+    # which would duplicate its rows.
+    output = None if DRY_RUN else await asyncio.to_thread(get_hour_output, athena_client, basic_dt)
+    if output and output['output_files']:
+      print('[WARNING] Skip {}: {} files already exist in the output location; delete them'
+        ' to compact it again'.format(basic_dt.strftime(BACKFILL_HOUR_FMT), output['output_files']), file=sys.stderr)
+      return
+    output = await run_local_compaction(basic_dt, deadline=deadline)
+  else:
+    #XXX: CTAS reads the partitions added to the source table.
+    query_execution = await run_query(athena_client, 'ctas', run_ctas, basic_dt, plan=plan, deadline=deadline)
+    output = None
+    if plan is not None and query_execution is not None:
+      output = await asyncio.to_thread(get_hour_output, athena_client, basic_dt)
+  if plan is not None and output is not None:
+    compaction_planner.log_plan_result(plan, output)
+
+
+async def compact_hour(athena_client, basic_dt, plan=None, prev_query_execution_id=None, on_ctas_start=None, replace=False,
+    deadline=None):
+  """Compacts an hour as `plan`, and drops its temporary table right after CTAS. Returns the record of the hour.
+
+  If `prev_query_execution_id` is the CTAS query of the hour started by a run that stopped,
+  its result is taken instead of running CTAS again if it succeeded.
+  With the local engine, the hour is compacted by json_to_parquet instead.
+  If `replace` is set, e.g. for a dirty hour, the hour is compacted into its recompaction location,
+  and its merged files are replaced with the new ones.
+  """
+  hour = basic_dt.strftime(BACKFILL_HOUR_FMT)
+  local_engine = use_local_engine()
+  query_execution = None
+  if prev_query_execution_id is not None and not DRY_RUN and not local_engine:
+    try:
+      query_execution = await wait_for_query(athena_client, prev_query_execution_id, deadline=deadline)
+      print('[INFO] Resume from QueryExecutionId: {}'.format(prev_query_execution_id), file=sys.stderr)
+      record_query_statistics('ctas', basic_dt, query_execution)
+    except AthenaQueryError as ex:
+      if ex.query_execution is not None:
+        record_query_statistics('ctas', basic_dt, ex.query_execution)
+      print('[WARNING] Compact {} again: {}'.format(hour, ex), file=sys.stderr)
+
+  if query_execution is None and not DRY_RUN and not replace:
+    #XXX: The hour may have been compacted without being recorded, e.g. before the ledger was enabled.
+    output = await asyncio.to_thread(get_hour_output, athena_client, basic_dt)
+    if output.get('output_files'):
+      print('[WARNING] Skip {}: {} files already exist in the output location; delete them and the record of the hour'
+        ' to compact it again'.format(hour, output['output_files']), file=sys.stderr)
+      if not local_engine:
+        await run_query(athena_client, 'drop_tmp_table', run_drop_tmp_table, basic_dt, deadline=deadline)
+      return dict(output, hour=hour, status='EXISTING')
+
+  staging_location = get_recompaction_location(basic_dt) if replace else None
+  if query_execution is None:
+    if not PARTITION_PROJECTION:
+      await run_concurrently(*add_partitions_to_tables(athena_client, basic_dt, deadline=deadline))
+    if local_engine:
+      output = await run_local_compaction(basic_dt, deadline=deadline)
+      if output is None:
+        return {'hour': hour, 'status': 'SUCCEEDED'}
+      if plan is not None:
+        compaction_planner.log_plan_result(plan, output)
+        output['predicted_files'] = plan['predicted_files']
+      return dict(output, hour=hour, status='SUCCEEDED', engine='local', compression=PARQUET_COMPRESSION,
+        source_format=SOURCE_FORMAT, source_compression=SOURCE_COMPRESSION)
+    if replace and not DRY_RUN:
+      #XXX: CTAS fails on a location with files, e.g. left by a failed attempt.
+      await asyncio.to_thread(delete_location, staging_location)
+    query_execution = await run_query(athena_client, 'ctas', run_ctas, basic_dt, plan=plan, external_location=staging_location,
+      deadline=deadline, on_start=on_ctas_start)
+
+  await run_query(athena_client, 'drop_tmp_table', run_drop_tmp_table, basic_dt, deadline=deadline)
+  if query_execution is None:
+    return {'hour': hour, 'status': 'SUCCEEDED'}
+  if replace:
+    await asyncio.to_thread(replace_hour_output, basic_dt)
+
+  output = await asyncio.to_thread(get_hour_output, athena_client, basic_dt, query_execution['QueryExecutionId'])
+  if plan is not None:
+    compaction_planner.log_plan_result(plan, output)
+    output.update({k: plan[k] for k in ('input_files', 'input_bytes', 'bucket_count', 'predicted_files')})
+  return dict(output, hour=hour, status='SUCCEEDED', compression=PARQUET_COMPRESSION, source_format=SOURCE_FORMAT,
+    source_compression=SOURCE_COMPRESSION, query_execution_id=query_execution['QueryExecutionId'],
+    data_scanned_bytes=query_execution.get('Statistics', {}).get('DataScannedInBytes', 0))
+
+
+def get_hour_output(athena_client, basic_dt, query_execution_id=None):
+  """Returns the number and bytes of the files in the output location of an hour,
+  and the number of rows written by the CTAS query if `query_execution_id` is given."""
+  external_location = get_hour_location(OUTPUT_PREFIX, basic_dt)
+
+  output = {'output_files': 0, 'output_bytes': 0}
+  try:
+    output['output_files'], output['output_bytes'] = list_location(external_location)
+
+    if query_execution_id is not None:
+      #XXX: UpdateCount is the number of rows inserted by CTAS.
+      response = athena_client.get_query_results(QueryExecutionId=query_execution_id, MaxResults=1)
+      output['rows'] = response.get('UpdateCount')
+  except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as ex:
+    print('[WARNING] Failed to get the output of {}: {}'.format(external_location, ex), file=sys.stderr)
+  return output
+
+
+def create_ledger(ledger_url):
+  """Returns the compaction ledger of `ledger_url`, sharing the S3 client of this function."""
+  s3_client = get_s3_client() if ledger_url.startswith('s3://') else None
+  return compaction_ledger.create_ledger(ledger_url, s3_client=s3_client, region_name=AWS_REGION)
+
+
+def get_ledger():
+  global LEDGER
+
+  if LEDGER is None:
+    LEDGER = create_ledger(COMPACTION_LEDGER)
+  return LEDGER
+
+
+def get_ledger_id():
+  return '{}.{}'.format(NEW_DATABASE, NEW_TABLE_NAME)
+
+
+async def put_record(ledger, record):
+  if ledger is None or DRY_RUN:
+    return
+  await asyncio.to_thread(ledger.put_record, get_ledger_id(), record)
+
+
+def verify_hour(basic_dt, started_at=''):
+  """Counts the rows of the objects of an hour created before it started being compacted at `started_at`,
+  streaming each JSON object or reading the footer of each Parquet object, and the rows of its merged files from their footers.
+
+  Returns the counts, the objects counted, and the objects created since as (creation time, size).
+  """
+  storage = get_storage()
+  source_objects, late_objects = ([], [])
+  for location, size, modified_dt in list_source_hour(basic_dt, modified=True):
+    created_at = modified_dt.strftime(compaction_ledger.TIME_FMT)
+    #XXX: LastModified has a resolution of a second, so an object of the second the compaction started is late.
+    if started_at and created_at >= started_at:
+      late_objects.append((created_at, size))
+    else:
+      source_objects.append(location)
+  output_files = [e for e, _ in storage.list(get_hour_location(OUTPUT_PREFIX, basic_dt))]
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_COPY_THREADS) as executor:
+    #XXX: The rows of the objects converted by Firehose are read from their footers, too.
+    if SOURCE_FORMAT == 'parquet':
+      count_rows = compaction_verifier.read_num_rows
+    else:
+      count_rows = lambda s, e: compaction_verifier.count_json_rows(s, e, compression=SOURCE_COMPRESSION)
+    source_rows = sum(executor.map(lambda e: count_rows(storage, e), source_objects))
+    output_rows = sum(executor.map(lambda e: compaction_verifier.read_num_rows(storage, e), output_files))
+  return {
+    'source_objects': source_objects,
+    'source_rows': source_rows,
+    'output_files': len(output_files),
+    'output_rows': output_rows,
+    'late_objects': sorted(late_objects)
+  }
+
+
+def tag_verified_objects(locations):
+  storage = get_storage()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_COPY_THREADS) as executor:
+    list(executor.map(lambda e: storage.tag(e, VERIFIED_TAGS), locations))
+
+
+def log_verify_result(hour, result):
+  print('[{}] Verify {}: {} rows of {} objects, {} rows of {} merged files'.format(
+    'INFO' if result['source_rows'] == result['output_rows'] else 'WARNING', hour, result['source_rows'],
+    len(result['source_objects']), result['output_rows'], result['output_files']), file=sys.stderr)
+
+
+async def verify_hours(ledger, records, hours, deadline=None):
+  """Verifies the hours compacted but not verified yet, and updates their records in `records` and `ledger`.
+
+  The objects of a VERIFIED hour are tagged with VERIFIED_TAGS. An hour with objects created since it started
+  being compacted is marked DIRTY, like by their S3 event notifications. A mismatched hour is marked DIRTY to be compacted
+  again, up to VERIFY_MAX_RECOMPACTIONS times before it is recorded as MISMATCHED. Returns a summary of the verification.
+  """
+  summary = {'verified': 0, 'mismatched': [], 'unverified': 0}
+  for hour in hours:
+    record = records.get(hour, {})
+    if record.get('status') not in compaction_ledger.UNVERIFIED_STATUSES:
+      continue
+    if deadline is not None and time.monotonic() > deadline:
+      #XXX: The next run verifies the hours left.
+      summary['unverified'] += 1
+      continue
+
+    basic_dt = datetime.datetime.strptime(hour, BACKFILL_HOUR_FMT)
+    try:
+      with tracing.span('verify_hour', hour=hour):
+        result = await asyncio.to_thread(verify_hour, basic_dt,
+          late_data.get_compaction_started_at(record, MAX_COMPACTION_SECONDS))
+    except (compaction_verifier.ParquetFooterError, botocore.exceptions.BotoCoreError,
+        botocore.exceptions.ClientError) as ex:
+      summary['unverified'] += 1
+      print('[WARNING] Failed to verify {}: {}'.format(hour, ex), file=sys.stderr)
+      continue
+    log_verify_result(hour, result)
+
+    if result['late_objects']:
+      dirty_records = await asyncio.to_thread(late_data.mark_dirty_hours, ledger, get_ledger_id(),
+        {hour: result['late_objects']}, MAX_COMPACTION_SECONDS)
+      records.update(dirty_records)
+      continue
+
+    now = datetime.datetime.now(datetime.timezone.utc).strftime(compaction_ledger.TIME_FMT)
+    counts = {k: result[k] for k in ('source_rows', 'output_rows')}
+    if result['source_rows'] == result['output_rows']:
+      await asyncio.to_thread(tag_verified_objects, result['source_objects'])
+      record = dict(record, status='VERIFIED', verified_at=now, source_objects=len(result['source_objects']), **counts)
+      record.pop('verify_failures', None)
+      summary['verified'] += 1
+    else:
+      summary['mismatched'].append(hour)
+      verify_failures = record.get('verify_failures', 0) + 1
+      if verify_failures > VERIFY_MAX_RECOMPACTIONS:
+        record = dict(record, status='MISMATCHED', verified_at=now, verify_failures=verify_failures, **counts)
+        print('[ERROR] {} still has {} rows for {} rows of its objects after being compacted again {} times;'
+          ' its objects are kept untagged'.format(hour, result['output_rows'], result['source_rows'],
+            verify_failures - 1), file=sys.stderr)
+      else:
+        #XXX: Compacted again once it settles, like an hour with late objects
+        record = dict(counts, hour=hour, status=compaction_ledger.DIRTY_STATUS, late_objects=0, late_bytes=0,
+          first_late_object_at=now, last_late_object_at=now, recompactions=record.get('recompactions', 0),
+          verify_failures=verify_failures)
+    await put_record(ledger, record)
+    records[hour] = record
+  return summary
+
+
+def collect_late_data(ledger):
+  """Marks the hours with late objects notified through LATE_DATA_QUEUE_URL as DIRTY. Returns the dirty hours."""
+  sqs_client = get_sqs_client()
+  with tracing.span('receive_late_data_events'):
+    events, receipt_handles = late_data.receive_late_data_events(sqs_client, LATE_DATA_QUEUE_URL, LATE_DATA_MAX_MESSAGES)
+  dirty_records = late_data.mark_dirty_hours(ledger, get_ledger_id(),
+    late_data.get_late_objects(events, OLD_TABLE_LOCATION_PREFIX), MAX_COMPACTION_SECONDS)
+  #XXX: Messages not deleted, e.g. if the ledger failed, are received again by the next run.
+  late_data.delete_late_data_events(sqs_client, LATE_DATA_QUEUE_URL, receipt_handles)
+  print('[INFO] {} S3 event notifications, {} dirty hours'.format(len(receipt_handles), len(dirty_records)), file=sys.stderr)
+  return dirty_records
+
+
+async def backfill(athena_client, start_dt, end_dt, concurrency=5, ledger=None, deadline=None):
+  """Compacts every hour in [start_dt, end_dt) with at most `concurrency` active queries.
+
+  Hours recorded as done in `ledger` are skipped, so a backfill stopped by a crash continues where it stopped.
+  DIRTY hours are compacted again once their late objects have settled. Hours not started before `deadline` are deferred. The record of each hour has the cost and latency of its queries,
+  and the regressions against the hours of similar input bytes in `ledger`. Returns a summary of the backfill.
+  """
+  global QUERY_SLOTS
+
+  QUERY_STATISTICS.clear()
+
+  hours = []
+  basic_dt = start_dt.replace(minute=0, second=0, microsecond=0)
+  while basic_dt < end_dt:
+    hours.append(basic_dt)
+    basic_dt += datetime.timedelta(hours=1)
+
+  start_hour, end_hour = [e.strftime(BACKFILL_HOUR_FMT) for e in (start_dt, end_dt)]
+  records = {}
+  if ledger is not None:
+    with tracing.span('get_records'):
+      records = await asyncio.to_thread(ledger.get_records, get_ledger_id(), start_hour, end_hour)
+
+  statuses = {e: records.get(e.strftime(BACKFILL_HOUR_FMT), {}).get('status') for e in hours}
+  pending = [e for e in hours if statuses[e] not in compaction_ledger.DONE_STATUSES]
+  #XXX: A dirty hour still receiving late objects waits for the burst to end, so that it is compacted again only once.
+  dirty = [e for e in pending if statuses[e] == compaction_ledger.DIRTY_STATUS]
+  settling = [e for e in dirty if late_data.is_settling(records[e.strftime(BACKFILL_HOUR_FMT)], LATE_DATA_SETTLE_MINUTES)]
+  pending = [e for e in pending if e not in settling]
+  summary = {'hours': len(hours), 'skipped': len(hours) - len(pending) - len(settling), 'succeeded': 0, 'existing': 0,
+    'empty': 0, 'dirty': len(dirty) - len(settling), 'settling': len(settling), 'failed': [], 'deferred': 0, 'rows': 0,
+    'output_bytes': 0, 'data_scanned_bytes': 0, 'queries': 0, 'query_cost_usd': 0.0, 'regressions': [], 'elapsed_s': 0.0}
+  print('[INFO] Compact {} hours from {} to {}: {} already compacted, {} dirty, {} dirty but still settling'.format(len(hours),
+    start_hour, end_hour, summary['skipped'], summary['dirty'], summary['settling']), file=sys.stderr)
+
+  plans = {}
+  if SIZE_AWARE_PLANNING and pending:
+    plans = await plan_hours(pending, ratio=compaction_planner.get_parquet_to_json_ratio(records, PARQUET_COMPRESSION,
+      SOURCE_FORMAT, SOURCE_COMPRESSION, get_default_ratio()))
+    #XXX: Hours without objects cost neither partitions nor queries.
+    for hour in [k for k, v in plans.items() if compaction_planner.is_empty(v)]:
+      summary['empty'] += 1
+      await put_record(ledger, {'hour': hour, 'status': 'EMPTY',
+        'compacted_at': datetime.datetime.now(datetime.timezone.utc).strftime(compaction_ledger.TIME_FMT)})
+    pending = [e for e in pending if not compaction_planner.is_empty(plans[e.strftime(BACKFILL_HOUR_FMT)])]
+
+  start = time.monotonic()
+  throttled = sum(THROTTLED_QUERY_STARTS.values())
+
+  async def run_worker(hour_iter):
+    #XXX: Workers share the iterator, so each takes the next pending hour as soon as it finishes one.
+    for basic_dt in hour_iter:
+      hour = basic_dt.strftime(BACKFILL_HOUR_FMT)
+      if deadline is not None and time.monotonic() > deadline:
+        summary['deferred'] += 1
+        continue
+
+      hour_start = time.monotonic()
+      prev_record = records.get(hour, {})
+      #XXX: Records of the hours being compacted again keep `replace` until they succeed, e.g. after a failure.
+      recompaction = {}
+      if prev_record.get('status') == compaction_ledger.DIRTY_STATUS or prev_record.get('replace'):
+        recompaction = {'replace': True, 'recompactions': prev_record.get('recompactions', 0)}
+        if prev_record.get('verify_failures'):
+          recompaction['verify_failures'] = prev_record['verify_failures']
+
+      async def on_ctas_start(query_execution_id):
+        await put_record(ledger, dict(recompaction, hour=hour, status='RUNNING', query_execution_id=query_execution_id))
+
+      try:
+        with tracing.span('compact_hour', hour=hour):
+          record = await compact_hour(athena_client, basic_dt,
+            plan=plans.get(hour),
+            prev_query_execution_id=prev_record.get('query_execution_id'),
+            on_ctas_start=on_ctas_start,
+            replace=bool(recompaction),
+            deadline=deadline)
+      except TimeoutError as ex:
+        #XXX: The CTAS query recorded as RUNNING is taken over by the next run.
+        summary['deferred'] += 1
+        print('[WARNING] Defer {} to the next run: {}'.format(hour, ex), file=sys.stderr)
+        continue
+      except Exception as ex:
+        record = dict(recompaction, hour=hour, status='FAILED', error=str(ex))
+        summary['failed'].append(hour)
+        print('[ERROR] Failed to compact {}: {}'.format(hour, ex), file=sys.stderr)
+      else:
+        if recompaction:
+          record['recompactions'] = recompaction['recompactions'] + 1
+          if 'verify_failures' in recompaction:
+            record['verify_failures'] = recompaction['verify_failures']
+        record['duration_s'] = round(time.monotonic() - hour_start, 3)
+        summary['succeeded'] += 1
+        summary['existing'] += int(record['status'] == 'EXISTING')
+        for k in ('rows', 'output_bytes', 'data_scanned_bytes'):
+          summary[k] += record.get(k) or 0
+
+      #XXX: Failed hours are charged for the queries they ran, too.
+      query_summary = summarize_queries(hour)
+      if query_summary['queries']:
+        record.update(query_summary)
+        summary['queries'] += query_summary['queries']
+        summary['query_cost_usd'] += query_summary['query_cost_usd']
+        if record['status'] == 'SUCCEEDED':
+          regressions = find_regressions(record, records.values())
+          if regressions:
+            record['regressions'] = regressions
+            summary['regressions'].append(hour)
+        log_hour_summary(record)
+      record['compacted_at'] = datetime.datetime.now(datetime.timezone.utc).strftime(compaction_ledger.TIME_FMT)
+      await put_record(ledger, record)
+      records[hour] = record
+
+      finished = summary['succeeded'] + len(summary['failed'])
+      elapsed = max(time.monotonic() - start, 1e-9)
+      print('[INFO] [{}/{}] {} {} in {:.1f} s, {} rows, {} bytes, {:.1f} hours/min, ETA {:.0f} s'.format(finished,
+        len(pending), hour, record['status'], time.monotonic() - hour_start, record.get('rows', '-'),
+        record.get('output_bytes', '-'), finished / elapsed * 60, (len(pending) - finished) * elapsed / finished), file=sys.stderr)
+
+  QUERY_SLOTS = asyncio.Semaphore(concurrency)
+  try:
+    hour_iter = iter(pending)
+    await asyncio.gather(*[run_worker(hour_iter) for _ in range(min(concurrency, len(pending)))])
+  finally:
+    QUERY_SLOTS = None
+
+  if VERIFY_COMPACTION and ledger is not None and not DRY_RUN:
+    summary.update(await verify_hours(ledger, records, [e.strftime(BACKFILL_HOUR_FMT) for e in hours], deadline=deadline))
+
+  summary['elapsed_s'] = time.monotonic() - start
+  summary['throttled_query_starts'] = sum(THROTTLED_QUERY_STARTS.values()) - throttled
+  return summary
+
+
+def print_backfill_summary(summary):
+  print('[INFO] Compaction of {hours} hours: {succeeded} succeeded ({existing} existing, {dirty} dirty), {empty} empty, '
+    '{num_failed} failed, {deferred} deferred, {settling} settling, {skipped} skipped in {elapsed_s:.1f} s ({throughput:.1f} hours/min), {rows} rows, '
+    '{output_mb:.1f} MB written, {data_scanned_mb:.1f} MB scanned, {queries} queries costing ${query_cost_usd:.4f}, '
+    '{throttled_query_starts} throttled query starts retried'.format(
+      num_failed=len(summary['failed']),
+      throughput=summary['succeeded'] / max(summary['elapsed_s'], 1e-9) * 60,
+      output_mb=summary['output_bytes'] / 1024**2,
+      data_scanned_mb=summary['data_scanned_bytes'] / 1024**2, **summary), file=sys.stderr)
+  if summary['failed']:
+    print('[ERROR] Failed hours: {}; run again to retry them'.format(', '.join(summary['failed'])), file=sys.stderr)
+  if summary['regressions']:
+    print('[WARNING] Hours with query regressions: {}'.format(', '.join(summary['regressions'])), file=sys.stderr)
+  if 'verified' in summary:
+    print('[INFO] Verification: {} verified, {} mismatched, {} left to the next run'.format(summary['verified'],
+      len(summary['mismatched']), summary['unverified']), file=sys.stderr)
+
+
+@tracing.trace('athena_ctas')
 def lambda_handler(event, context):
   event_dt = datetime.datetime.strptime(event['time'], "%Y-%m-%dT%H:%M:%SZ")
   prev_basic_dt, basic_dt = [event_dt - datetime.timedelta(hours=e) for e in (2, 1)]
 
-  client = boto3.client('athena', region_name=AWS_REGION)
-  run_drop_tmp_table(client, prev_basic_dt)
+  deadline = None
+  if hasattr(context, 'get_remaining_time_in_millis'):
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - QUERY_WAIT_MARGIN
 
-  if not DRY_RUN:
-    print('[INFO] Wait for a few seconds until dropping old table', file=sys.stderr)
-    time.sleep(10)
+  with tracing.span('create_client'):
+    client = get_athena_client()
 
-  run_alter_table_add_partition(client, basic_dt,
-    database_name=OLD_DATABASE,
-    table_name=OLD_TABLE_NAME,
-    output_prefix=OLD_TABLE_LOCATION_PREFIX)
+  if not COMPACTION_LEDGER:
+    asyncio.run(merge_small_files(client, prev_basic_dt, basic_dt, deadline=deadline))
+    return
+
+  #XXX: Catch up every hour not compacted yet up to the previous hour, e.g. after a failed or skipped run.
+  end_dt = basic_dt.replace(minute=0, second=0) + datetime.timedelta(hours=1)
+  start_dt = end_dt - datetime.timedelta(hours=CATCH_UP_HOURS)
+  ledger = get_ledger()
+  if LATE_DATA_QUEUE_URL:
+    dirty_records = collect_late_data(ledger)
+    stale_hours = [e for e in dirty_records if e < start_dt.strftime(BACKFILL_HOUR_FMT)]
+    if stale_hours:
+      print('[WARNING] Dirty hours before the last {} hours: {}; run a backfill over them to compact them again'.format(
+        CATCH_UP_HOURS, ', '.join(stale_hours)), file=sys.stderr)
+
+  summary = asyncio.run(backfill(client, start_dt, end_dt,
+    concurrency=MAX_CONCURRENT_QUERIES,
+    ledger=ledger,
+    deadline=deadline))
+  print_backfill_summary(summary)
+  if summary['failed']:
+    raise CompactionError('Failed to compact hours: {}'.format(', '.join(summary['failed'])))
+
+
+@tracing.trace('get_compaction_queries')
+def get_queries_handler(event, context):
+  """Returns the queries merging the previous hour of a scheduled event, which the state machine of the step_functions
+  orchestration runs with the native Amazon Athena integration instead of a lambda function waiting for them.
 
-  if not DRY_RUN:
-    print('[INFO] Wait for a few seconds until adding partitions to table: %s.%s' % (OLD_DATABASE, OLD_TABLE_NAME), file=sys.stderr)
-    time.sleep(10)
+  `prepare_queries`, dropping the temporary table of the hour before and adding the partitions of the hour to both tables,
+  run in parallel, and then `ctas` runs unless `skip` is set for an hour without objects.
+  """
+  event_dt = datetime.datetime.strptime(event['time'], "%Y-%m-%dT%H:%M:%SZ")
+  prev_basic_dt, basic_dt = [event_dt - datetime.timedelta(hours=e) for e in (2, 1)]
+  hour = basic_dt.strftime(BACKFILL_HOUR_FMT)
 
-  run_alter_table_add_partition(client, basic_dt,
-    database_name=NEW_DATABASE,
-    table_name=NEW_TABLE_NAME,
-    output_prefix=OUTPUT_PREFIX)
+  plan = None
+  if SIZE_AWARE_PLANNING:
+    plan = asyncio.run(plan_hours([basic_dt]))[hour]
+  skip = plan is not None and compaction_planner.is_empty(plan)
 
-  if not DRY_RUN:
-    print('[INFO] Wait for a few seconds until adding partitions to table: %s.%s' % (NEW_DATABASE, NEW_TABLE_NAME), file=sys.stderr)
-    time.sleep(10)
+  queries = [get_drop_tmp_table_query(prev_basic_dt)]
+  if not (PARTITION_PROJECTION or skip):
+    #XXX: With TENANT_PARTITION_KEY, the partitions of the tenants with objects in the hour are added to the source table.
+    tenants = list_source_hour_tenants(basic_dt) if TENANT_PARTITION_KEY else None
+    if tenants is None or tenants:
+      queries.append(get_alter_table_add_partition_query(basic_dt, OLD_DATABASE, OLD_TABLE_NAME, OLD_TABLE_LOCATION_PREFIX,
+        tenants=tenants))
+    queries.append(get_alter_table_add_partition_query(basic_dt, NEW_DATABASE, NEW_TABLE_NAME, OUTPUT_PREFIX))
+  ctas_query, _, external_location = get_ctas_query(basic_dt, plan=plan)
+  print('[INFO] Queries of {}: {} to prepare, CTAS into {}{}'.format(hour, len(queries), external_location,
+    ' skipped without objects' if skip else ''), file=sys.stderr)
 
-  run_ctas(client, basic_dt)
+  return {
+    'hour': hour,
+    'skip': skip,
+    'plan': plan,
+    'prepare_queries': [{'QueryString': query} for query, _ in queries],
+    'ctas': {'QueryString': ctas_query}
+  }
 
 
 if __name__ == '__main__':
@@ -196,6 +1413,52 @@ if __name__ == '__main__':
     help='s3 path for aws athena tmp table')
   parser.add_argument('--column-names', default='*',
     help='selectable column names of aws athena source table')
+  parser.add_argument('--partition-registrar', default='glue', choices=['glue', 'athena'],
+    help='register partitions through aws glue or aws athena ddl')
+  parser.add_argument('--partition-projection', action='store_true',
+    help='skip adding partitions to the tables with partition projection')
+  parser.add_argument('--backfill-start',
+    help='compact every hour from this hour ex) 2020-02-28T03')
+  parser.add_argument('--backfill-end',
+    help='compact every hour until this hour, exclusive ex) 2020-02-29T00')
+  parser.add_argument('--concurrency', default=MAX_CONCURRENT_QUERIES, type=int,
+    help='the maximum number of active queries of a backfill, below the active query quota of the work group (default: 5)')
+  parser.add_argument('--ledger', default=COMPACTION_LEDGER or None,
+    help='the compaction ledger recording compacted hours to resume a backfill: dynamodb://{table}, s3://{bucket}/{prefix},'
+      ' or a local file path (default: athena_ctas_backfill_{start}_{end}.jsonl)')
+  parser.add_argument('--target-file-size-mb', default=TARGET_FILE_SIZE_MB, type=float,
+    help='the target size of merged files; an hour is bucketed by --bucket-column into files of this size (default: 128)')
+  parser.add_argument('--bucket-column', default=BUCKET_COLUMN,
+    help='the column to bucket merged files by without --cluster-by (default: requestId)')
+  parser.add_argument('--cluster-by', default=','.join(CLUSTER_BY),
+    help='the columns to sort merged files by, and bucket them by the first of, ex) user,requestTime')
+  parser.add_argument('--size-aware-planning', action='store_true', default=SIZE_AWARE_PLANNING,
+    help='list the objects of each hour to skip empty hours and bucket large hours into files of the target size')
+  parser.add_argument('--engine', default=COMPACTION_ENGINE, choices=['athena', 'local'],
+    help='compact hours by aws athena ctas, or by pyarrow in this process (default: athena)')
+  parser.add_argument('--local-root',
+    help='a local directory standing in for s3 with --engine local, which stores s3://{bucket}/{key} at {local-root}/{bucket}/{key}')
+  parser.add_argument('--compression', default=PARQUET_COMPRESSION, type=str.upper, choices=['SNAPPY', 'ZSTD', 'GZIP'],
+    help='the parquet codec of merged files (default: SNAPPY)')
+  parser.add_argument('--compression-level', default=PARQUET_COMPRESSION_LEVEL, type=int,
+    help='the compression level of the codec, which aws athena applies to ZSTD only (default: the default of the codec)')
+  parser.add_argument('--row-group-rows', default=PARQUET_ROW_GROUP_ROWS, type=int,
+    help='the rows of a parquet row group of --engine local (default: 500000)')
+  parser.add_argument('--late-events',
+    help='a file of s3 event notifications, one json document per line, e.g. received from the late data queue;'
+      ' marks the hours compacted before their objects were created as dirty in --ledger, and compacts them again')
+  parser.add_argument('--late-data-settle-minutes', default=LATE_DATA_SETTLE_MINUTES, type=float,
+    help='compact a dirty hour again once no late objects have arrived for this long (default: 15)')
+  parser.add_argument('--verify', action='store_true', default=VERIFY_COMPACTION,
+    help='compare the rows of each compacted hour with its objects, and tag the objects of the verified hours'
+      ' with compaction=verified; a backfill with --ledger also verifies the hours compacted before')
+  parser.add_argument('--source-format', default=SOURCE_FORMAT, choices=['json', 'parquet'],
+    help='the format of the objects of the old table, parquet if kinesis data firehose converts them (default: json)')
+  parser.add_argument('--source-compression', default=SOURCE_COMPRESSION, choices=['UNCOMPRESSED', 'GZIP', 'HADOOP_SNAPPY'],
+    help='the compression format of the json objects of the old table, set by kinesis data firehose (default: UNCOMPRESSED)')
+  parser.add_argument('--tenant-partition-key', default=TENANT_PARTITION_KEY, choices=['', 'tenant', 'tenant_bucket'],
+    help='the partition key of the tenants before the hourly partitions of the source table,'
+      ' written by kinesis data firehose with dynamic partitioning (default: none)')
   parser.add_argument('--run', action='store_true',
     help='run ctas query')
 
@@ -212,6 +1475,54 @@ if __name__ == '__main__':
   OUTPUT_PREFIX = options.output_prefix
   STAGING_OUTPUT_PREFIX = options.staging_output_prefix
   COLUMN_NAMES = options.column_names
+  PARTITION_REGISTRAR = options.partition_registrar
+  PARTITION_PROJECTION = options.partition_projection
+  TARGET_FILE_SIZE_MB = options.target_file_size_mb
+  BUCKET_COLUMN = options.bucket_column
+  CLUSTER_BY = [e.strip() for e in options.cluster_by.split(',') if e.strip()]
+  SIZE_AWARE_PLANNING = options.size_aware_planning
+  COMPACTION_ENGINE = options.engine
+  LOCAL_STORAGE_ROOT = options.local_root or ''
+  PARQUET_COMPRESSION = options.compression
+  PARQUET_COMPRESSION_LEVEL = options.compression_level
+  PARQUET_ROW_GROUP_ROWS = options.row_group_rows
+  LATE_DATA_SETTLE_MINUTES = options.late_data_settle_minutes
+  VERIFY_COMPACTION = options.verify
+  TENANT_PARTITION_KEY = options.tenant_partition_key
+  SOURCE_FORMAT = options.source_format
+  SOURCE_COMPRESSION = options.source_compression
+
+  if options.late_events:
+    if not options.ledger:
+      parser.error('--ledger is required with --late-events')
+    with open(options.late_events) as f:
+      events = [json.loads(e) for e in f if e.strip()]
+    ledger = create_ledger(options.ledger)
+    dirty_records = late_data.mark_dirty_hours(ledger, get_ledger_id(),
+      late_data.get_late_objects(events, OLD_TABLE_LOCATION_PREFIX), MAX_COMPACTION_SECONDS)
+    if not dirty_records:
+      print('[INFO] No dirty hours in {} events'.format(len(events)), file=sys.stderr)
+      sys.exit(0)
+
+    start_dt, end_dt = [datetime.datetime.strptime(e, BACKFILL_HOUR_FMT) for e in (min(dirty_records), max(dirty_records))]
+    summary = asyncio.run(backfill(get_athena_client(), start_dt, end_dt + datetime.timedelta(hours=1),
+      concurrency=options.concurrency,
+      ledger=ledger))
+    print_backfill_summary(summary)
+    sys.exit(1 if summary['failed'] else 0)
+
+  if options.backfill_start or options.backfill_end:
+    if not (options.backfill_start and options.backfill_end):
+      parser.error('--backfill-start and --backfill-end are required together')
+    start_dt, end_dt = [datetime.datetime.strptime(e, BACKFILL_HOUR_FMT) for e in (options.backfill_start, options.backfill_end)]
+    ledger_url = options.ledger or 'athena_ctas_backfill_{}_{}.jsonl'.format(start_dt.strftime('%Y%m%d%H'),
+      end_dt.strftime('%Y%m%d%H'))
+
+    summary = asyncio.run(backfill(get_athena_client(), start_dt, end_dt,
+      concurrency=options.concurrency,
+      ledger=create_ledger(ledger_url)))
+    print_backfill_summary(summary)
+    sys.exit(1 if summary['failed'] else 0)
 
   event = {
     "id": "cdc73f9d-aea9-11e3-9d5a-835b769c0d9c",
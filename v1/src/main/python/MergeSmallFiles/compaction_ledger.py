@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import json
+import os
+
+import boto3
+
+#XXX: The hours of the ledger, e.g. 2023-01-31T12
+HOUR_FMT = '%Y-%m-%dT%H'
+TIME_FMT = '%Y-%m-%dT%H:%M:%SZ'
+
+#XXX: Statuses of the hours not to compact again. EXISTING hours were compacted without being recorded,
+# and EMPTY hours had no objects to compact. VERIFIED hours have as many rows as their objects, and MISMATCHED hours
+# still did not after being compacted again, which needs a look.
+DONE_STATUSES = ('SUCCEEDED', 'EXISTING', 'EMPTY', 'VERIFIED', 'MISMATCHED')
+#XXX: Statuses of the hours compacted by this function, whose statistics are comparable
+COMPACTED_STATUSES = ('SUCCEEDED', 'VERIFIED')
+#XXX: Statuses of the hours to verify with VERIFY_COMPACTION
+UNVERIFIED_STATUSES = ('SUCCEEDED', 'EXISTING')
+#XXX: DIRTY hours had objects created after they were compacted, and are compacted again.
+DIRTY_STATUS = 'DIRTY'
+
+
+class FileLedger:
+  """The compaction ledger in a local JSON lines file, e.g. the checkpoint of a backfill run on a local machine."""
+
+  def __init__(self, path):
+    self.path = path
+
+  def get_records(self, ledger_id, start_hour, end_hour):
+    records = {}
+    if not os.path.exists(self.path):
+      return records
+
+    with open(self.path) as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError as _:
+          #XXX: The last line may be truncated by a crash.
+          continue
+        if record.get('ledger_id', ledger_id) == ledger_id and start_hour <= record['hour'] < end_hour:
+          records[record['hour']] = record
+    return records
+
+  def put_record(self, ledger_id, record):
+    with open(self.path, 'a') as f:
+      f.write(json.dumps(dict(record, ledger_id=ledger_id)) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+
+
+class S3Ledger:
+  """The compaction ledger in S3 objects named `{prefix}/{ledger_id}/hour={hour}/{status}.json`.
+
+  A page of ListObjectsV2 tells the status of up to 1000 records, and only the records
+  of unfinished hours are read, e.g. for the CTAS queries to take over.
+  """
+
+  def __init__(self, s3_client, bucket, prefix):
+    self.s3_client = s3_client
+    self.bucket = bucket
+    self.prefix = prefix.strip('/')
+
+  def get_records(self, ledger_id, start_hour, end_hour):
+    prefix = '{}/{}/hour='.format(self.prefix, ledger_id).lstrip('/')
+    latest = {}
+    paginator = self.s3_client.get_paginator('list_objects_v2')
+    objects = (e for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, StartAfter=prefix + start_hour)
+      for e in page.get('Contents', []))
+    for e in objects:
+      hour, _, name = e['Key'][len(prefix):].partition('/')
+      if hour >= end_hour:
+        break
+      status = name[:-len('.json')]
+      prev = latest.get(hour)
+      #XXX: LastModified has a resolution of a second, so the final status of an hour wins.
+      if prev is None or (status in DONE_STATUSES, e['LastModified']) > (prev['status'] in DONE_STATUSES, prev['LastModified']):
+        latest[hour] = dict(e, status=status)
+
+    records = {}
+    for hour, e in latest.items():
+      if e['status'] in DONE_STATUSES:
+        #XXX: The record is written as soon as the hour is compacted.
+        records[hour] = {'hour': hour, 'status': e['status'], 'compacted_at': e['LastModified'].strftime(TIME_FMT)}
+      else:
+        records[hour] = json.loads(self.s3_client.get_object(Bucket=self.bucket, Key=e['Key'])['Body'].read())
+    return records
+
+  def put_record(self, ledger_id, record):
+    key = '{}/{}/hour={}/{}.json'.format(self.prefix, ledger_id, record['hour'], record['status']).lstrip('/')
+    self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=json.dumps(record).encode('utf-8'),
+      ContentType='application/json')
+
+
+class DynamoDBLedger:
+  """The compaction ledger in a DynamoDB table with the partition key `ledger_id` and the sort key `hour`.
+
+  A Query of the hours to catch up reads their records at once.
+  """
+
+  def __init__(self, dynamodb_client, table_name):
+    self.dynamodb_client = dynamodb_client
+    self.table_name = table_name
+
+  def get_records(self, ledger_id, start_hour, end_hour):
+    records = {}
+    paginator = self.dynamodb_client.get_paginator('query')
+    for page in paginator.paginate(TableName=self.table_name,
+        KeyConditionExpression='ledger_id = :ledger_id AND #hour BETWEEN :start_hour AND :end_hour',
+        ExpressionAttributeNames={'#hour': 'hour'},
+        ExpressionAttributeValues={
+          ':ledger_id': {'S': ledger_id},
+          ':start_hour': {'S': start_hour},
+          ':end_hour': {'S': end_hour}
+        },
+        ConsistentRead=True):
+      for item in page['Items']:
+        if item['hour']['S'] < end_hour:
+          records[item['hour']['S']] = json.loads(item['record']['S'])
+    return records
+
+  def put_record(self, ledger_id, record):
+    self.dynamodb_client.put_item(TableName=self.table_name, Item={
+      'ledger_id': {'S': ledger_id},
+      'hour': {'S': record['hour']},
+      'status': {'S': record['status']},
+      'record': {'S': json.dumps(record)}
+    })
+
+
+def create_ledger(ledger_url, s3_client=None, region_name=None):
+  """Returns the compaction ledger of `ledger_url`: `dynamodb://{table}`, `s3://{bucket}/{prefix}`, or a local file path."""
+  if ledger_url.startswith('dynamodb://'):
+    return DynamoDBLedger(boto3.client('dynamodb', region_name=region_name), ledger_url[len('dynamodb://'):])
+  if ledger_url.startswith('s3://'):
+    bucket, _, prefix = ledger_url[len('s3://'):].partition('/')
+    return S3Ledger(s3_client or boto3.client('s3', region_name=region_name), bucket, prefix)
+  return FileLedger(ledger_url)
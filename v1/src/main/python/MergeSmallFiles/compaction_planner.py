@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import math
+import sys
+
+import compaction_ledger
+
+#XXX: Athena writes a file per bucket of a partition.
+MAX_BUCKET_COUNT = 100
+
+
+def get_parquet_to_json_ratio(records, compression, source_format, source_compression, default_ratio):
+  """Returns the ratio of output bytes to input bytes of the hours in `records` compacted from `source_format`
+  compressed with `source_compression` into `compression`, or `default_ratio` if there are none."""
+  #XXX: Hours recorded without a codec were compacted with SNAPPY, and those without a source format from uncompressed JSON.
+  done = [e for e in records.values() if e.get('status') in compaction_ledger.COMPACTED_STATUSES
+    and e.get('input_bytes') and e.get('output_bytes')
+    and e.get('compression', 'SNAPPY') == compression and e.get('source_format', 'json') == source_format
+    and e.get('source_compression', 'UNCOMPRESSED') == source_compression]
+  if not done:
+    return default_ratio
+  return sum(e['output_bytes'] for e in done) / sum(e['input_bytes'] for e in done)
+
+
+def plan_hour(hour, input_files, input_bytes, ratio, target_file_size_mb):
+  """Returns the plan to compact an hour into files of about `target_file_size_mb`, one file per bucket."""
+  predicted_bytes = int(input_bytes * ratio)
+  bucket_count = min(MAX_BUCKET_COUNT, max(1, math.ceil(predicted_bytes / (target_file_size_mb * 1024**2))))
+  return {
+    'hour': hour,
+    'input_files': input_files,
+    'input_bytes': input_bytes,
+    'predicted_bytes': predicted_bytes,
+    'bucket_count': bucket_count,
+    'predicted_files': bucket_count if input_files else 0
+  }
+
+
+def is_empty(plan):
+  return plan is not None and not plan['input_files']
+
+
+def log_plan(plan):
+  print('[INFO] Plan {hour}: {input_files} objects of {input_mb:.1f} MB, {bucket_count} buckets, '
+    '{predicted_files} files of {predicted_mb:.1f} MB predicted'.format(input_mb=plan['input_bytes'] / 1024**2,
+      predicted_mb=plan['predicted_bytes'] / 1024**2, **plan), file=sys.stderr)
+
+
+def log_plan_result(plan, output):
+  print('[INFO] Compacted {}: {} files of {:.1f} MB predicted, {} files of {:.1f} MB actual'.format(plan['hour'],
+    plan['predicted_files'], plan['predicted_bytes'] / 1024**2, output.get('output_files', '-'),
+    output.get('output_bytes', 0) / 1024**2), file=sys.stderr)
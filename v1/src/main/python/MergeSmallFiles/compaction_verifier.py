@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import contextlib
+import re
+import struct
+
+import source_compression
+
+PARQUET_MAGIC = b'PAR1'
+#XXX: The footer of a merged file is a few KB, so a ranged GET of the last 64 KB usually reads it at once.
+FOOTER_READ_BYTES = 64 * 1024
+#XXX: Bytes of a JSON object read at a time
+CHUNK_SIZE = 1024 * 1024
+#XXX: A record starts after a newline, and blank lines are no records.
+RECORD_START = re.compile(rb'\n[^\n]')
+
+#XXX: Types of the Thrift compact protocol
+# https://github.com/apache/thrift/blob/master/doc/specs/thrift-compact-protocol.md
+BOOLEAN_TRUE, BOOLEAN_FALSE, BYTE, I16, I32, I64, DOUBLE, BINARY, LIST, SET, MAP, STRUCT = range(1, 13)
+
+#XXX: The field id of `num_rows` of FileMetaData in parquet.thrift
+NUM_ROWS_FIELD_ID = 3
+
+
+class ParquetFooterError(Exception):
+  pass
+
+
+class CompactReader:
+  """Reads the fields of a Thrift struct in the compact protocol, skipping those not asked for."""
+
+  def __init__(self, data):
+    self.data = data
+    self.pos = 0
+
+  def read_byte(self):
+    if self.pos >= len(self.data):
+      raise ParquetFooterError('Unexpected end of the footer at {}'.format(self.pos))
+    self.pos += 1
+    return self.data[self.pos - 1]
+
+  def read_varint(self):
+    shift, value = (0, 0)
+    while True:
+      b = self.read_byte()
+      value |= (b & 0x7f) << shift
+      if not b & 0x80:
+        return value
+      shift += 7
+
+  def read_zigzag(self):
+    n = self.read_varint()
+    return (n >> 1) ^ -(n & 1)
+
+  def read_field_header(self, last_field_id):
+    """Returns (field id, type) of the next field of a struct, or (None, None) at its end."""
+    b = self.read_byte()
+    if b == 0:
+      return (None, None)
+    delta, field_type = (b >> 4, b & 0x0f)
+    field_id = last_field_id + delta if delta else self.read_zigzag()
+    return (field_id, field_type)
+
+  def skip(self, field_type):
+    if field_type in (BOOLEAN_TRUE, BOOLEAN_FALSE):
+      return
+    if field_type == BYTE:
+      self.pos += 1
+    elif field_type in (I16, I32, I64):
+      self.read_varint()
+    elif field_type == DOUBLE:
+      self.pos += 8
+    elif field_type == BINARY:
+      size = self.read_varint()
+      self.pos += size
+    elif field_type in (LIST, SET):
+      b = self.read_byte()
+      size, elem_type = (b >> 4, b & 0x0f)
+      if size == 15:
+        size = self.read_varint()
+      for _ in range(size):
+        #XXX: A boolean of a list takes a byte.
+        if elem_type in (BOOLEAN_TRUE, BOOLEAN_FALSE):
+          self.pos += 1
+        else:
+          self.skip(elem_type)
+    elif field_type == MAP:
+      size = self.read_varint()
+      if size:
+        b = self.read_byte()
+        for _ in range(size):
+          self.skip(b >> 4)
+          self.skip(b & 0x0f)
+    elif field_type == STRUCT:
+      field_id = 0
+      while True:
+        field_id, elem_type = self.read_field_header(field_id)
+        if field_id is None:
+          return
+        self.skip(elem_type)
+    else:
+      raise ParquetFooterError('Unknown type {} at {}'.format(field_type, self.pos))
+
+
+def get_num_rows(file_metadata):
+  """Returns `num_rows` of the FileMetaData of a Parquet footer, without parsing its schema and row groups."""
+  reader = CompactReader(file_metadata)
+  field_id = 0
+  while True:
+    field_id, field_type = reader.read_field_header(field_id)
+    if field_id is None:
+      raise ParquetFooterError('No num_rows in the footer')
+    if field_id == NUM_ROWS_FIELD_ID and field_type == I64:
+      return reader.read_zigzag()
+    reader.skip(field_type)
+
+
+def read_num_rows(storage, location):
+  """Returns the number of rows of a Parquet file from its footer, in one or two ranged GETs."""
+  tail = storage.read_tail(location, FOOTER_READ_BYTES)
+  if len(tail) < 12 or tail[-4:] != PARQUET_MAGIC:
+    raise ParquetFooterError('Not a Parquet file: {}'.format(location))
+  footer_size = struct.unpack('<I', tail[-8:-4])[0]
+  if footer_size + 8 > len(tail):
+    tail = storage.read_tail(location, footer_size + 8)
+  return get_num_rows(tail[-8 - footer_size:-8])
+
+
+def count_json_rows(storage, location, chunk_size=CHUNK_SIZE, compression='UNCOMPRESSED'):
+  """Returns the number of records of a JSON Lines object compressed with `compression`, streaming it a chunk at a time."""
+  num_rows, last_byte = (0, b'\n')
+  #XXX: The body of an S3 object is closed, not used as a context manager, by older botocore.
+  with contextlib.closing(storage.open(location)) as f:
+    for chunk in source_compression.iter_chunks(f, compression, chunk_size):
+      #XXX: The last byte of the chunk before tells whether the chunk starts a record.
+      num_rows += len(RECORD_START.findall(last_byte + chunk))
+      last_byte = chunk[-1:]
+  return num_rows
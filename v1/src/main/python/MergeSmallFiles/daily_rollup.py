@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import os
+import asyncio
+import datetime
+import time
+
+import botocore.exceptions
+
+import athena_ctas
+import compaction_ledger
+import compaction_planner
+import json_to_parquet
+import late_data
+import tracing
+
+#XXX: The daily table is partitioned by year, month and day, and has `hour` as a column.
+DAILY_TABLE_NAME = os.getenv('DAILY_TABLE_NAME') or '{}_daily'.format(athena_ctas.NEW_TABLE_NAME)
+DAILY_OUTPUT_PREFIX = os.getenv('DAILY_OUTPUT_PREFIX')
+#XXX: A day is closed this long after its end, once its last hour is compacted.
+ROLLUP_DELAY_HOURS = float(os.getenv('ROLLUP_DELAY_HOURS', '2'))
+#XXX: The number of closed days to roll up, e.g. to catch up after failed runs
+ROLLUP_DAYS = int(os.getenv('ROLLUP_DAYS', '3'))
+#XXX: The hourly files rolled up, and the files of the previous version of a day, are deleted this long after the switch,
+# so that the queries running at the switch can still read them.
+ROLLUP_GC_GRACE_HOURS = float(os.getenv('ROLLUP_GC_GRACE_HOURS', '1'))
+
+ROLLUP_DAY_FMT = '%Y-%m-%d'
+ROLLUP_VERSION_FMT = '%Y%m%dT%H%M%SZ'
+
+#XXX: Parameters of a partition of the daily table, which change with its location in the same call to AWS Glue
+ROLLED_UP_AT_PARAMETER = 'rollup.rolled_up_at'
+PREVIOUS_LOCATION_PARAMETER = 'rollup.previous_location'
+
+DAILY_LOCATION_FMT = '''{output_prefix}/year={year}/month={month:02}/day={day:02}/rollup={version}/'''
+
+ROLLUP_QUERY_FMT = '''CREATE TABLE {database}.tmp_{daily_table_name}
+WITH (
+  external_location='{location}',
+  format = 'PARQUET',
+  write_compression = '{compression}'{compression_level}{bucketing})
+AS SELECT {columns}
+FROM {database}.{hourly_table_name}
+WHERE year={year} AND month={month} AND day={day}{hourly_hours}{daily_rows}{order_by}
+WITH DATA
+'''
+
+#XXX: The rows of the hours without hourly files are kept from the current version of the day.
+DAILY_ROWS_FMT = '''
+UNION ALL
+SELECT {columns}
+FROM {database}.{daily_table_name}
+WHERE year={year} AND month={month} AND day={day} AND hour NOT IN ({hours})'''
+
+
+def get_columns():
+  columns = athena_ctas.COLUMN_NAMES
+  if columns.strip() == '*':
+    #XXX: Both sides of UNION ALL need the same columns in the same order.
+    columns = ','.join(name for name, _ in json_to_parquet.TABLE_COLUMNS)
+  return '{}, hour'.format(columns)
+
+
+def get_day_location(output_prefix, day_dt):
+  return '{output_prefix}/year={year}/month={month:02}/day={day:02}/'.format(output_prefix=output_prefix,
+    year=day_dt.year, month=day_dt.month, day=day_dt.day)
+
+
+def list_hourly_files(day_dt):
+  """Returns the merged files of the hours of a day in the hourly table by hour, with their size and LastModified."""
+  bucket, prefix = json_to_parquet.S3Storage.split(get_day_location(athena_ctas.OUTPUT_PREFIX, day_dt))
+  files = {}
+  paginator = athena_ctas.get_s3_client().get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+    for e in page.get('Contents', []):
+      matched = late_data.HOUR_KEY_PATTERN.search(e['Key'])
+      if matched is None:
+        continue
+      files.setdefault(int(matched.group(4)), []).append(('s3://{}/{}'.format(bucket, e['Key']), e['Size'], e['LastModified']))
+  return files
+
+
+def get_daily_partition(glue_client, day_dt):
+  try:
+    response = glue_client.get_partition(DatabaseName=athena_ctas.NEW_DATABASE, TableName=DAILY_TABLE_NAME,
+      PartitionValues=[str(day_dt.year), str(day_dt.month), str(day_dt.day)])
+  except botocore.exceptions.ClientError as ex:
+    if ex.response.get('Error', {}).get('Code') == 'EntityNotFoundException':
+      return None
+    raise
+  return response['Partition']
+
+
+def get_rolled_up_at(partition):
+  return datetime.datetime.strptime(partition['Parameters'][ROLLED_UP_AT_PARAMETER],
+    compaction_ledger.TIME_FMT).replace(tzinfo=datetime.timezone.utc)
+
+
+def get_unfinished_hours(ledger, day_dt):
+  """Returns the hours of a day not compacted, or compacted again, according to the compaction ledger."""
+  start_hour, end_hour = [(day_dt + datetime.timedelta(days=e)).strftime(athena_ctas.BACKFILL_HOUR_FMT) for e in (0, 1)]
+  records = ledger.get_records(athena_ctas.get_ledger_id(), start_hour, end_hour)
+  return [(day_dt + datetime.timedelta(hours=e)).strftime(athena_ctas.BACKFILL_HOUR_FMT) for e in range(24)
+    if records.get((day_dt + datetime.timedelta(hours=e)).strftime(athena_ctas.BACKFILL_HOUR_FMT), {}).get('status')
+      not in compaction_ledger.DONE_STATUSES]
+
+
+def plan_day(partition, hourly_files, now):
+  """Returns what a run does with a closed day: (roll up, collect garbage).
+
+  A day is rolled up if it has no partition in the daily table yet, or if hourly files were written after its
+  last roll-up, e.g. by late data. The hourly files rolled up and the previous version of the day are deleted
+  ROLLUP_GC_GRACE_HOURS after the roll-up.
+  """
+  if partition is None:
+    return (bool(hourly_files), False)
+
+  rolled_up_at = get_rolled_up_at(partition)
+  files = [e for v in hourly_files.values() for e in v]
+  rollup = any(last_modified > rolled_up_at for _, _, last_modified in files)
+  garbage = any(last_modified <= rolled_up_at for _, _, last_modified in files) \
+    or bool(partition['Parameters'].get(PREVIOUS_LOCATION_PARAMETER))
+  gc = garbage and now - rolled_up_at >= datetime.timedelta(hours=ROLLUP_GC_GRACE_HOURS)
+  return (rollup, gc)
+
+
+def get_rollup_query(day_dt, location, hours, bucket_count, keep_daily_rows):
+  """Returns the CTAS query rolling up a day from the hourly files of `hours`, and from the current version of the day
+  for the other hours if `keep_daily_rows` is set."""
+  columns = get_columns()
+  year, month, day = (day_dt.year, day_dt.month, day_dt.day)
+  hour_list = ', '.join(str(e) for e in sorted(hours))
+  hourly_hours = ' AND hour IN ({})'.format(hour_list) if keep_daily_rows else ''
+  daily_rows = DAILY_ROWS_FMT.format(columns=columns, database=athena_ctas.NEW_DATABASE, daily_table_name=DAILY_TABLE_NAME,
+    year=year, month=month, day=day, hours=hour_list) if keep_daily_rows else ''
+
+  compression_level = ''
+  if athena_ctas.PARQUET_COMPRESSION_LEVEL is not None and athena_ctas.PARQUET_COMPRESSION == 'ZSTD':
+    compression_level = athena_ctas.COMPRESSION_LEVEL_FMT.format(level=athena_ctas.PARQUET_COMPRESSION_LEVEL)
+  bucketing = athena_ctas.BUCKETING_FMT.format(column=athena_ctas.get_bucket_column(), bucket_count=bucket_count)
+  order_by = athena_ctas.ORDER_BY_FMT.format(columns=', '.join(athena_ctas.CLUSTER_BY)) if athena_ctas.CLUSTER_BY else ''
+
+  return ROLLUP_QUERY_FMT.format(database=athena_ctas.NEW_DATABASE,
+    daily_table_name='{}_{:%Y%m%d}'.format(DAILY_TABLE_NAME, day_dt),
+    hourly_table_name=athena_ctas.NEW_TABLE_NAME, columns=columns, location=location,
+    compression=athena_ctas.PARQUET_COMPRESSION, compression_level=compression_level, bucketing=bucketing,
+    year=year, month=month, day=day, hourly_hours=hourly_hours, daily_rows=daily_rows, order_by=order_by)
+
+
+def start_query(athena_client, day_dt, query, output_location):
+  print('[INFO] QueryString:\n{}'.format(query), file=sys.stderr)
+  print('[INFO] OutputLocation: {}'.format(output_location), file=sys.stderr)
+
+  if athena_ctas.DRY_RUN:
+    print('[INFO] End of dry-run', file=sys.stderr)
+    return None
+
+  response = athena_client.start_query_execution(
+    QueryString=query,
+    QueryExecutionContext={
+      'Database': athena_ctas.NEW_DATABASE
+    },
+    ResultConfiguration={
+      'OutputLocation': output_location
+    },
+    WorkGroup=athena_ctas.WORK_GROUP
+  )
+  print('[INFO] QueryExecutionId: {}'.format(response['QueryExecutionId']), file=sys.stderr)
+  return response['QueryExecutionId']
+
+
+async def drop_tmp_table(athena_client, day_dt, deadline=None):
+  tmp_table_name = '{}_{:%Y%m%d}'.format(DAILY_TABLE_NAME, day_dt)
+  query = 'DROP TABLE IF EXISTS {}.tmp_{}'.format(athena_ctas.NEW_DATABASE, tmp_table_name)
+  output_location = '{}/tmp_{}'.format(athena_ctas.STAGING_OUTPUT_PREFIX, tmp_table_name)
+  await athena_ctas.run_query(athena_client, f'drop_tmp_table:{DAILY_TABLE_NAME}', start_query, day_dt, query, output_location,
+    deadline=deadline)
+
+
+def register_hourly_partitions(glue_client, day_dt, hours):
+  """Registers the partitions of the hours in the hourly table, e.g. of an hour compacted again after its partition was
+  dropped by the garbage collection of a roll-up."""
+  values = [[str(day_dt.year), str(day_dt.month), str(day_dt.day), str(e)] for e in sorted(hours)]
+  storage_descriptor = athena_ctas.get_table_storage_descriptor(glue_client, athena_ctas.NEW_DATABASE, athena_ctas.NEW_TABLE_NAME)
+  response = glue_client.batch_create_partition(DatabaseName=athena_ctas.NEW_DATABASE, TableName=athena_ctas.NEW_TABLE_NAME,
+    PartitionInputList=[{'Values': e, 'StorageDescriptor': dict(storage_descriptor,
+      Location=athena_ctas.get_hour_location(athena_ctas.OUTPUT_PREFIX, day_dt.replace(hour=int(e[3]))))} for e in values])
+  errors = [e for e in response.get('Errors', []) if e['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException']
+  if errors:
+    raise athena_ctas.PartitionRegistrationError('Failed to create partitions in {}.{}: {}'.format(athena_ctas.NEW_DATABASE,
+      athena_ctas.NEW_TABLE_NAME, [e['PartitionValues'] for e in errors]))
+  athena_ctas.KNOWN_PARTITIONS[(athena_ctas.NEW_DATABASE, athena_ctas.NEW_TABLE_NAME)].update(tuple(e) for e in values)
+
+
+def switch_daily_partition(glue_client, day_dt, partition, location, rolled_up_at):
+  """Points the partition of a day in the daily table to the location of its new version.
+
+  A single call to AWS Glue creates or updates the partition, so a query reads either version of the day, never both.
+  """
+  values = [str(day_dt.year), str(day_dt.month), str(day_dt.day)]
+  storage_descriptor = athena_ctas.get_table_storage_descriptor(glue_client, athena_ctas.NEW_DATABASE, DAILY_TABLE_NAME)
+  partition_input = {
+    'Values': values,
+    'StorageDescriptor': dict(storage_descriptor, Location=location),
+    'Parameters': {
+      ROLLED_UP_AT_PARAMETER: rolled_up_at.strftime(compaction_ledger.TIME_FMT),
+      PREVIOUS_LOCATION_PARAMETER: partition['StorageDescriptor']['Location'] if partition else ''
+    }
+  }
+  if partition is None:
+    glue_client.create_partition(DatabaseName=athena_ctas.NEW_DATABASE, TableName=DAILY_TABLE_NAME,
+      PartitionInput=partition_input)
+  else:
+    glue_client.update_partition(DatabaseName=athena_ctas.NEW_DATABASE, TableName=DAILY_TABLE_NAME,
+      PartitionValueList=values, PartitionInput=partition_input)
+  print('[INFO] Switched {} of {}.{} to {}'.format(day_dt.strftime(ROLLUP_DAY_FMT), athena_ctas.NEW_DATABASE, DAILY_TABLE_NAME,
+    location), file=sys.stderr)
+
+
+async def rollup_day(athena_client, glue_client, day_dt, partition, hourly_files, deadline=None):
+  """Merges the hourly files of a day into the files of a new version of the day, and switches the daily table to it.
+  Returns the statistics of the roll-up."""
+  #XXX: Files written from a second before the roll-up on are rolled up again by the next run.
+  rolled_up_at = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0) - datetime.timedelta(seconds=1)
+  location = DAILY_LOCATION_FMT.format(output_prefix=DAILY_OUTPUT_PREFIX, year=day_dt.year, month=day_dt.month,
+    day=day_dt.day, version=rolled_up_at.strftime(ROLLUP_VERSION_FMT))
+
+  input_files, input_bytes = (sum(len(v) for v in hourly_files.values()), sum(e[1] for v in hourly_files.values() for e in v))
+  keep_daily_rows = partition is not None and len(hourly_files) < 24
+  if keep_daily_rows:
+    daily_files = await asyncio.to_thread(athena_ctas.get_storage().list, partition['StorageDescriptor']['Location'])
+    input_files, input_bytes = (input_files + len(daily_files), input_bytes + sum(size for _, size in daily_files))
+  #XXX: Parquet files are merged without being compressed again, so the ratio of output to input bytes is about 1.
+  plan = compaction_planner.plan_hour(day_dt.strftime(athena_ctas.BACKFILL_HOUR_FMT), input_files, input_bytes, 1.0,
+    athena_ctas.TARGET_FILE_SIZE_MB)
+  query = get_rollup_query(day_dt, location, hourly_files.keys(), plan['bucket_count'], keep_daily_rows)
+
+  if not athena_ctas.PARTITION_PROJECTION and not athena_ctas.DRY_RUN:
+    await asyncio.to_thread(register_hourly_partitions, glue_client, day_dt, hourly_files.keys())
+
+  #XXX: The temporary table of a run stopped before dropping it is dropped first.
+  await drop_tmp_table(athena_client, day_dt, deadline=deadline)
+  output_location = '{}/tmp_{}_{:%Y%m%d}'.format(athena_ctas.STAGING_OUTPUT_PREFIX, DAILY_TABLE_NAME, day_dt)
+  query_execution = await athena_ctas.run_query(athena_client, f'rollup_ctas:{DAILY_TABLE_NAME}', start_query, day_dt,
+    query, output_location, deadline=deadline)
+  if query_execution is None:
+    return None
+
+  await asyncio.to_thread(switch_daily_partition, glue_client, day_dt, partition, location, rolled_up_at)
+  await drop_tmp_table(athena_client, day_dt, deadline=deadline)
+
+  output_files, output_bytes = await asyncio.to_thread(athena_ctas.list_location, location)
+  print('[INFO] Rolled up {}: {} files of {:.1f} MB into {} files of {:.1f} MB'.format(day_dt.strftime(ROLLUP_DAY_FMT),
+    input_files, input_bytes / 1024**2, output_files, output_bytes / 1024**2), file=sys.stderr)
+  return {'input_files': input_files, 'input_bytes': input_bytes, 'output_files': output_files, 'output_bytes': output_bytes}
+
+
+def collect_garbage(glue_client, day_dt, partition, hourly_files):
+  """Deletes the hourly files rolled up into the current version of a day with their partitions, and the files of the
+  previous version of the day. Returns the number of files deleted."""
+  rolled_up_at = get_rolled_up_at(partition)
+  storage = athena_ctas.get_storage()
+  files = [location for v in hourly_files.values() for location, _, last_modified in v if last_modified <= rolled_up_at]
+  #XXX: Hours with files written after the roll-up keep their partitions for the next roll-up.
+  hours = [k for k, v in hourly_files.items() if all(last_modified <= rolled_up_at for _, _, last_modified in v)]
+
+  previous_location = partition['Parameters'].get(PREVIOUS_LOCATION_PARAMETER)
+  if previous_location:
+    files.extend(location for location, _ in storage.list(previous_location))
+
+  print('[INFO] Garbage of {}: {} files, {} hourly partitions{}'.format(day_dt.strftime(ROLLUP_DAY_FMT), len(files), len(hours),
+    ', the previous version at {}'.format(previous_location) if previous_location else ''), file=sys.stderr)
+  if athena_ctas.DRY_RUN:
+    return 0
+
+  storage.delete(files)
+  if hours and not athena_ctas.PARTITION_PROJECTION:
+    values = [[str(day_dt.year), str(day_dt.month), str(day_dt.day), str(e)] for e in sorted(hours)]
+    glue_client.batch_delete_partition(DatabaseName=athena_ctas.NEW_DATABASE, TableName=athena_ctas.NEW_TABLE_NAME,
+      PartitionsToDelete=[{'Values': e} for e in values])
+    athena_ctas.KNOWN_PARTITIONS[(athena_ctas.NEW_DATABASE, athena_ctas.NEW_TABLE_NAME)].difference_update(tuple(e) for e in values)
+
+  if previous_location:
+    #XXX: The location stays the same, so the day is not switched.
+    glue_client.update_partition(DatabaseName=athena_ctas.NEW_DATABASE, TableName=DAILY_TABLE_NAME,
+      PartitionValueList=partition['Values'],
+      PartitionInput={
+        'Values': partition['Values'],
+        'StorageDescriptor': partition['StorageDescriptor'],
+        'Parameters': dict(partition['Parameters'], **{PREVIOUS_LOCATION_PARAMETER: ''})
+      })
+  return len(files)
+
+
+async def rollup_days(athena_client, glue_client, day_dts, ledger=None, now=None, deadline=None):
+  """Rolls up the closed days, and collects the garbage of the days rolled up before. Returns the summary of the run."""
+  now = now or datetime.datetime.now(datetime.timezone.utc)
+  summary = {'days': len(day_dts), 'rolled_up': [], 'collected': [], 'deferred': [], 'failed': [], 'deleted_files': 0}
+  for day_dt in day_dts:
+    day = day_dt.strftime(ROLLUP_DAY_FMT)
+    with tracing.span('rollup_day', day=day):
+      try:
+        hourly_files, partition = await asyncio.gather(asyncio.to_thread(list_hourly_files, day_dt),
+          asyncio.to_thread(get_daily_partition, glue_client, day_dt))
+        rollup, gc = plan_day(partition, hourly_files, now)
+
+        if gc:
+          summary['deleted_files'] += await asyncio.to_thread(collect_garbage, glue_client, day_dt, partition, hourly_files)
+          summary['collected'].append(day)
+          if rollup and not athena_ctas.DRY_RUN:
+            partition = await asyncio.to_thread(get_daily_partition, glue_client, day_dt)
+            hourly_files = await asyncio.to_thread(list_hourly_files, day_dt)
+
+        if not rollup:
+          continue
+        unfinished_hours = await asyncio.to_thread(get_unfinished_hours, ledger, day_dt) if ledger is not None else []
+        if unfinished_hours:
+          print('[WARNING] Defer the roll-up of {} until its hours are compacted: {}'.format(day,
+            ', '.join(unfinished_hours)), file=sys.stderr)
+          summary['deferred'].append(day)
+          continue
+        if partition is not None and partition['Parameters'].get(PREVIOUS_LOCATION_PARAMETER):
+          #XXX: The previous version of the day may still be read until the garbage of the last switch is collected.
+          print('[INFO] Defer the roll-up of {} until the previous version is deleted'.format(day), file=sys.stderr)
+          summary['deferred'].append(day)
+          continue
+
+        await rollup_day(athena_client, glue_client, day_dt, partition, hourly_files, deadline=deadline)
+        summary['rolled_up'].append(day)
+      except (athena_ctas.AthenaQueryError, athena_ctas.PartitionRegistrationError,
+          botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as ex:
+        print('[ERROR] Failed to roll up {}: {}'.format(day, ex), file=sys.stderr)
+        summary['failed'].append(day)
+  return summary
+
+
+def get_closed_days(now):
+  """Returns the last ROLLUP_DAYS days ended at least ROLLUP_DELAY_HOURS before `now`, the oldest first."""
+  last_day = (now - datetime.timedelta(hours=ROLLUP_DELAY_HOURS)).replace(tzinfo=None, hour=0, minute=0, second=0,
+    microsecond=0) - datetime.timedelta(days=1)
+  return [last_day - datetime.timedelta(days=e) for e in reversed(range(ROLLUP_DAYS))]
+
+
+def print_rollup_summary(summary):
+  print('[INFO] Roll-up of {days} days: {num_rolled_up} rolled up, {num_collected} collected ({deleted_files} files deleted), '
+    '{num_deferred} deferred, {num_failed} failed'.format(num_rolled_up=len(summary['rolled_up']),
+      num_collected=len(summary['collected']), num_deferred=len(summary['deferred']), num_failed=len(summary['failed']),
+      **summary), file=sys.stderr)
+
+
+@tracing.trace('daily_rollup')
+def lambda_handler(event, context):
+  now = datetime.datetime.strptime(event['time'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
+
+  deadline = None
+  if hasattr(context, 'get_remaining_time_in_millis'):
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - athena_ctas.QUERY_WAIT_MARGIN
+
+  ledger = athena_ctas.get_ledger() if athena_ctas.COMPACTION_LEDGER else None
+  athena_ctas.QUERY_STATISTICS.clear()
+  summary = asyncio.run(rollup_days(athena_ctas.get_athena_client(), athena_ctas.get_glue_client(), get_closed_days(now),
+    ledger=ledger, now=datetime.datetime.now(datetime.timezone.utc), deadline=deadline))
+  print_rollup_summary(summary)
+  if summary['failed']:
+    raise athena_ctas.CompactionError('Failed to roll up days: {}'.format(', '.join(summary['failed'])))
+  return summary
+
+
+if __name__ == '__main__':
+  import argparse
+
+  parser = argparse.ArgumentParser(description='Roll up the hourly merged files of closed days into a daily table')
+  parser.add_argument('--region-name', default='us-east-1',
+    help='aws region name')
+  parser.add_argument('--database', default='mydatabase',
+    help='aws athena database name of the hourly and the daily tables')
+  parser.add_argument('--hourly-table-name', default='restapi_access_log_parquet',
+    help='aws athena table name of the hourly merged files')
+  parser.add_argument('--daily-table-name',
+    help='aws athena table name of the daily rolled up files (default: {hourly-table-name}_daily)')
+  parser.add_argument('--work-group', default='primary',
+    help='aws athena work group')
+  parser.add_argument('--output-prefix', required=True,
+    help='s3 path for the hourly table')
+  parser.add_argument('--daily-output-prefix', required=True,
+    help='s3 path for the daily table')
+  parser.add_argument('--staging-output-prefix', required=True,
+    help='s3 path for aws athena tmp table')
+  parser.add_argument('--column-names', default='*',
+    help='selectable column names of the hourly table')
+  parser.add_argument('--partition-projection', action='store_true',
+    help='skip registering and dropping the partitions of the hourly table with partition projection')
+  parser.add_argument('--day', nargs='+',
+    help='the days to roll up ex) 2020-02-28 (default: the last {} closed days)'.format(ROLLUP_DAYS))
+  parser.add_argument('--ledger', default=athena_ctas.COMPACTION_LEDGER or None,
+    help='the compaction ledger of the hourly table, to defer the days with hours not compacted')
+  parser.add_argument('--run', action='store_true',
+    help='run the roll-up queries')
+
+  options = parser.parse_args()
+
+  athena_ctas.DRY_RUN = False if options.run else True
+  athena_ctas.AWS_REGION = options.region_name
+  athena_ctas.NEW_DATABASE = options.database
+  athena_ctas.NEW_TABLE_NAME = options.hourly_table_name
+  athena_ctas.WORK_GROUP = options.work_group
+  athena_ctas.OUTPUT_PREFIX = options.output_prefix
+  athena_ctas.STAGING_OUTPUT_PREFIX = options.staging_output_prefix
+  athena_ctas.COLUMN_NAMES = options.column_names
+  athena_ctas.PARTITION_PROJECTION = options.partition_projection
+  DAILY_TABLE_NAME = options.daily_table_name or '{}_daily'.format(options.hourly_table_name)
+  DAILY_OUTPUT_PREFIX = options.daily_output_prefix
+
+  now = datetime.datetime.now(datetime.timezone.utc)
+  day_dts = [datetime.datetime.strptime(e, ROLLUP_DAY_FMT) for e in options.day] if options.day else get_closed_days(now)
+  ledger = athena_ctas.create_ledger(options.ledger) if options.ledger else None
+  summary = asyncio.run(rollup_days(athena_ctas.get_athena_client(), athena_ctas.get_glue_client(), day_dts,
+    ledger=ledger, now=now))
+  print_rollup_summary(summary)
+  sys.exit(1 if summary['failed'] else 0)
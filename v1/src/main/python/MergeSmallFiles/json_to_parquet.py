@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import collections
+import concurrent.futures
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import source_compression
+
+try:
+  import pyarrow as pa
+  import pyarrow.compute as pc
+  import pyarrow.json as pa_json
+  import pyarrow.parquet as pq
+except ImportError:
+  #XXX: pyarrow is not included in the AWS Lambda Python runtime.
+  # Attach a Lambda Layer such as AWS SDK for pandas to use the local compaction engine.
+  pa = None
+
+#XXX: The columns of restapi_access_log_parquet in the order of the table
+TABLE_COLUMNS = [
+  ('requestId', 'string'),
+  ('ip', 'string'),
+  ('user', 'string'),
+  ('requestTime', 'timestamp'),
+  ('httpMethod', 'string'),
+  ('resourcePath', 'string'),
+  ('status', 'string'),
+  ('protocol', 'string'),
+  ('responseLength', 'int')
+]
+
+#XXX: Bytes of JSON Lines parsed at a time
+BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def get_schema(column_names='*'):
+  """Returns the Arrow schema of `column_names` of restapi_access_log_parquet, e.g. COLUMN_NAMES of the compaction job."""
+  arrow_types = {
+    'string': pa.string(),
+    #XXX: requestTime is $context.requestTimeEpoch of Amazon API Gateway, in milliseconds.
+    'timestamp': pa.timestamp('ms'),
+    'int': pa.int32()
+  }
+  names = [e for e, _ in TABLE_COLUMNS] if column_names.strip() == '*' else [e.strip() for e in column_names.split(',')]
+  types = dict(TABLE_COLUMNS)
+  unknown = [e for e in names if e not in types]
+  if unknown:
+    raise ValueError('Unknown columns of restapi_access_log_parquet: {}'.format(', '.join(unknown)))
+  return pa.schema([(e, arrow_types[types[e]]) for e in names])
+
+
+class S3Storage:
+  """Reads and writes objects of `s3://{bucket}/{key}` locations with an Amazon S3 client."""
+
+  def __init__(self, s3_client):
+    self.s3_client = s3_client
+
+  @staticmethod
+  def split(location):
+    bucket, _, key = location[len('s3://'):].partition('/')
+    return (bucket, key)
+
+  def list(self, location):
+    """Returns (location, size) of the objects under a location, a page of up to 1000 objects at a time."""
+    bucket, prefix = self.split(location)
+    objects = []
+    for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+      objects.extend(('s3://{}/{}'.format(bucket, e['Key']), e['Size']) for e in page.get('Contents', []))
+    return objects
+
+  def list_modified(self, location):
+    """Returns (location, size, last modified time in UTC) of the objects under a location."""
+    bucket, prefix = self.split(location)
+    objects = []
+    for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+      objects.extend(('s3://{}/{}'.format(bucket, e['Key']), e['Size'], e['LastModified']) for e in page.get('Contents', []))
+    return objects
+
+  def list_prefixes(self, location):
+    """Returns the locations of the `/`-delimited prefixes under a location, e.g. the partitions of a table."""
+    bucket, prefix = self.split(location)
+    prefixes = []
+    for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix, Delimiter='/'):
+      prefixes.extend('s3://{}/{}'.format(bucket, e['Prefix']) for e in page.get('CommonPrefixes', []))
+    return prefixes
+
+  def read(self, location):
+    bucket, key = self.split(location)
+    return self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+  def open(self, location):
+    """Returns a stream of the body of an object, to read it a chunk at a time."""
+    bucket, key = self.split(location)
+    return self.s3_client.get_object(Bucket=bucket, Key=key)['Body']
+
+  def read_tail(self, location, num_bytes):
+    """Returns up to the last `num_bytes` bytes of an object in a ranged GET, e.g. the footer of a Parquet file."""
+    bucket, key = self.split(location)
+    return self.s3_client.get_object(Bucket=bucket, Key=key, Range='bytes=-{}'.format(num_bytes))['Body'].read()
+
+  def tag(self, location, tags):
+    bucket, key = self.split(location)
+    self.s3_client.put_object_tagging(Bucket=bucket, Key=key,
+      Tagging={'TagSet': [{'Key': k, 'Value': v} for k, v in tags.items()]})
+
+  def write_file(self, path, location):
+    bucket, key = self.split(location)
+    self.s3_client.upload_file(path, bucket, key)
+
+  def copy(self, src_location, dst_location):
+    #XXX: CopyObject copies objects of up to 5 GB, far above the target size of merged files.
+    src_bucket, src_key = self.split(src_location)
+    dst_bucket, dst_key = self.split(dst_location)
+    self.s3_client.copy_object(Bucket=dst_bucket, Key=dst_key, CopySource={'Bucket': src_bucket, 'Key': src_key})
+
+  def delete(self, locations):
+    for i in range(0, len(locations), 1000):
+      bucket = self.split(locations[i])[0]
+      self.s3_client.delete_objects(Bucket=bucket, Delete={
+        'Objects': [{'Key': self.split(e)[1]} for e in locations[i:i + 1000]],
+        'Quiet': True
+      })
+
+
+class LocalStorage:
+  """A stand-in for S3Storage on a local filesystem, which stores `s3://{bucket}/{key}` at `{root}/{bucket}/{key}`."""
+
+  def __init__(self, root):
+    self.root = root
+
+  def path(self, location):
+    return os.path.join(self.root, location[len('s3://'):])
+
+  def list(self, location):
+    objects = []
+    prefix_path = self.path(location)
+    for dir_path, _, file_names in os.walk(os.path.dirname(prefix_path)):
+      for file_name in file_names:
+        path = os.path.join(dir_path, file_name)
+        if path.startswith(prefix_path):
+          objects.append(('s3://' + os.path.relpath(path, self.root), os.path.getsize(path)))
+    return sorted(objects)
+
+  def list_modified(self, location):
+    return [(e, size, datetime.datetime.fromtimestamp(os.path.getmtime(self.path(e)), tz=datetime.timezone.utc))
+      for e, size in self.list(location)]
+
+  def list_prefixes(self, location):
+    prefix_path = self.path(location)
+    dir_path = os.path.dirname(prefix_path)
+    if not os.path.isdir(dir_path):
+      return []
+    paths = [os.path.join(dir_path, e) for e in os.listdir(dir_path)]
+    return sorted('s3://' + os.path.relpath(e, self.root) + '/' for e in paths if os.path.isdir(e) and e.startswith(prefix_path))
+
+  def read(self, location):
+    with open(self.path(location), 'rb') as f:
+      return f.read()
+
+  def open(self, location):
+    return open(self.path(location), 'rb')
+
+  def read_tail(self, location, num_bytes):
+    with open(self.path(location), 'rb') as f:
+      f.seek(max(0, os.path.getsize(self.path(location)) - num_bytes))
+      return f.read()
+
+  def tag(self, location, tags):
+    #XXX: Files have no tags, e.g. for a lifecycle rule to filter by.
+    pass
+
+  def write_file(self, path, location):
+    os.makedirs(os.path.dirname(self.path(location)), exist_ok=True)
+    shutil.copyfile(path, self.path(location))
+
+  def copy(self, src_location, dst_location):
+    self.write_file(self.path(src_location), dst_location)
+
+  def delete(self, locations):
+    for e in locations:
+      os.remove(self.path(e))
+
+
+def iter_line_blocks(data, block_size=BLOCK_SIZE):
+  """Yields blocks of about `block_size` bytes of JSON Lines, split at the end of a line, without copying `data`."""
+  view = memoryview(data)
+  start = 0
+  while start < len(data):
+    end = data.find(b'\n', start + block_size - 1) if start + block_size < len(data) else -1
+    end = len(data) if end < 0 else end + 1
+    yield view[start:end]
+    start = end
+
+
+def parse_block(block, schema):
+  """Parses a block of JSON Lines into a table of `schema`, converting values as the JSON SerDe of Athena does."""
+  table = pa_json.read_json(pa.BufferReader(block), read_options=pa_json.ReadOptions(use_threads=False))
+  columns = []
+  for field in schema:
+    if field.name not in table.column_names:
+      columns.append(pa.nulls(table.num_rows, field.type))
+      continue
+    column = table.column(field.name)
+    if column.type != field.type:
+      column = column.cast(field.type)
+    columns.append(column)
+  return pa.Table.from_arrays(columns, schema=schema)
+
+
+class PartitionWriter:
+  """Writes tables to Parquet files of about `target_file_bytes` under a location.
+
+  Each file is written to a local temporary file and uploaded in the background as soon as it is closed.
+  Rows are buffered until a row group of `row_group_rows` rows.
+  """
+
+  def __init__(self, storage, location, schema, executor, compression='snappy', compression_level=None,
+      row_group_rows=500000, target_file_bytes=128 * 1024 * 1024, tmp_dir=None):
+    self.storage = storage
+    self.location = location.rstrip('/') + '/'
+    self.schema = schema
+    self.executor = executor
+    self.compression = compression.lower()
+    #XXX: Some codecs, e.g. snappy, have no compression levels.
+    self.compression_level = compression_level if pa.Codec.supports_compression_level(self.compression) else None
+    self.row_group_rows = row_group_rows
+    self.target_file_bytes = target_file_bytes
+    self.tmp_dir = tmp_dir or tempfile.gettempdir()
+    self.run_id = uuid.uuid4().hex
+    self.buffer, self.buffered_rows = ([], 0)
+    self.sink, self.writer, self.path = (None, None, None)
+    self.uploads = []
+    self.rows = 0
+
+  def write(self, table):
+    self.buffer.append(table)
+    self.buffered_rows += table.num_rows
+    while self.buffered_rows >= self.row_group_rows:
+      self._write_row_group(self.row_group_rows)
+
+  def _write_row_group(self, num_rows):
+    table = pa.concat_tables(self.buffer)
+    self.buffer = [table.slice(num_rows)] if num_rows < table.num_rows else []
+    self.buffered_rows = table.num_rows - num_rows
+    row_group = table.slice(0, num_rows)
+
+    if self.writer is None:
+      self.path = os.path.join(self.tmp_dir, '{}_{:05d}.parquet'.format(self.run_id, len(self.uploads)))
+      self.sink = pa.OSFile(self.path, 'wb')
+      #XXX: Athena writes timestamps of Hive tables as INT96.
+      self.writer = pq.ParquetWriter(self.sink, self.schema, compression=self.compression,
+        compression_level=self.compression_level, use_deprecated_int96_timestamps=True)
+    self.writer.write_table(row_group, row_group_size=num_rows)
+    self.rows += num_rows
+    if self.sink.tell() >= self.target_file_bytes:
+      self._close_file()
+
+  def _close_file(self):
+    self.writer.close()
+    self.sink.close()
+    path, self.writer, self.sink = (self.path, None, None)
+    location = '{}{}_{:05d}.{}.parquet'.format(self.location, self.run_id, len(self.uploads), self.compression)
+    self.uploads.append((location, os.path.getsize(path), self.executor.submit(self._upload, path, location)))
+
+  def _upload(self, path, location):
+    try:
+      self.storage.write_file(path, location)
+    finally:
+      os.remove(path)
+
+  def close(self):
+    """Writes the buffered rows, and waits for the uploads. Returns (location, size) of the files."""
+    if self.buffered_rows:
+      self._write_row_group(self.buffered_rows)
+    if self.writer is not None:
+      self._close_file()
+    for _, _, future in self.uploads:
+      future.result()
+    return [(location, size) for location, size, _ in self.uploads]
+
+  def abort(self):
+    """Deletes the files uploaded so far, e.g. if the compaction fails or runs out of time."""
+    if self.writer is not None:
+      self.writer.close()
+      self.sink.close()
+      os.remove(self.path)
+      self.writer = None
+    concurrent.futures.wait([future for _, _, future in self.uploads])
+    uploaded = [location for location, _, future in self.uploads if future.exception() is None]
+    if uploaded:
+      self.storage.delete(uploaded)
+
+
+def check_deadline(deadline, location):
+  if deadline is not None and time.monotonic() > deadline:
+    raise TimeoutError('Compaction of {} is not finished before the deadline'.format(location))
+
+
+def iter_parquet_tables(data, schema):
+  """Yields the tables of the row groups of a Parquet object with `schema`.
+
+  Firehose writes the columns of the Glue table, whose names are lowercase, so they are matched case-insensitively.
+  """
+  parquet_file = pq.ParquetFile(pa.BufferReader(data))
+  names = {e.lower(): e for e in parquet_file.schema_arrow.names}
+  for i in range(parquet_file.num_row_groups):
+    table = parquet_file.read_row_group(i, columns=[names[e.lower()] for e in schema.names if e.lower() in names],
+      use_threads=False)
+    yield pa.table([table.column(names[field.name.lower()]).cast(field.type) if field.name.lower() in names
+      else pa.nulls(table.num_rows, field.type) for field in schema], schema=schema)
+
+
+def iter_tables(storage, objects, schema, executor, io_threads, max_prefetch_bytes, block_size, deadline=None,
+    input_format='json', input_compression='UNCOMPRESSED'):
+  """Yields the tables parsed from `objects`, a block of JSON Lines or a row group of Parquet at a time.
+
+  Up to `io_threads` objects are read ahead of parsing while their bytes stay under `max_prefetch_bytes`.
+  JSON objects compressed with `input_compression` are decompressed one at a time as they are parsed.
+  """
+  reads, prefetch_bytes, i = (collections.deque(), 0, 0)
+  while i < len(objects) or reads:
+    while i < len(objects) and (not reads or (len(reads) < io_threads and prefetch_bytes + objects[i][1] <= max_prefetch_bytes)):
+      location, size = objects[i]
+      reads.append((location, executor.submit(storage.read, location), size))
+      prefetch_bytes += size
+      i += 1
+
+    location, future, size = reads.popleft()
+    data = future.result()
+    if input_format != 'parquet':
+      data = source_compression.decompress(data, input_compression)
+    blocks = iter_parquet_tables(data, schema) if input_format == 'parquet' else (parse_block(e, schema)
+      for e in iter_line_blocks(data, block_size))
+    for table in blocks:
+      check_deadline(deadline, location)
+      yield table
+    prefetch_bytes -= size
+    del data
+
+
+def get_cluster_ranges(counts, max_sort_rows):
+  """Groups the values of the first clustering column, in order, into ranges of up to `max_sort_rows` rows.
+
+  Returns (low, high) of each range. A value with more rows than `max_sort_rows` is a range by itself.
+  """
+  ranges, low, high, rows = ([], None, None, 0)
+  for value in sorted(counts):
+    if low is not None and rows + counts[value] > max_sort_rows:
+      ranges.append((low, high))
+      low, rows = (None, 0)
+    low = value if low is None else low
+    high = value
+    rows += counts[value]
+  if low is not None:
+    ranges.append((low, high))
+  return ranges
+
+
+def cluster_tables(tables, schema, cluster_by, max_sort_rows=1000000, tmp_dir=None, deadline=None):
+  """Yields the rows of `tables` sorted by the columns of `cluster_by`, e.g. ['user', 'requestTime'].
+
+  The rows are spilled to a local Parquet file while counting the rows of each value of the first column.
+  Then the values are grouped into ranges of up to `max_sort_rows` rows, which are read back and sorted one at a time,
+  so memory is bounded by `max_sort_rows` rows rather than the rows of an hour.
+  """
+  key = cluster_by[0]
+  sort_keys = [(e, 'ascending') for e in cluster_by]
+  counts, null_rows = (collections.Counter(), 0)
+  with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix='.parquet') as spill:
+    #XXX: The spill file is read back once for each range, so it is compressed with a fast codec.
+    with pq.ParquetWriter(spill.name, schema, compression='lz4') as spill_writer:
+      for table in tables:
+        for e in pc.value_counts(table.column(key)).to_pylist():
+          if e['values'] is None:
+            null_rows += e['counts']
+          else:
+            counts[e['values']] += e['counts']
+        spill_writer.write_table(table)
+
+    spill_file = pq.ParquetFile(spill.name)
+    for low, high in get_cluster_ranges(counts, max_sort_rows):
+      batches = []
+      for batch in spill_file.iter_batches():
+        check_deadline(deadline, spill.name)
+        column = batch.column(key)
+        batches.append(batch.filter(pc.and_(pc.greater_equal(column, low), pc.less_equal(column, high))))
+      yield pa.Table.from_batches(batches, schema=schema).sort_by(sort_keys)
+
+    #XXX: Rows without the first column come last, as nulls are sorted at the end.
+    if null_rows:
+      batches = [batch.filter(pc.is_null(batch.column(key))) for batch in spill_file.iter_batches()]
+      yield pa.Table.from_batches(batches, schema=schema).sort_by(sort_keys)
+
+
+def compact(storage, input_location, output_location, column_names='*', compression='snappy', compression_level=None,
+    row_group_rows=500000, target_file_size_mb=128, io_threads=8, max_prefetch_bytes=64 * 1024 * 1024,
+    block_size=BLOCK_SIZE, cluster_by=None, max_sort_rows=1000000, deadline=None, input_format='json',
+    input_compression='UNCOMPRESSED'):
+  """Compacts the JSON Lines objects under `input_location`, or a list of locations, into Parquet files under `output_location`.
+
+  Up to `io_threads` objects are read ahead of parsing while their bytes stay under `max_prefetch_bytes`,
+  and parsed `block_size` bytes at a time, so memory is bounded by them and a row group.
+  With `input_format` of `parquet`, e.g. the objects converted by Firehose, they are merged a row group at a time.
+  JSON objects compressed by Firehose with `input_compression`, e.g. GZIP, are decompressed before they are parsed.
+  With `cluster_by`, e.g. ['user', 'requestTime'], the rows are sorted by its columns, so that the statistics of
+  row groups let queries filtering on the first column skip the other row groups.
+  If it fails, or `deadline` of time.monotonic() passes, the files written so far are deleted.
+  Returns the statistics of the compaction.
+  """
+  if pa is None:
+    raise RuntimeError('pyarrow is required by the local compaction engine')
+
+  start = time.monotonic()
+  schema = get_schema(column_names)
+  if cluster_by and any(e not in schema.names for e in cluster_by):
+    raise ValueError('Cannot cluster by {} with the columns {}'.format(cluster_by, schema.names))
+  input_locations = [input_location] if isinstance(input_location, str) else input_location
+  objects = [e for location in input_locations for e in storage.list(location)]
+  stats = {'input_files': len(objects), 'input_bytes': sum(size for _, size in objects), 'rows': 0}
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=io_threads) as executor:
+    writer = PartitionWriter(storage, output_location, schema, executor,
+      compression=compression,
+      compression_level=compression_level,
+      row_group_rows=row_group_rows,
+      target_file_bytes=int(target_file_size_mb * 1024 * 1024))
+    try:
+      tables = iter_tables(storage, objects, schema, executor, io_threads, max_prefetch_bytes, block_size, deadline=deadline,
+        input_format=input_format, input_compression=input_compression)
+      if cluster_by:
+        tables = cluster_tables(tables, schema, cluster_by, max_sort_rows=max_sort_rows, deadline=deadline)
+      for table in tables:
+        writer.write(table)
+      files = writer.close()
+    except BaseException as _:
+      writer.abort()
+      raise
+
+  stats.update({
+    'rows': writer.rows,
+    'output_files': len(files),
+    'output_bytes': sum(size for _, size in files),
+    'elapsed_s': round(time.monotonic() - start, 3)
+  })
+  return stats
+
+
+def main():
+  import argparse
+
+  parser = argparse.ArgumentParser(description='Compact JSON Lines objects of an hour into Parquet files without Amazon Athena')
+  parser.add_argument('input_location', help='s3 path of the JSON objects, ex) s3://bucket/json-data/year=2023/month=01/day=31/hour=12/')
+  parser.add_argument('output_location', help='s3 path of the Parquet files, ex) s3://bucket/parquet-data/year=2023/month=01/day=31/hour=12/')
+  parser.add_argument('--local-root',
+    help='a local directory standing in for Amazon S3, which stores s3://{bucket}/{key} at {local-root}/{bucket}/{key}')
+  parser.add_argument('--region-name', default='us-east-1', help='aws region name')
+  parser.add_argument('--column-names', default='*', help='columns of restapi_access_log_parquet to write')
+  parser.add_argument('--compression', default='snappy', help='parquet codec, ex) snappy, zstd, gzip (default: snappy)')
+  parser.add_argument('--compression-level', type=int, help='the compression level of the codec')
+  parser.add_argument('--row-group-rows', default=500000, type=int, help='rows of a row group (default: 500000)')
+  parser.add_argument('--target-file-size-mb', default=128, type=float, help='the size of a Parquet file (default: 128)')
+  parser.add_argument('--io-threads', default=8, type=int, help='threads to read and upload objects (default: 8)')
+  parser.add_argument('--cluster-by', help='columns to sort the rows by, ex) user,requestTime')
+  parser.add_argument('--input-format', default='json', choices=['json', 'parquet'],
+    help='the format of the objects, parquet if converted by kinesis data firehose (default: json)')
+  parser.add_argument('--input-compression', default='UNCOMPRESSED', choices=source_compression.COMPRESSION_FORMATS,
+    help='the compression format of the json objects of kinesis data firehose (default: UNCOMPRESSED)')
+
+  options = parser.parse_args()
+
+  if options.local_root:
+    storage = LocalStorage(options.local_root)
+  else:
+    import boto3
+    storage = S3Storage(boto3.client('s3', region_name=options.region_name))
+
+  stats = compact(storage, options.input_location, options.output_location,
+    column_names=options.column_names,
+    compression=options.compression,
+    compression_level=options.compression_level,
+    row_group_rows=options.row_group_rows,
+    target_file_size_mb=options.target_file_size_mb,
+    io_threads=options.io_threads,
+    cluster_by=options.cluster_by.split(',') if options.cluster_by else None,
+    input_format=options.input_format,
+    input_compression=options.input_compression)
+  print('[INFO] {}'.format(stats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import collections
+import datetime
+import itertools
+import json
+import re
+import sys
+import urllib.parse
+
+import compaction_ledger
+
+#XXX: The partition of an object of the source table, e.g. json-data/year=2023/month=01/day=31/hour=12/{object},
+# optionally under a tenant partition, e.g. json-data/tenant=alice/year=2023/...
+HOUR_KEY_PATTERN = re.compile(r'(?:\w+=[^/]*/)?year=(\d{4})/month=(\d{1,2})/day=(\d{1,2})/hour=(\d{1,2})/')
+
+
+def iter_s3_event_records(event):
+  """Yields the records of the objects in `event`: an S3 event notification, an SQS message or a batch of them
+  wrapping one, or an Amazon EventBridge `Object Created` event of Amazon S3."""
+  if 'Records' in event:
+    for record in event['Records']:
+      if 'body' in record:
+        yield from iter_s3_event_records(json.loads(record['body']))
+      elif 's3' in record:
+        yield record
+  elif 'Body' in event:
+    yield from iter_s3_event_records(json.loads(event['Body']))
+  elif event.get('detail-type') == 'Object Created':
+    yield {
+      'eventName': 'ObjectCreated:{}'.format(event['detail'].get('reason', 'PutObject')),
+      'eventTime': event['time'],
+      's3': {'bucket': event['detail']['bucket'], 'object': event['detail']['object']}
+    }
+
+
+def get_late_objects(events, location_prefix):
+  """Returns the objects created under `location_prefix` in `events` by hour, as lists of (event time, size)."""
+  prefix = location_prefix.rstrip('/') + '/'
+  late_objects = collections.defaultdict(list)
+  for record in itertools.chain.from_iterable(iter_s3_event_records(e) for e in events):
+    if not record.get('eventName', '').startswith('ObjectCreated'):
+      continue
+    #XXX: Keys are URL-encoded in S3 event notifications, e.g. year%3D2023.
+    location = 's3://{}/{}'.format(record['s3']['bucket']['name'], urllib.parse.unquote_plus(record['s3']['object']['key']))
+    match = HOUR_KEY_PATTERN.match(location[len(prefix):]) if location.startswith(prefix) else None
+    if match is None:
+      continue
+    hour = datetime.datetime(*[int(e) for e in match.groups()]).strftime(compaction_ledger.HOUR_FMT)
+    event_time = record['eventTime'][:len('YYYY-MM-DDTHH:MM:SS')] + 'Z'
+    late_objects[hour].append((event_time, record['s3']['object'].get('size', 0)))
+  return late_objects
+
+
+def get_compaction_started_at(record, max_duration_s):
+  """Returns the time an hour started being compacted, before which its objects were compacted, or '' if unknown."""
+  if not record.get('compacted_at'):
+    return ''
+  #XXX: Without its duration, e.g. in the S3 ledger, the compaction may have started as early as a lambda function can run.
+  duration_s = record.get('duration_s') or max_duration_s
+  compacted_dt = datetime.datetime.strptime(record['compacted_at'], compaction_ledger.TIME_FMT)
+  return (compacted_dt - datetime.timedelta(seconds=duration_s)).strftime(compaction_ledger.TIME_FMT)
+
+
+def mark_dirty_hours(ledger, ledger_id, late_objects, max_duration_s):
+  """Records the compacted hours with objects created since they started being compacted as DIRTY,
+  and adds the late objects to those already DIRTY. Returns the records of the dirty hours.
+
+  Hours not compacted yet are left to be compacted as usual.
+  """
+  if not late_objects:
+    return {}
+  start_hour = min(late_objects)
+  end_hour = (datetime.datetime.strptime(max(late_objects), compaction_ledger.HOUR_FMT) +
+    datetime.timedelta(hours=1)).strftime(compaction_ledger.HOUR_FMT)
+  records = ledger.get_records(ledger_id, start_hour, end_hour)
+
+  dirty_records = {}
+  for hour, objects in sorted(late_objects.items()):
+    record = records.get(hour)
+    if record is None or record['status'] not in compaction_ledger.DONE_STATUSES + (compaction_ledger.DIRTY_STATUS,):
+      continue
+    if record['status'] != compaction_ledger.DIRTY_STATUS:
+      #XXX: The objects created while the hour was being compacted may have been missed.
+      started_at = get_compaction_started_at(record, max_duration_s)
+      objects = [e for e in objects if e[0] >= started_at]
+      if not objects:
+        continue
+      record = {'hour': hour, 'status': compaction_ledger.DIRTY_STATUS, 'late_objects': 0, 'late_bytes': 0,
+        'first_late_object_at': objects[0][0], 'last_late_object_at': objects[0][0],
+        'recompactions': record.get('recompactions', 0)}
+    record = dict(record,
+      late_objects=record['late_objects'] + len(objects),
+      late_bytes=record['late_bytes'] + sum(size for _, size in objects),
+      first_late_object_at=min([record['first_late_object_at']] + [t for t, _ in objects]),
+      last_late_object_at=max([record['last_late_object_at']] + [t for t, _ in objects]))
+    ledger.put_record(ledger_id, record)
+    dirty_records[hour] = record
+    print('[INFO] Mark {} dirty: {} late objects of {} bytes, the last at {}'.format(hour, record['late_objects'],
+      record['late_bytes'], record['last_late_object_at']), file=sys.stderr)
+  return dirty_records
+
+
+def receive_late_data_events(sqs_client, queue_url, max_messages):
+  """Receives the S3 event notifications queued since the last run, 10 messages at a time.
+  Returns the events and the receipt handles to delete them with once they are recorded.
+  """
+  events, receipt_handles = ([], [])
+  while len(receipt_handles) < max_messages:
+    response = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=1)
+    messages = response.get('Messages', [])
+    if not messages:
+      break
+    for message in messages:
+      events.append(json.loads(message['Body']))
+      receipt_handles.append(message['ReceiptHandle'])
+  return (events, receipt_handles)
+
+
+def delete_late_data_events(sqs_client, queue_url, receipt_handles):
+  for i in range(0, len(receipt_handles), 10):
+    sqs_client.delete_message_batch(QueueUrl=queue_url,
+      Entries=[{'Id': str(j), 'ReceiptHandle': e} for j, e in enumerate(receipt_handles[i:i + 10])])
+
+
+def is_settling(record, settle_minutes, now=None):
+  """Returns True if late objects of a dirty hour arrived in the last `settle_minutes`."""
+  now = now or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+  last_dt = datetime.datetime.strptime(record['last_late_object_at'], compaction_ledger.TIME_FMT)
+  return now - last_dt < datetime.timedelta(minutes=settle_minutes)
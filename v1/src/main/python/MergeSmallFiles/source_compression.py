@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import gzip
+import io
+import struct
+
+try:
+  import snappy
+except ImportError:
+  #XXX: python-snappy is not included in the AWS Lambda Python runtime, so Snappy blocks are decompressed by pyarrow instead.
+  snappy = None
+
+try:
+  import pyarrow as pa
+except ImportError:
+  pa = None
+
+#XXX: The compression formats of Firehose whose objects Athena reads by the extension Firehose appends, .gz or .snappy.
+# Athena cannot read the Snappy framing format of `Snappy`, nor ZIP.
+COMPRESSION_FORMATS = ('UNCOMPRESSED', 'GZIP', 'HADOOP_SNAPPY')
+
+#XXX: Bytes of an object read at a time
+CHUNK_SIZE = 1024 * 1024
+
+
+class DecompressionError(Exception):
+  pass
+
+
+def read_exactly(f, size):
+  """Reads `size` bytes of a stream, or none at its end."""
+  data = b''
+  while len(data) < size:
+    chunk = f.read(size - len(data))
+    if not chunk:
+      break
+    data += chunk
+  if data and len(data) < size:
+    raise DecompressionError('Truncated Hadoop Snappy stream: {} of {} bytes'.format(len(data), size))
+  return data
+
+
+def snappy_uncompress(block):
+  if snappy is not None:
+    return snappy.uncompress(block)
+  if pa is None:
+    raise DecompressionError('python-snappy or pyarrow is required to decompress HADOOP_SNAPPY objects')
+  #XXX: A raw Snappy block starts with its uncompressed length as a varint.
+  size, shift = (0, 0)
+  for b in block:
+    size |= (b & 0x7f) << shift
+    if not b & 0x80:
+      break
+    shift += 7
+  return pa.decompress(block, decompressed_size=size, codec='snappy', asbytes=True)
+
+
+def iter_hadoop_snappy(f):
+  """Yields the decompressed chunks of the Hadoop Snappy format, written by Firehose with HADOOP_SNAPPY.
+
+  Each block is its uncompressed length followed by its compressed chunks, each with its compressed length,
+  as big-endian 32-bit integers.
+  """
+  while True:
+    header = read_exactly(f, 4)
+    if not header:
+      return
+    remaining = struct.unpack('>I', header)[0]
+    while remaining > 0:
+      size = read_exactly(f, 4)
+      if not size:
+        raise DecompressionError('Truncated Hadoop Snappy block: {} bytes left'.format(remaining))
+      chunk = snappy_uncompress(read_exactly(f, struct.unpack('>I', size)[0]))
+      remaining -= len(chunk)
+      yield chunk
+
+
+def iter_chunks(f, compression, chunk_size=CHUNK_SIZE):
+  """Yields the decompressed bytes of a stream of an object compressed with `compression`, a chunk at a time."""
+  if compression == 'HADOOP_SNAPPY':
+    yield from iter_hadoop_snappy(f)
+    return
+  if compression == 'GZIP':
+    f = gzip.GzipFile(fileobj=f)
+  elif compression != 'UNCOMPRESSED':
+    raise ValueError('Unknown compression format of the source objects: {}'.format(compression))
+  while True:
+    chunk = f.read(chunk_size)
+    if not chunk:
+      return
+    yield chunk
+
+
+def decompress(data, compression):
+  """Returns the decompressed bytes of an object compressed with `compression`."""
+  if compression == 'UNCOMPRESSED':
+    return data
+  if compression == 'GZIP':
+    return gzip.decompress(data)
+  return b''.join(iter_chunks(io.BytesIO(data), compression))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+import uuid
+
+os.environ.setdefault('IcebergDatabaseName', 'restapi_access_log_iceberg_db')
+os.environ.setdefault('IcebergTableName', 'restapi_access_log_iceberg')
+os.environ.setdefault('IcebergTableColumns', 'request_id:string,ip:string,user:string,request_time:timestamp,'
+  'http_method:string,resource_path:string,status:string,protocol:string,response_length:int')
+os.environ.setdefault('IcebergTableNumericStringColumns', 'status')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/main/python/IcebergTransformer'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../lambda_layers/tracing/python'))
+
+import firehose_to_iceberg_transformer as transformer
+
+#XXX: (transform mode, request_time splice fast path, schema validation)
+CONFIGURATIONS = [
+  ('row', False, False),
+  ('row', False, True),
+  ('row', True, False),
+  ('row', True, True),
+  ('columnar', False, False),
+  ('columnar', False, True),
+  ('columnar', True, False),
+  ('columnar', True, True)
+]
+
+VALIDATE_RECORD = transformer.VALIDATE_RECORD
+
+#XXX: The same kinds of invalid records as the `__main__` block of firehose_to_iceberg_transformer.py
+INVALID_RECORD_KINDS = [
+  'string_request_time',
+  'missing_column',
+  'mismatched_data_type',
+  'mismatched_column_name',
+  'malformed_json'
+]
+
+
+def gen_access_log(rand, request_time):
+  #XXX: The same layout as `access_log_format` in cdk_stacks/random_gen_apigw.py
+  return '''{"request_id": "%s", "ip": "%s", "user": "%s", "request_time": %d, "http_method": "GET", "resource_path": "/random/strings", "status": %d, "protocol": "HTTP/1.1", "response_length": %d}\n''' % (
+    uuid.UUID(int=rand.getrandbits(128), version=4),
+    '.'.join(str(rand.randint(1, 254)) for _ in range(4)),
+    uuid.UUID(int=rand.getrandbits(128), version=4),
+    request_time,
+    rand.choice([200, 200, 200, 400, 500]),
+    rand.randint(1, 2000))
+
+
+def gen_invalid_access_log(rand, request_time):
+  json_value = json.loads(gen_access_log(rand, request_time))
+  kind = rand.choice(INVALID_RECORD_KINDS)
+  if kind == 'string_request_time':
+    json_value['request_time'] = str(request_time)
+  elif kind == 'missing_column':
+    del json_value['request_id']
+  elif kind == 'mismatched_data_type':
+    json_value['ip'] = rand.getrandbits(32)
+  elif kind == 'mismatched_column_name':
+    json_value = {''.join(w.capitalize() if i else w for i, w in enumerate(k.split('_'))): v for k, v in json_value.items()}
+  else:
+    return json.dumps(json_value)[:-1] + '\n'
+  return json.dumps(json_value) + '\n'
+
+
+def gen_event(num_records, invalid_ratio=0.0, start_time_ms=1743740705172, time_span_ms=60000, seed=47):
+  rand = random.Random(f'{seed}-{num_records}-{invalid_ratio}')
+  records = []
+  for i in range(num_records):
+    request_time = start_time_ms + rand.randint(0, time_span_ms)
+    gen_fn = gen_invalid_access_log if rand.random() < invalid_ratio else gen_access_log
+    records.append({
+      'recordId': f'{i:056d}',
+      'approximateArrivalTimestamp': request_time,
+      'data': base64.b64encode(gen_fn(rand, request_time).encode('utf-8'))
+    })
+
+  return {
+    'invocationId': 'invocationIdExample',
+    'deliveryStreamArn': 'arn:aws:kinesis:EXAMPLE',
+    'region': 'us-east-1',
+    'records': records
+  }
+
+
+def get_peak_rss_mb():
+  #XXX: ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def output_digest(res):
+  digest = hashlib.sha256()
+  for record in res['records']:
+    digest.update(record['data'])
+    digest.update(record['result'].encode('utf-8'))
+  return digest.hexdigest()
+
+
+def run(transform_mode, fast_path, validate, num_records, invalid_ratio, iterations):
+  """Runs `lambda_handler` in a fresh process, so that peak RSS is measured per configuration."""
+  transformer.LOGGER.setLevel('WARNING')
+  #XXX: The embedded metrics are emitted, so that their cost is measured.
+  sys.stdout = open(os.devnull, 'w')
+  transformer.EMIT_METRICS = True
+  transformer.TRANSFORM_MODE = transform_mode
+  transformer.REQUEST_TIME_FAST_PATH = fast_path
+  transformer.VALIDATE_RECORD = VALIDATE_RECORD if validate else None
+
+  event = gen_event(num_records, invalid_ratio)
+
+  # warm up the request_time cache as a warm Lambda container does
+  res = transformer.lambda_handler(event, {})
+
+  latencies = []
+  for _ in range(iterations):
+    start = time.perf_counter()
+    transformer.lambda_handler(event, {})
+    latencies.append(time.perf_counter() - start)
+
+  #XXX: tracemalloc traces live memory only, so the peak of an invocation is measured
+  # rather than the total bytes allocated and freed by it.
+  tracemalloc.start()
+  transformer.lambda_handler(event, {})
+  _, peak_traced_bytes = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  latencies.sort()
+  return {
+    'num_records': num_records,
+    'invalid_ratio': invalid_ratio,
+    'transform_mode': transform_mode,
+    'fast_path': fast_path,
+    'validate': validate,
+    'records_per_second': num_records * len(latencies) / sum(latencies),
+    'p50_latency_ms': statistics.median(latencies) * 1000,
+    'p99_latency_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    'peak_rss_mb': get_peak_rss_mb(),
+    'peak_bytes_per_record': peak_traced_bytes / num_records,
+    'output_digest': output_digest(res)
+  }
+
+
+def result_key(result):
+  return (result['num_records'], result['invalid_ratio'], result.get('transform_mode', 'row'), result['fast_path'], result['validate'])
+
+
+def result_label(result):
+  on_off = lambda e: 'on' if e else 'off'
+  return (result['num_records'], result['invalid_ratio'], result['transform_mode'], on_off(result['fast_path']), on_off(result['validate']))
+
+
+def compare_transform_modes(results):
+  """Prints the records/s of the columnar transform mode against the row transform mode for the same event and configuration."""
+  row_results = {result_key(e)[:2] + result_key(e)[3:]: e for e in results if e['transform_mode'] == 'row'}
+
+  print('\n{:>8} {:>7} {:>5} {:>8} {:>12} {:>12} {:>9}'.format('records', 'invalid', 'fast', 'validate', 'row', 'columnar', 'change'))
+  for result in results:
+    base = row_results.get(result_key(result)[:2] + result_key(result)[3:], None)
+    if result['transform_mode'] != 'columnar' or base is None:
+      continue
+    label = result_label(result)
+    print('{:>8} {:>7.2f} {:>5} {:>8} {:>12,.0f} {:>12,.0f} {:>+8.1%}'.format(*label[:2], *label[3:],
+      base['records_per_second'], result['records_per_second'], result['records_per_second'] / base['records_per_second'] - 1))
+
+
+def compare_with_baseline(results, baseline, tolerance):
+  """Prints the change against a baseline and returns the results regressed by more than `tolerance`."""
+  baseline_results = {result_key(e): e for e in baseline['results']}
+  regressions = []
+
+  print('\n{:>8} {:>7} {:>8} {:>5} {:>8} {:>12} {:>12}'.format('records', 'invalid', 'mode', 'fast', 'validate', 'records/s', 'p99'))
+  for result in results:
+    base = baseline_results.get(result_key(result), None)
+    if base is None:
+      continue
+    throughput_change = result['records_per_second'] / base['records_per_second'] - 1
+    p99_change = result['p99_latency_ms'] / base['p99_latency_ms'] - 1
+    print('{:>8} {:>7.2f} {:>8} {:>5} {:>8} {:>+11.1%} {:>+11.1%}'.format(*result_label(result), throughput_change, p99_change))
+    if throughput_change < -tolerance:
+      regressions.append(result)
+  return regressions
+
+
+def benchmark_record_validator(num_records=10000):
+  json_values = [json.loads(base64.b64decode(record['data'])) for record in gen_event(num_records)['records']]
+  start = time.perf_counter()
+  for json_value in json_values:
+    VALIDATE_RECORD(json_value)
+  return (time.perf_counter() - start) / len(json_values) * 1e9
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--num-records', default=[100, 1000, 5000, 20000], type=int, nargs='+',
+    help='The number of records in a Firehose transformation event (default: 100 1000 5000 20000)')
+  parser.add_argument('--invalid-ratio', default=[0.0, 0.1], type=float, nargs='+',
+    help='The ratio of invalid records in a Firehose transformation event (default: 0.0 0.1)')
+  parser.add_argument('--iterations', default=10, type=int,
+    help='The number of invocations of lambda_handler for each configuration (default: 10)')
+  parser.add_argument('--output', help='json file to save the benchmark results')
+  parser.add_argument('--baseline', help='json file of the benchmark results to compare with')
+  parser.add_argument('--tolerance', default=0.1, type=float,
+    help='The ratio of records/s drop against the baseline regarded as a regression (default: 0.1)')
+
+  options = parser.parse_args()
+
+  ctx = multiprocessing.get_context('spawn')
+
+  results = []
+  print('{:>8} {:>7} {:>8} {:>5} {:>8} {:>12} {:>9} {:>9} {:>9} {:>13}'.format('records', 'invalid', 'mode', 'fast', 'validate',
+    'records/s', 'p50(ms)', 'p99(ms)', 'rss(MB)', 'peak B/record'))
+  for num_records in options.num_records:
+    for invalid_ratio in options.invalid_ratio:
+      digests = {}
+      for config in CONFIGURATIONS:
+        with ctx.Pool(1) as pool:
+          result = pool.apply(run, (*config, num_records, invalid_ratio, options.iterations))
+        results.append(result)
+        digests.setdefault(result['validate'], set()).add(result['output_digest'])
+
+        print('{:>8} {:>7.2f} {:>8} {:>5} {:>8} {:>12,.0f} {:>9.2f} {:>9.2f} {:>9.1f} {:>13,.0f}'.format(*result_label(result),
+          result['records_per_second'], result['p50_latency_ms'], result['p99_latency_ms'],
+          result['peak_rss_mb'], result['peak_bytes_per_record']))
+
+      #XXX: Every configuration must produce byte-identical output for the same event,
+      # except that invalid records pass through without the schema validation.
+      assert all(len(e) == 1 for e in digests.values()), \
+        f'configurations produce different outputs for {num_records} records (invalid ratio: {invalid_ratio})'
+
+  compare_transform_modes(results)
+
+  validation_ns_per_record = benchmark_record_validator()
+  print('\nschema validation: {:.0f} ns/record'.format(validation_ns_per_record))
+
+  if options.output:
+    with open(options.output, 'w') as f:
+      json.dump({
+        'created_at': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'schema_validation_ns_per_record': validation_ns_per_record,
+        'results': results
+      }, f, indent=2)
+    print(f'[INFO] Saved the benchmark results to {options.output}', file=sys.stderr)
+
+  if options.baseline:
+    with open(options.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline, options.tolerance)
+    if regressions:
+      print(f'\n[ERROR] {len(regressions)} configuration(s) regressed by more than {options.tolerance:.0%} in records/s', file=sys.stderr)
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
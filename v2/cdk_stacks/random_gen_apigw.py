@@ -16,6 +16,8 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+from .tracing_layer import create_tracing_layer
+
 
 class RandomGenApiStack(Stack):
 
@@ -68,13 +70,22 @@ class RandomGenApiStack(Stack):
     )
     apigw_account.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
 
+    lambda_memory_size = self.node.try_get_context("lambda_memory_size") or {}
+    lambda_tracing = self.node.try_get_context("lambda_tracing") or {}
+
     random_gen_lambda_fn = aws_lambda.Function(self, 'RandomStringsLambdaFn',
       runtime=aws_lambda.Runtime.PYTHON_3_9,
       function_name="RandomStrings",
       handler="random_strings.lambda_handler",
       description='Function that returns strings randomly generated',
       code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(os.path.dirname(__file__)), 'src/main/python/RestAPIs')),
-      timeout=cdk.Duration.minutes(5)
+      environment={
+        "TracingEnabled": str(lambda_tracing.get("enabled", False)).lower(),
+        "TracingSampleRate": str(lambda_tracing.get("sample_rate", 0.01))
+      },
+      timeout=cdk.Duration.minutes(5),
+      memory_size=lambda_memory_size.get("RandomStrings", 128),
+      layers=[create_tracing_layer(self, aws_lambda.Runtime.PYTHON_3_9)]
     )
 
     random_gen_api_log_group = aws_logs.LogGroup(self, 'RandomGenApiLogs')
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import base64
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/IcebergTransformer'))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../src/main/python/RestAPIs'))
+#XXX: tracing.py of the lambda functions is shipped in the tracing Lambda Layer.
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '../../lambda_layers/tracing/python'))
+
+#XXX: AWS Lambda allocates CPU power in proportion to the memory size,
+# and a function has the equivalent of one vCPU at 1,769 MB.
+# https://docs.aws.amazon.com/lambda/latest/dg/configuration-memory.html
+LAMBDA_MEMORY_PER_VCPU_MB = 1769
+LAMBDA_MIN_MEMORY_MB, LAMBDA_MAX_MEMORY_MB = (128, 10240)
+LAMBDA_MEMORY_STEP_MB = 64
+
+#XXX: The synchronous invocation payload limit of AWS Lambda applies to both request and response.
+LAMBDA_PAYLOAD_LIMIT_BYTES = 6 * 1024 * 1024
+
+#XXX: `BufferSizeInMBs` of a Firehose Lambda processor is an integer from 1 to 3.
+FIREHOSE_PROCESSOR_BUFFER_SIZES_MB = (1, 2, 3)
+
+#XXX: Lambda function names in cdk_stacks
+TRANSFORMER_FN_NAME = 'FirehoseToIcebergTransformer'
+RANDOM_STRINGS_FN_NAME = 'RandomStrings'
+
+
+def gen_random_strings_event():
+  # The largest response of random_strings.lambda_handler
+  return {
+    'resource': '/random/strings',
+    'path': '/random/strings',
+    'httpMethod': 'GET',
+    'queryStringParameters': {'chars': 'letters', 'num': '100', 'len': '20'}
+  }
+
+
+def gen_transformer_event(buffer_size_mb):
+  import transformer_benchmark
+
+  sample = transformer_benchmark.gen_event(100)
+  avg_record_size = sum(len(base64.b64decode(e['data'])) for e in sample['records']) / len(sample['records'])
+  return transformer_benchmark.gen_event(max(1, int(buffer_size_mb * 1024 * 1024 / avg_record_size)))
+
+
+def payload_size(payload):
+  return len(json.dumps(payload, default=lambda e: e.decode('utf-8') if isinstance(e, bytes) else str(e)))
+
+
+def measure(function_name, buffer_size_mb, iterations):
+  """Runs a lambda handler in a fresh process and measures its peak memory, CPU time and payload sizes."""
+  import transformer_benchmark
+
+  if function_name == TRANSFORMER_FN_NAME:
+    handler = transformer_benchmark.transformer.lambda_handler
+    transformer_benchmark.transformer.LOGGER.setLevel('WARNING')
+    sys.stdout = open(os.devnull, 'w')
+    event = gen_transformer_event(buffer_size_mb)
+  else:
+    import random_strings
+    handler = random_strings.lambda_handler
+    event = gen_random_strings_event()
+
+  res = handler(event, {})
+
+  cpu_times = []
+  for _ in range(iterations):
+    start = time.process_time()
+    handler(event, {})
+    cpu_times.append(time.process_time() - start)
+
+  tracemalloc.start()
+  handler(event, {})
+  _, peak_traced_bytes = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  return {
+    'function_name': function_name,
+    'buffer_size_mb': buffer_size_mb,
+    'num_records': len(event['records']) if 'records' in event else 1,
+    'cpu_time_ms': min(cpu_times) * 1000,
+    'peak_traced_mb': peak_traced_bytes / 1024 / 1024,
+    'peak_rss_mb': transformer_benchmark.get_peak_rss_mb(),
+    'request_bytes': payload_size(event),
+    'response_bytes': payload_size(res)
+  }
+
+
+def estimate_duration_ms(cpu_time_ms, memory_size):
+  return cpu_time_ms / min(1.0, memory_size / LAMBDA_MEMORY_PER_VCPU_MB)
+
+
+def recommend_memory_size(measurement, headroom, target_duration_ms):
+  """Returns the smallest memory size that fits the peak RSS with headroom and meets the target duration."""
+  memory_size = math.ceil(measurement['peak_rss_mb'] * headroom / LAMBDA_MEMORY_STEP_MB) * LAMBDA_MEMORY_STEP_MB
+  memory_size = max(LAMBDA_MIN_MEMORY_MB, memory_size)
+  while memory_size < LAMBDA_MAX_MEMORY_MB and estimate_duration_ms(measurement['cpu_time_ms'], memory_size) > target_duration_ms:
+    memory_size += LAMBDA_MEMORY_STEP_MB
+  return min(memory_size, LAMBDA_MAX_MEMORY_MB)
+
+
+def load_cdk_context(context_file):
+  if not os.path.exists(context_file):
+    return {}
+  with open(context_file) as f:
+    return json.load(f)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--context-file', default='cdk.context.json',
+    help='cdk context file to read the Firehose processor buffer size from (default: cdk.context.json)')
+  parser.add_argument('--buffer-sizes', type=int, nargs='+', choices=FIREHOSE_PROCESSOR_BUFFER_SIZES_MB,
+    help='Firehose processor buffer sizes in MB to run the data transformer with (default: 1 2 3 up to buffer_size)')
+  parser.add_argument('--iterations', default=3, type=int,
+    help='The number of invocations to measure CPU time (default: 3)')
+  parser.add_argument('--headroom', default=1.5, type=float,
+    help='The ratio of memory size to the measured peak RSS (default: 1.5)')
+  parser.add_argument('--target-duration-ms', default=1000, type=float,
+    help='The target duration of an invocation used to size CPU power (default: 1000)')
+  parser.add_argument('--update-context', action='store_true',
+    help='write the recommendation to the cdk context file')
+
+  options = parser.parse_args()
+
+  cdk_context = load_cdk_context(options.context_file)
+  firehose_config = cdk_context.get('data_firehose_configuration', {})
+  max_buffer_size_mb = firehose_config.get('transform_records_with_aws_lambda', {}).get('buffer_size',
+    FIREHOSE_PROCESSOR_BUFFER_SIZES_MB[-1])
+  buffer_sizes = options.buffer_sizes or [e for e in FIREHOSE_PROCESSOR_BUFFER_SIZES_MB if e <= max_buffer_size_mb]
+  if not buffer_sizes:
+    parser.error('buffer_size of transform_records_with_aws_lambda must be from 1 to 3 MB: {}'.format(max_buffer_size_mb))
+
+  ctx = multiprocessing.get_context('spawn')
+  runs = [(TRANSFORMER_FN_NAME, e) for e in buffer_sizes] + [(RANDOM_STRINGS_FN_NAME, None)]
+
+  measurements = []
+  print('{:>30} {:>8} {:>8} {:>10} {:>10} {:>9} {:>10} {:>10} {:>9}'.format('function', 'MB', 'records', 'cpu(ms)',
+    'traced(MB)', 'rss(MB)', 'req(MB)', 'resp(MB)', 'memory'))
+  for function_name, buffer_size_mb in runs:
+    with ctx.Pool(1) as pool:
+      measurement = pool.apply(measure, (function_name, buffer_size_mb, options.iterations))
+    measurement['memory_size'] = recommend_memory_size(measurement, options.headroom, options.target_duration_ms)
+    measurement['fits_payload_limit'] = max(measurement['request_bytes'], measurement['response_bytes']) <= LAMBDA_PAYLOAD_LIMIT_BYTES
+    measurements.append(measurement)
+
+    print('{:>30} {:>8} {:>8} {:>10.1f} {:>10.1f} {:>9.1f} {:>10.2f} {:>10.2f} {:>9}{}'.format(function_name,
+      buffer_size_mb if buffer_size_mb else '-', measurement['num_records'], measurement['cpu_time_ms'],
+      measurement['peak_traced_mb'], measurement['peak_rss_mb'],
+      measurement['request_bytes'] / 1024 / 1024, measurement['response_bytes'] / 1024 / 1024,
+      measurement['memory_size'], '' if measurement['fits_payload_limit'] else ' (exceeds 6 MB payload limit)'))
+
+  #XXX: The largest buffer size whose request and response fit in the Lambda payload limit
+  transformer_measurements = [e for e in measurements if e['function_name'] == TRANSFORMER_FN_NAME and e['fits_payload_limit']]
+  if not transformer_measurements:
+    print('[ERROR] No buffer size fits in the Lambda payload limit', file=sys.stderr)
+    sys.exit(1)
+  transformer_measurement = max(transformer_measurements, key=lambda e: e['buffer_size_mb'])
+  random_strings_measurement = [e for e in measurements if e['function_name'] == RANDOM_STRINGS_FN_NAME][0]
+
+  recommendation = {
+    'lambda_memory_size': {
+      TRANSFORMER_FN_NAME: transformer_measurement['memory_size'],
+      RANDOM_STRINGS_FN_NAME: random_strings_measurement['memory_size']
+    },
+    'data_firehose_configuration': {
+      'transform_records_with_aws_lambda': {
+        'buffer_size': transformer_measurement['buffer_size_mb']
+      }
+    }
+  }
+  print('\n[INFO] Recommended cdk context:\n{}'.format(json.dumps(recommendation, indent=2)), file=sys.stderr)
+
+  if options.update_context:
+    cdk_context['lambda_memory_size'] = dict(cdk_context.get('lambda_memory_size', {}), **recommendation['lambda_memory_size'])
+    transform_config = cdk_context.setdefault('data_firehose_configuration', {}).setdefault('transform_records_with_aws_lambda', {})
+    transform_config['buffer_size'] = transformer_measurement['buffer_size_mb']
+    with open(options.context_file, 'w') as f:
+      json.dump(cdk_context, f, indent=2)
+    print(f'[INFO] Updated {options.context_file}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -8,11 +8,14 @@ import aws_cdk as cdk
 
 from aws_cdk import (
   Stack,
+  aws_iam,
   aws_lambda,
   aws_logs
 )
 from constructs import Construct
 
+from .tracing_layer import create_tracing_layer
+
 
 class FirehoseDataProcLambdaStack(Stack):
 
@@ -23,8 +26,20 @@ class FirehoseDataProcLambdaStack(Stack):
     dest_iceberg_table_config = data_firehose_configuration["destination_iceberg_table_configuration"]
     dest_iceberg_table_unique_keys = dest_iceberg_table_config.get("unique_keys", None)
     dest_iceberg_table_unique_keys = ",".join(dest_iceberg_table_unique_keys) if dest_iceberg_table_unique_keys else ""
+    dest_iceberg_table_columns = dest_iceberg_table_config.get("columns", [])
+    dest_iceberg_table_columns = ",".join(f"{e['name']}:{e['type']}" for e in dest_iceberg_table_columns)
+    dest_iceberg_table_schema_from_glue = dest_iceberg_table_config.get("schema_from_glue", False)
+    dest_iceberg_table_numeric_string_columns = ",".join(dest_iceberg_table_config.get("numeric_string_columns", []))
+
+    transform_records_with_aws_lambda = data_firehose_configuration["transform_records_with_aws_lambda"]
+    request_time_zone = transform_records_with_aws_lambda.get("request_time_zone", "local") # [local, UTC]
+    transform_mode = transform_records_with_aws_lambda.get("transform_mode", "row") # [row, columnar]
+    emit_metrics = transform_records_with_aws_lambda.get("emit_metrics", False)
+    metrics_namespace = transform_records_with_aws_lambda.get("metrics_namespace", "SaaSMetering/FirehoseTransformer")
 
     LAMBDA_FN_NAME = "FirehoseToIcebergTransformer"
+    lambda_memory_size = self.node.try_get_context("lambda_memory_size") or {}
+    lambda_tracing = self.node.try_get_context("lambda_tracing") or {}
     self.data_proc_lambda_fn = aws_lambda.Function(self, "FirehoseToIcebergTransformer",
       runtime=aws_lambda.Runtime.PYTHON_3_11,
       function_name=LAMBDA_FN_NAME,
@@ -34,13 +49,35 @@ class FirehoseDataProcLambdaStack(Stack):
       environment={
         "IcebergDatabaseName": dest_iceberg_table_config["database_name"],
         "IcebergTableName": dest_iceberg_table_config["table_name"],
-        "IcebergTableUniqueKeys": dest_iceberg_table_unique_keys
+        "IcebergTableUniqueKeys": dest_iceberg_table_unique_keys,
+        "IcebergTableColumns": dest_iceberg_table_columns,
+        "IcebergTableSchemaFromGlue": str(dest_iceberg_table_schema_from_glue).lower(),
+        "IcebergTableNumericStringColumns": dest_iceberg_table_numeric_string_columns,
+        "RequestTimeZone": request_time_zone,
+        "TransformMode": transform_mode,
+        "EmitMetrics": str(emit_metrics).lower(),
+        "MetricsNamespace": metrics_namespace,
+        "TracingEnabled": str(lambda_tracing.get("enabled", False)).lower(),
+        "TracingSampleRate": str(lambda_tracing.get("sample_rate", 0.01))
       },
       timeout=cdk.Duration.minutes(5),
       #XXX: set memory size appropriately
-      memory_size=256
+      # Run benchmarks/memory_advisor.py to get the recommended memory size
+      memory_size=lambda_memory_size.get(LAMBDA_FN_NAME, 256),
+      layers=[create_tracing_layer(self, aws_lambda.Runtime.PYTHON_3_11)]
     )
 
+    if dest_iceberg_table_schema_from_glue:
+      self.data_proc_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=[
+          f"arn:aws:glue:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:catalog",
+          f"arn:aws:glue:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:database/{dest_iceberg_table_config['database_name']}",
+          f"arn:aws:glue:{cdk.Aws.REGION}:{cdk.Aws.ACCOUNT_ID}:table/{dest_iceberg_table_config['database_name']}/*"
+        ],
+        actions=["glue:GetTable"]
+      ))
+
     log_group = aws_logs.LogGroup(self, "FirehoseToIcebergTransformerLogGroup",
       #XXX: Circular dependency between resources occurs
       # if aws_lambda.Function.function_name is used
@@ -4,10 +4,22 @@
 
 import base64
 import collections
+import functools
 import json
 import logging
 import os
-from datetime import datetime
+import re
+import time
+from datetime import datetime, timezone
+
+import tracing
+
+try:
+  import numpy as np
+except ImportError:
+  #XXX: numpy is not included in the AWS Lambda Python runtime.
+  # Attach a Lambda Layer such as AWS SDK for pandas to group `request_time` with numpy in the columnar transform mode.
+  np = None
 
 
 LOGGER = logging.getLogger()
@@ -23,44 +35,395 @@ else:
 DESTINATION_DATABASE_NAME = os.environ['IcebergDatabaseName']
 DESTINATION_TABLE_NAME = os.environ['IcebergTableName']
 DESTINATION_TABLE_UNIQUE_KEYS = os.environ.get('IcebergTableUniqueKeys', None)
+REQUEST_TIME_FAST_PATH = os.environ.get('RequestTimeFastPath', 'true').lower() == 'true'
+REQUEST_TIME_ZONE = os.environ.get('RequestTimeZone', 'local') # [local, UTC]
+REQUEST_TIME_CACHE_SIZE = int(os.environ.get('RequestTimeCacheSize', '4096'))
+TRANSFORM_MODE = os.environ.get('TransformMode', 'row') # [row, columnar]
+DESTINATION_TABLE_COLUMNS = os.environ.get('IcebergTableColumns', '') # ex) request_id:string,ip:string,...
+DESTINATION_TABLE_SCHEMA_FROM_GLUE = os.environ.get('IcebergTableSchemaFromGlue', 'false').lower() == 'true'
+DESTINATION_TABLE_NUMERIC_STRING_COLUMNS = os.environ.get('IcebergTableNumericStringColumns', '') # ex) status
+EMIT_METRICS = os.environ.get('EmitMetrics', 'false').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('MetricsNamespace', 'SaaSMetering/FirehoseTransformer')
+
+REQUEST_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+INVALID_RECORD_REASONS = [
+  'malformed_json',
+  'malformed_record',
+  'missing_column',
+  'unknown_column',
+  'type_mismatch',
+  'invalid_request_time'
+]
+
+#XXX: (metric name, unit, key of the invocation metrics, scale)
+# Timings are measured in seconds and emitted in milliseconds.
+METRICS = [
+  ('RecordsIn', 'Count', 'total', 1),
+  ('RecordsOut', 'Count', 'valid', 1),
+  ('InvalidRecords', 'Count', 'invalid', 1),
+  ('BytesIn', 'Bytes', 'bytes_in', 1),
+  ('BytesOut', 'Bytes', 'bytes_out', 1),
+  ('RequestTimeCacheMisses', 'Count', 'request_time_cache_misses', 1),
+  ('DecodeTime', 'Milliseconds', 'decode_time', 1000),
+  ('ParseTime', 'Milliseconds', 'parse_time', 1000),
+  ('TransformTime', 'Milliseconds', 'transform_time', 1000),
+  ('EncodeTime', 'Milliseconds', 'encode_time', 1000)
+] + [
+  ('InvalidRecords.{}'.format(''.join(w.capitalize() for w in reason.split('_'))), 'Count', reason, 1)
+    for reason in INVALID_RECORD_REASONS
+]
+METRIC_DEFINITIONS = [{'Name': name, 'Unit': unit} for name, unit, _, _ in METRICS]
+
+#XXX: The fixed layout of `access_log_format` in cdk_stacks/random_gen_apigw.py
+# Strings are limited to printable ASCII characters without escapes,
+# and integers to their canonical form, so that `json.dumps(json.loads(...))`
+# reproduces every byte outside of `request_time`.
+_JSON_STRING = rb'"[\x20\x21\x23-\x5b\x5d-\x7e]*"'
+_JSON_INTEGER = rb'-?(?:0|[1-9][0-9]*)'
+ACCESS_LOG_LAYOUT = re.compile(
+  rb'(\{"request_id": ' + _JSON_STRING +
+  rb', "ip": ' + _JSON_STRING +
+  rb', "user": ' + _JSON_STRING +
+  rb', "request_time": )(' + _JSON_INTEGER +
+  rb')(, "http_method": ' + _JSON_STRING +
+  rb', "resource_path": ' + _JSON_STRING +
+  rb', "status": ' + _JSON_INTEGER +
+  rb', "protocol": ' + _JSON_STRING +
+  rb', "response_length": ' + _JSON_INTEGER +
+  rb'\})\n?'
+)
+
+#XXX: A record with the layout of `access_log_format`, which is used to check
+# whether every record matching `ACCESS_LOG_LAYOUT` is valid against the table schema.
+ACCESS_LOG_LAYOUT_SAMPLE = {
+  "request_id": "",
+  "ip": "",
+  "user": "",
+  "request_time": 0,
+  "http_method": "",
+  "resource_path": "",
+  "status": 0,
+  "protocol": "",
+  "response_length": 0
+}
+
+#XXX: JSON value types accepted for each column type of the table.
+# `request_time` is an epoch time in milliseconds before it is transformed into a timestamp.
+# Columns of other types (e.g. struct, array, map) are only checked for their presence.
+JSON_TYPES_BY_COLUMN_TYPE = {
+  'string': (str,),
+  'varchar': (str,),
+  'char': (str,),
+  'date': (str,),
+  'tinyint': (int,),
+  'smallint': (int,),
+  'int': (int,),
+  'integer': (int,),
+  'bigint': (int,),
+  'long': (int,),
+  'float': (int, float),
+  'double': (int, float),
+  'decimal': (int, float),
+  'boolean': (bool,),
+  'timestamp': (int, float),
+  'timestamptz': (int, float)
+}
+
+
+def parse_table_columns(table_columns):
+  """Parses `name:type,name:type,...` into a list of (name, type)."""
+  columns = []
+  for column in filter(None, table_columns.split(',')):
+    name, _, column_type = column.partition(':')
+    columns.append((name.strip(), column_type.strip()))
+  return columns
+
+
+def get_glue_table_columns(database_name, table_name):
+  import boto3
+
+  glue_client = boto3.client('glue')
+  response = glue_client.get_table(DatabaseName=database_name, Name=table_name)
+  return [(column['Name'], column['Type']) for column in response['Table']['StorageDescriptor']['Columns']]
+
+
+def is_string_column_type(column_type):
+  return JSON_TYPES_BY_COLUMN_TYPE.get(column_type.lower().split('(')[0].strip(), None) == (str,)
+
+
+def make_record_validator(columns, numeric_string_columns=()):
+  """Returns a function that returns None for a valid record, or the reason why the record is invalid.
+
+  The JSON value types of each column are looked up once, so that a record is validated without parsing the schema.
+  A string column in `numeric_string_columns` also accepts an integer, e.g. `status`, which API Gateway logs as a number.
+  """
+  column_names = frozenset(name for name, _ in columns)
+  column_json_types = []
+  for name, column_type in columns:
+    json_types = JSON_TYPES_BY_COLUMN_TYPE.get(column_type.lower().split('(')[0].strip(), None)
+    if json_types is not None:
+      if name in numeric_string_columns and is_string_column_type(column_type):
+        json_types = (str, int)
+      column_json_types.append((name, json_types))
+
+  def validate_record(record):
+    if type(record) is not dict:
+      return 'malformed_record'
+    if record.keys() != column_names:
+      return 'missing_column' if column_names - record.keys() else 'unknown_column'
+    for name, json_types in column_json_types:
+      value = record[name]
+      if value is not None and type(value) not in json_types:
+        return 'type_mismatch'
+    return None
+
+  return validate_record
+
+
+def build_record_validator():
+  """Builds the record validator from the columns of the table once at cold start. Returns None if no schema is given."""
+  columns = []
+  if DESTINATION_TABLE_SCHEMA_FROM_GLUE:
+    try:
+      columns = get_glue_table_columns(DESTINATION_DATABASE_NAME, DESTINATION_TABLE_NAME)
+    except Exception as ex:
+      LOGGER.warning('failed to get the schema of %s.%s from AWS Glue: %s', DESTINATION_DATABASE_NAME, DESTINATION_TABLE_NAME, ex)
+
+  #XXX: Declared columns take precedence over the table definition in AWS Glue.
+  declared_column_types = dict(parse_table_columns(DESTINATION_TABLE_COLUMNS))
+  columns = [(name, declared_column_types.pop(name, column_type)) for name, column_type in columns]
+  columns += list(declared_column_types.items())
+
+  numeric_string_columns = frozenset(filter(None, (e.strip() for e in DESTINATION_TABLE_NUMERIC_STRING_COLUMNS.split(','))))
+  return make_record_validator(columns, numeric_string_columns) if columns else None
+
+
+VALIDATE_RECORD = build_record_validator()
+
+
+#XXX: Records in a Firehose batch share a handful of distinct seconds,
+# so formatted timestamps are cached by epoch second across invocations of a warm container.
+@functools.lru_cache(maxsize=REQUEST_TIME_CACHE_SIZE)
+def format_epoch_second(epoch_second):
+  tz = timezone.utc if REQUEST_TIME_ZONE.upper() == 'UTC' else None
+  return datetime.fromtimestamp(epoch_second, tz=tz).strftime(REQUEST_TIME_FORMAT)
+
+
+def format_request_time(request_time):
+  if type(request_time) is int:
+    return format_epoch_second(request_time // 1000)
+  tz = timezone.utc if REQUEST_TIME_ZONE.upper() == 'UTC' else None
+  return datetime.fromtimestamp(request_time/1000, tz=tz).strftime(REQUEST_TIME_FORMAT)
+
+
+def is_access_log_layout_valid():
+  return VALIDATE_RECORD is None or VALIDATE_RECORD(ACCESS_LOG_LAYOUT_SAMPLE) is None
+
+
+def splice_request_time(match, request_time):
+  """Replaces the integer `request_time` of a record matching `ACCESS_LOG_LAYOUT` with a formatted value."""
+  head, _, tail = match.groups()
+  return b'%s"%s"%s' % (head, request_time.encode('utf-8'), tail)
+
+
+def format_request_times(request_times, reasons):
+  """Formats `request_time` of valid records. The value is None if it cannot be formatted."""
+  formatted = [None] * len(request_times)
+  for i, request_time in enumerate(request_times):
+    if reasons[i] is not None:
+      continue
+    try:
+      formatted[i] = format_request_time(request_time)
+    except Exception as _:
+      pass
+  return formatted
 
 
+def format_request_times_by_column(request_times, reasons):
+  """Formats `request_time` of valid records in one pass over the whole batch. The value is None if it cannot be formatted.
+
+  Integer values are floored to epoch seconds at once, and each distinct second is formatted once,
+  which gives the same output as `format_request_times`. Other values are formatted one at a time.
+  """
+  formatted = [None] * len(request_times)
+  indices, epoch_millis = [], []
+  for i, request_time in enumerate(request_times):
+    if reasons[i] is not None:
+      continue
+    if type(request_time) is int and -2**63 <= request_time < 2**63:
+      indices.append(i)
+      epoch_millis.append(request_time)
+      continue
+    try:
+      formatted[i] = format_request_time(request_time)
+    except Exception as _:
+      pass
+
+  if not indices:
+    return formatted
+
+  if np is not None:
+    unique_seconds, inverse = np.unique(np.floor_divide(np.array(epoch_millis, dtype=np.int64), 1000), return_inverse=True)
+    unique_seconds, inverse = unique_seconds.tolist(), inverse.tolist()
+  else:
+    epoch_seconds = [epoch_milli // 1000 for epoch_milli in epoch_millis]
+    unique_seconds = list(set(epoch_seconds))
+    position = {epoch_second: j for j, epoch_second in enumerate(unique_seconds)}
+    inverse = [position[epoch_second] for epoch_second in epoch_seconds]
+
+  formatted_seconds = []
+  for epoch_second in unique_seconds:
+    try:
+      formatted_seconds.append(format_epoch_second(epoch_second))
+    except Exception as _:
+      formatted_seconds.append(None)
+
+  for i, j in zip(indices, inverse):
+    formatted[i] = formatted_seconds[j]
+  return formatted
+
+
+def transform_records(records, metrics):
+  """Transforms a batch of records and returns a list of (data, reason), where reason is None for a valid record.
+
+  Records pass through the decode, parse and transform stages one stage at a time,
+  so that each stage is timed once per invocation rather than once per record.
+  In the columnar transform mode, `request_time` of the whole batch is converted at once.
+  """
+  fast_path = REQUEST_TIME_FAST_PATH and is_access_log_layout_valid()
+  format_fn = format_request_times_by_column if TRANSFORM_MODE == 'columnar' else format_request_times
+
+  start = time.perf_counter()
+  with tracing.span('decode'):
+    raws = [base64.b64decode(record['data']) for record in records]
+    metrics['bytes_in'] += sum(map(len, raws))
+  decoded_at = time.perf_counter()
+
+  parsed = [None] * len(raws) # a match of `ACCESS_LOG_LAYOUT` or a json value
+  request_times = [None] * len(raws)
+  reasons = [None] * len(raws)
+  with tracing.span('parse', fast_path=fast_path):
+    for i, raw in enumerate(raws):
+      match = ACCESS_LOG_LAYOUT.fullmatch(raw) if fast_path else None
+      if match is not None:
+        parsed[i] = match
+        request_times[i] = int(match.group(2))
+        continue
+
+      payload = raw.decode('utf-8')
+      try:
+        json_value = json.loads(payload)
+      except Exception as _:
+        reasons[i] = 'malformed_json'
+        continue
+
+      reason = VALIDATE_RECORD(json_value) if VALIDATE_RECORD is not None else None
+      if reason is None:
+        if type(json_value) is not dict:
+          reason = 'malformed_record'
+        elif 'request_time' not in json_value:
+          reason = 'missing_column'
+      if reason is not None:
+        reasons[i] = reason
+        continue
+
+      parsed[i] = json_value
+      request_times[i] = json_value['request_time']
+  parsed_at = time.perf_counter()
+
+  transformed = []
+  with tracing.span('transform', mode=TRANSFORM_MODE):
+    for raw, value, request_time, reason in zip(raws, parsed, format_fn(request_times, reasons), reasons):
+      if reason is not None:
+        pass
+      elif request_time is None:
+        reason = 'invalid_request_time'
+      elif type(value) is dict:
+        value['request_time'] = request_time
+        raw = json.dumps(value).encode('utf-8')
+      else:
+        raw = splice_request_time(value, request_time)
+      transformed.append((raw, reason))
+  transformed_at = time.perf_counter()
+
+  metrics['decode_time'] += decoded_at - start
+  metrics['parse_time'] += parsed_at - decoded_at
+  metrics['transform_time'] += transformed_at - parsed_at
+  return transformed
+
+
+def emit_metrics(metrics):
+  """Prints the metrics of an invocation as a single log line in CloudWatch Embedded Metric Format.
+
+  Every invocation emits the same set of metrics, so the log line does not grow with the number of records.
+  """
+  document = {
+    '_aws': {
+      'Timestamp': int(time.time() * 1000),
+      'CloudWatchMetrics': [{
+        'Namespace': METRICS_NAMESPACE,
+        'Dimensions': [['DestinationDatabaseName', 'DestinationTableName']],
+        'Metrics': METRIC_DEFINITIONS
+      }]
+    },
+    'DestinationDatabaseName': DESTINATION_DATABASE_NAME,
+    'DestinationTableName': DESTINATION_TABLE_NAME
+  }
+  for name, _, key, scale in METRICS:
+    document[name] = round(metrics[key] * scale, 3)
+
+  print(json.dumps(document), flush=True)
+
+
+@tracing.trace('firehose_to_iceberg_transformer')
 def lambda_handler(event, context):
   counter = collections.Counter(total=0, valid=0, invalid=0)
+  metrics = collections.Counter()
   firehose_records_output = {'records': []}
 
   unique_keys_exist = True if DESTINATION_TABLE_UNIQUE_KEYS else False
   otf_metadata_operation = 'insert' if not unique_keys_exist else 'update'
 
-  for record in event['records']:
-    counter['total'] += 1
+  cache_info = format_epoch_second.cache_info()
 
-    payload = base64.b64decode(record['data']).decode('utf-8')
-    is_valid = True
-    try:
-      json_value = json.loads(payload)
-      json_value['request_time'] = datetime.fromtimestamp(json_value['request_time']/1000).strftime('%Y-%m-%dT%H:%M:%SZ')
-      payload = json.dumps(json_value)
-    except Exception as _:
-      is_valid = False
-    counter['valid' if is_valid else 'invalid'] += 1
-
-    firehose_record = {
-      'data': base64.b64encode(payload.encode('utf-8')),
-      'recordId': record['recordId'],
-      'result': 'Ok' if is_valid else 'ProcessingFailed', # [Ok, Dropped, ProcessingFailed]
-      'metadata': {
-        'otfMetadata': {
-          'destinationDatabaseName': DESTINATION_DATABASE_NAME,
-          'destinationTableName': DESTINATION_TABLE_NAME,
-          'operation': otf_metadata_operation
+  records = event['records']
+  transformed_records = transform_records(records, metrics)
+
+  start = time.perf_counter()
+  with tracing.span('encode'):
+    for record, (raw, reason) in zip(records, transformed_records):
+      counter['total'] += 1
+      if reason is None:
+        counter['valid'] += 1
+        metrics['bytes_out'] += len(raw)
+      else:
+        counter['invalid'] += 1
+        metrics[reason] += 1
+
+      firehose_record = {
+        'data': base64.b64encode(raw),
+        'recordId': record['recordId'],
+        'result': 'Ok' if reason is None else 'ProcessingFailed', # [Ok, Dropped, ProcessingFailed]
+        'metadata': {
+          'otfMetadata': {
+            'destinationDatabaseName': DESTINATION_DATABASE_NAME,
+            'destinationTableName': DESTINATION_TABLE_NAME,
+            'operation': otf_metadata_operation
+          }
         }
       }
-    }
 
-    firehose_records_output['records'].append(firehose_record)
+      firehose_records_output['records'].append(firehose_record)
+  metrics['encode_time'] += time.perf_counter() - start
+
+  counter['request_time_cache_hits'] = format_epoch_second.cache_info().hits - cache_info.hits
+  counter['request_time_cache_misses'] = format_epoch_second.cache_info().misses - cache_info.misses
 
   LOGGER.info(', '.join("{}={}".format(k, v) for k, v in counter.items()))
+  if EMIT_METRICS:
+    metrics.update(counter)
+    emit_metrics(metrics)
 
   return firehose_records_output
 
@@ -68,6 +431,12 @@ def lambda_handler(event, context):
 if __name__ == '__main__':
   import pprint
 
+  if VALIDATE_RECORD is None:
+    #XXX: The same columns as `destination_iceberg_table_configuration` in .example.cdk.context.json
+    VALIDATE_RECORD = make_record_validator(parse_table_columns(
+      'request_id:string,ip:string,user:string,request_time:timestamp,http_method:string,'
+      'resource_path:string,status:string,protocol:string,response_length:int'), numeric_string_columns={'status'})
+
   record_list = [
     ('Ok', {
       "request_id": "685f946b-99b5-4281-9ea1-c46373b50a6d",
@@ -152,3 +521,36 @@ if __name__ == '__main__':
     res = lambda_handler(event, {})
     print(f"\n>> {correct_result} == {res['records'][0]['result']}?",  res['records'][0]['result'] == correct_result)
     pprint.pprint(res)
+
+  # The splice fast path must produce byte-identical output to the json.loads path.
+  EMIT_METRICS = False
+  ok_record = record_list[0][1]
+  edge_records = [record for _, record in record_list] + [
+    dict(ok_record, request_time=request_time) for request_time in (0, -1, 1743740705999, 10**20, 253402300800000)
+  ] + [
+    dict(ok_record, user='\uc0ac\uc6a9\uc790'),
+    dict(ok_record, resource_path='\\/random\\/strings')
+  ]
+
+  for record in edge_records:
+    for line_end in ('', '\n'):
+      event = {
+        "records": [
+          {
+            "recordId": "49546986683135544286507457936321625675700192471156785154",
+            "approximateArrivalTimestamp": 1495072949453,
+            "data": base64.b64encode((json.dumps(record) + line_end).encode('utf-8'))
+          }
+        ]
+      }
+
+      outputs = []
+      for fast_path in (True, False):
+        REQUEST_TIME_FAST_PATH = fast_path
+        outputs.append(lambda_handler(event, {}))
+      print(f"\n>> fast path == json.loads path? {outputs[0] == outputs[1]}", record.get('request_time'), repr(line_end))
+
+      TRANSFORM_MODE = 'columnar'
+      outputs.append(lambda_handler(event, {}))
+      TRANSFORM_MODE = 'row'
+      print(f">> columnar mode == row mode? {outputs[1] == outputs[2]}", record.get('request_time'), repr(line_end))
@@ -6,6 +6,8 @@ import json
 import random
 import string
 
+import tracing
+
 random.seed(47)
 
 MIN_LEN, MAX_LEN = (1, 20)
@@ -25,6 +27,7 @@ DEFAULT_PARAMS = {
 }
 
 
+@tracing.trace('random_strings')
 def lambda_handler(event, context):
   params = event['queryStringParameters'] if event.get('queryStringParameters', {}) else {}
   params.update({k: v for k, v in DEFAULT_PARAMS.items() if k not in params})
@@ -35,11 +38,15 @@ def lambda_handler(event, context):
   num = min(max(int(params['num']), MIN_NUM), MAX_NUM)
   length = min(max(int(params['len']), MIN_LEN), MAX_LEN)
 
-  ret = [''.join(random.choices(allowed_chars, k=length)) for _ in range(num)]
+  with tracing.span('generate', num=num, len=length):
+    ret = [''.join(random.choices(allowed_chars, k=length)) for _ in range(num)]
+
+  with tracing.span('serialize'):
+    body = json.dumps(ret)
 
   return {
     'statusCode': 200,
-    'body': json.dumps(ret)
+    'body': body
   }
 
 